@@ -0,0 +1,131 @@
+"""
+Backfill: upgrades a database created by an earlier version, which needs to be done before the API is used with it.
+First, the schema is brought up to date (the tables are only created by the API when they do not exist):
+- The columns that were added to the models are added to the tables (posts.path, posts.hot_score,
+  posts.controversial_score, images.renditions and images.content_hash).
+- The indexes that were added are created (e.g. the feed indexes and, on PostgreSQL, the trigram indexes).
+- The search objects are created (see models.py): the full text index on PostgreSQL, or the FTS5 table and its
+  triggers on SQLite, which is then filled from the existing posts.
+Then the values of the new columns are filled in for the existing rows:
+- path: the IDs of each post's ancestors (see models.py). Without it, replies to older comments get the wrong ancestors,
+  comment counts are not updated for the real ancestors, and deleting a thread leaves its older replies behind.
+- hot_score and controversial_score: the scores of the "hot" and "controversial" orders (see ranking.py), which are 0
+  for existing rows.
+Existing images have no renditions or content hash, which the API handles (their files are not shared with new uploads).
+
+Safe to run more than once (and while the API is running), since only missing objects are created and only rows with
+incorrect values are changed.
+
+Run from the FastAPI directory (uses DB_URI):
+python backfill.py
+"""
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+from sqlalchemy import Text, cast, inspect, literal, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.schema import CreateColumn
+
+from database import AsyncSessionLocal, async_engine
+from models import Base, Post, SEARCH_DDL, TRIGRAM_EXTENSION_DDL
+from services.ranking import refresh_scores
+
+
+def add_column_ddl(connection: Connection, column) -> str:
+    # e.g. ALTER TABLE posts ADD COLUMN path VARCHAR NOT NULL DEFAULT ''.
+    # A NOT NULL column can only be added with a default for the existing rows, so its (Python side) default is used:
+    ddl = f"ALTER TABLE {column.table.name} ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}"
+    if not column.nullable and column.server_default is None and column.default is not None and column.default.is_scalar:
+        ddl += f" DEFAULT {literal(column.default.arg).compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})}"
+    return ddl
+
+
+def migrate_schema(connection: Connection) -> list:
+    # Adds the tables, columns, indexes and search objects of the models that are missing from the database.
+    # Returns a description of each change.
+    changes = []
+    dialect = connection.dialect.name
+
+    # The trigram indexes need the extension (which is also created before the tables, see models.py):
+    if dialect == "postgresql": connection.execute(text(TRIGRAM_EXTENSION_DDL))
+
+    # New tables are created along with their indexes (and their search objects, for the posts table):
+    existing_tables = set(inspect(connection).get_table_names())
+    Base.metadata.create_all(connection)
+    changes += [f"Created table {table.name}" for table in Base.metadata.sorted_tables if table.name not in existing_tables]
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables: continue
+
+        existing_columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns: continue
+            connection.execute(text(add_column_ddl(connection, column)))
+            changes.append(f"Added column {table.name}.{column.name}")
+
+        # Indexes that only apply to another database (e.g. the trigram indexes on SQLite) are skipped by create:
+        existing_indexes = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes: continue
+            index.create(connection)
+            if index.name in {index["name"] for index in inspect(connection).get_indexes(table.name)}:
+                changes.append(f"Created index {index.name}")
+
+    # The search statements create their objects only if they do not exist:
+    for statement in SEARCH_DDL.get(dialect, ()): connection.execute(text(statement))
+
+    if dialect == "sqlite":
+        # Adding the posts that are not in the search table yet (the triggers only add posts as they are created):
+        added = connection.execute(text(
+            "INSERT INTO posts_fts (rowid, title, body, author) "
+            "SELECT posts.id, posts.title, posts.body, users.name FROM posts LEFT JOIN users ON users.id = posts.user_id "
+            "WHERE posts.id NOT IN (SELECT rowid FROM posts_fts)"
+        )).rowcount
+        if added: changes.append(f"Added {added} posts to the search table")
+
+    return changes
+
+
+async def backfill_paths(db: AsyncSession) -> int:
+    # Builds the path of every post from the parent IDs with a recursive query (starting from the top-level posts,
+    # then adding a level of replies at a time), and updates the posts whose paths differ, in one statement.
+    # Returns the number of posts that were updated.
+    posts = Post.__table__
+    # The paths are cast to TEXT in both parts of the query, since PostgreSQL requires them to have the same type:
+    tree = select(posts.c.id, cast(literal(""), Text).label("path")).where(posts.c.parent_id.is_(None)).cte("tree", recursive=True)
+    parent = tree.alias("parent")
+    tree = tree.union_all(
+        select(posts.c.id, cast(parent.c.path + cast(parent.c.id, Text) + "/", Text).label("path"))
+        .join(parent, posts.c.parent_id == parent.c.id)
+    )
+
+    # The IDs are returned to count the updated posts (SQLite does not report the row count of statements starting with WITH):
+    updated = (await db.execute(
+        update(posts).where(posts.c.id == tree.c.id, posts.c.path != tree.c.path).values(path=tree.c.path).returning(posts.c.id)
+    )).all()
+    await db.commit()
+    return len(updated)
+
+
+async def backfill() -> None:
+    # The schema is changed in one transaction (on PostgreSQL, where DDL is transactional, a failure changes nothing):
+    async with async_engine.begin() as connection:
+        for change in await connection.run_sync(migrate_schema): print(change)
+
+    async with AsyncSessionLocal() as db:
+        print(f"Backfilled the paths of {await backfill_paths(db)} posts")
+        # The scores are calculated from the counters and creation times (in batches):
+        print(f"Backfilled the scores of {await refresh_scores(db)} posts")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    asyncio.run(backfill())
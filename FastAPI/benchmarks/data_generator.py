@@ -0,0 +1,164 @@
+"""
+Synthetic data generator: fills the database with users, top-level posts with comment trees, votes and images,
+for benchmarking the API with realistic amounts of data (used by benchmarks.suite).
+
+The same seed always generates the same posts, comments and votes. Every user's password is PASSWORD.
+
+Run from the FastAPI directory (uses DB_URI):
+python -m benchmarks.data_generator --users 100 --posts 1000 --comments 20 --depth 8 --votes 10
+"""
+import argparse
+import asyncio
+import datetime
+import random
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+from sqlalchemy import insert
+
+from database import engine, AsyncSessionLocal
+from enums import VoteType
+from models import Base, User, Post, Image, Vote
+from security import bcrypt_context
+from services.ranking import score_values
+
+PASSWORD = "benchmark-password"
+
+# The number of rows inserted per statement:
+BATCH_SIZE = 1000
+
+
+@dataclass
+class Node:
+    # A post (or comment) to be inserted, with the index of its parent in the list of nodes:
+    user_id: int
+    parent: Optional[int]
+    depth: int
+    created_at: datetime.datetime
+    votes: dict = field(default_factory=dict)
+    comment_count: int = 0
+    id: Optional[int] = None
+    path: str = ""
+
+
+@dataclass
+class Dataset:
+    # What was generated, used by the benchmarks to choose what to request:
+    user_ids: List[int]
+    emails: List[str]
+    post_ids: List[int]
+    comment_ids: List[int]
+    # The owner of each top-level post:
+    post_owners: dict
+
+    def summary(self) -> dict:
+        return {"users": len(self.user_ids), "posts": len(self.post_ids), "comments": len(self.comment_ids)}
+
+
+def comment_tree(rng: random.Random, root: int, comments: int, depth: int, user_ids: List[int], nodes: List[Node]) -> None:
+    # Adds the comments of the post at index 'root' to the nodes. The first comments form a chain down to the
+    # maximum depth, so that every tree is deep. The rest reply to random comments above the maximum depth:
+    parents = [root]
+    for i in range(comments):
+        parent = len(nodes) - 1 if i < depth else rng.choice(parents)
+
+        node = Node(user_id=rng.choice(user_ids), parent=parent, depth=nodes[parent].depth + 1,
+                    created_at=nodes[parent].created_at + datetime.timedelta(seconds=rng.randint(1, 3600)))
+        nodes.append(node)
+        if node.depth < depth: parents.append(len(nodes) - 1)
+
+        # Every ancestor's comment count includes the comment:
+        ancestor = parent
+        while ancestor is not None:
+            nodes[ancestor].comment_count += 1
+            ancestor = nodes[ancestor].parent
+
+
+async def insert_returning_ids(db, model, rows: List[dict]) -> List[int]:
+    ids = []
+    for i in range(0, len(rows), BATCH_SIZE):
+        result = await db.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows[i:i + BATCH_SIZE])
+        ids.extend(result.scalars().all())
+    return ids
+
+
+async def generate(users: int, posts: int, comments: int, depth: int, votes: int, image_ratio: float, seed: int = 0) -> Dataset:
+    rng = random.Random(seed)
+    # Every user has the same password, so it is only hashed once:
+    password_hash = bcrypt_context.hash(PASSWORD)
+    # Emails are unique for each run, so the data can be generated again in the same database:
+    run_id = f"{random.getrandbits(32):08x}"
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+    async with AsyncSessionLocal() as db:
+        emails = [f"user-{i}-{run_id}@example.com" for i in range(users)]
+        user_ids = await insert_returning_ids(db, User, [{"name": f"User {i}", "email": email, "password": password_hash}
+                                                         for i, email in enumerate(emails)])
+
+        # Building the trees first, so the counters are known when the posts are inserted:
+        nodes = []
+        for _ in range(posts):
+            nodes.append(Node(user_id=rng.choice(user_ids), parent=None, depth=0,
+                              created_at=now - datetime.timedelta(seconds=rng.randint(3600, 30 * 24 * 3600))))
+            comment_tree(rng, len(nodes) - 1, comments, depth, user_ids, nodes)
+
+        for node in nodes:
+            voters = rng.sample(user_ids, min(votes, len(user_ids)))
+            node.votes = {voter: rng.choice([VoteType.UP, VoteType.UP, VoteType.DOWN]) for voter in voters}
+
+        # Inserting a level at a time, since the comments need the IDs of their parents:
+        for level in range(depth + 1):
+            level_nodes = [node for node in nodes if node.depth == level]
+            if not level_nodes: break
+
+            rows = []
+            for node in level_nodes:
+                parent = nodes[node.parent] if node.parent is not None else None
+                node.path = f"{parent.path}{parent.id}/" if parent else ""
+                up = sum(1 for vote in node.votes.values() if vote == VoteType.UP)
+                down = len(node.votes) - up
+                rows.append({"user_id": node.user_id, "title": f"Post {rng.getrandbits(32):x}" if parent is None else None,
+                             "body": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * rng.randint(1, 6),
+                             "parent_id": parent.id if parent else None, "path": node.path, "comment_count": node.comment_count,
+                             "upvote_count": up, "downvote_count": down, "created_at": node.created_at,
+                             **score_values(up, down, node.created_at)})
+
+            for node, post_id in zip(level_nodes, await insert_returning_ids(db, Post, rows)): node.id = post_id
+
+        vote_rows = [{"post_id": node.id, "user_id": voter, "vote_type": vote_type}
+                     for node in nodes for voter, vote_type in node.votes.items()]
+        for i in range(0, len(vote_rows), BATCH_SIZE): await db.execute(insert(Vote), vote_rows[i:i + BATCH_SIZE])
+
+        # The image files are not created, since the benchmarks only request the posts (not the files):
+        roots = [node for node in nodes if node.parent is None]
+        rendition = {"name": "feed", "format": "webp", "width": 600, "height": 400, "url": "images/benchmark_feed.webp"}
+        image_rows = [{"post_id": node.id, "url": "images/benchmark.png", "renditions": [rendition]}
+                      for node in roots if rng.random() < image_ratio]
+        for i in range(0, len(image_rows), BATCH_SIZE): await db.execute(insert(Image), image_rows[i:i + BATCH_SIZE])
+
+        await db.commit()
+
+    return Dataset(user_ids=user_ids, emails=emails, post_ids=[node.id for node in roots],
+                   comment_ids=[node.id for node in nodes if node.parent is not None],
+                   post_owners={node.id: node.user_id for node in roots})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=20, help="comments per top-level post")
+    parser.add_argument("--depth", type=int, default=8, help="maximum depth of the comment trees")
+    parser.add_argument("--votes", type=int, default=10, help="votes per post and comment")
+    parser.add_argument("--image-ratio", type=float, default=0.3, help="fraction of top-level posts with an image")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    dataset = asyncio.run(generate(args.users, args.posts, args.comments, args.depth, args.votes, args.image_ratio, args.seed))
+    print(dataset.summary())
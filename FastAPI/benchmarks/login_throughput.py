@@ -0,0 +1,88 @@
+"""
+Login throughput benchmark: sends bursts of concurrent login requests through the API with different numbers of
+password hashing threads, reporting the logins per second, the latency of the logins, and the latency of a cheap
+request made during the burst (which would stall if hashing blocked the event loop).
+
+Run from the FastAPI directory (uses DB_URI):
+python -m benchmarks.login_throughput --pool-sizes 1 2 4 8 --logins 64
+"""
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+import httpx
+
+import main
+import security
+from metrics import LatencyStats
+
+PASSWORD = "benchmark-password"
+
+
+async def timed_request(client: httpx.AsyncClient, stats: LatencyStats, method: str, url: str, **kwargs) -> int:
+    started_at = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    stats.record(time.perf_counter() - started_at)
+    return response.status_code
+
+
+async def run(client: httpx.AsyncClient, email: str, pool_size: int, logins: int) -> dict:
+    # Replacing the hashing threads, allowing every login to wait so that none of them are rejected:
+    security.hash_executor.shutdown()
+    security.hash_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="password-hash")
+    security.HASH_WORKERS, security.HASH_QUEUE_LIMIT = pool_size, logins
+
+    login_stats, other_stats = LatencyStats(), LatencyStats()
+    form = {"username": email, "password": PASSWORD}
+
+    async def other_requests():
+        # A request that does not hash, made repeatedly while the logins are running:
+        while True:
+            await timed_request(client, other_stats, "GET", "/docs")
+            await asyncio.sleep(0.01)
+
+    other_task = asyncio.create_task(other_requests())
+    started_at = time.perf_counter()
+    statuses = await asyncio.gather(*(timed_request(client, login_stats, "POST", "/auth/token", data=form)
+                                      for _ in range(logins)))
+    elapsed = time.perf_counter() - started_at
+    other_task.cancel()
+
+    return {
+        "pool_size": pool_size,
+        "logins_per_second": round(logins / elapsed, 1),
+        "successful": statuses.count(200),
+        "login_p50_ms": round(login_stats.percentile(50) * 1000, 1),
+        "login_p99_ms": round(login_stats.percentile(99) * 1000, 1),
+        "other_request_p99_ms": round(other_stats.percentile(99) * 1000, 1),
+    }
+
+
+async def benchmark(pool_sizes: list, logins: int) -> None:
+    # Turning off rate limits, since every request comes from the same client:
+    main.app.state.limiter.enabled = False
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        email = f"login-benchmark-{random.getrandbits(64):x}@example.com"
+        response = await client.post("/user/", json={"name": "Login Benchmark", "email": email, "password": PASSWORD})
+        response.raise_for_status()
+
+        for pool_size in pool_sizes:
+            print(await run(client, email, pool_size, logins))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--logins", type=int, default=64)
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args.pool_sizes, args.logins))
@@ -0,0 +1,105 @@
+"""
+Query budget check: sends a request to each endpoint below (with the caches empty) and fails if any of them sends more
+database queries than its budget, listing the statements it sent. Run in CI so that a change adding round trips
+(e.g. an N+1 pattern) fails, rather than being found in production.
+If a change needs more queries on purpose, its budget is raised here along with it.
+
+Run from the FastAPI directory (uses DB_URI, a new SQLite file is the simplest, e.g. DB_URI=sqlite:///budgets.db):
+python -m benchmarks.query_budgets
+"""
+import argparse
+import asyncio
+import sys
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+import httpx
+
+import main
+from database import engine
+from models import Base
+from query_monitor import QueryBudgetExceeded, query_budget
+from security import create_access_token
+from services import response_cache as rc
+from services.user_cache import user_cache
+from benchmarks.data_generator import generate
+
+# The maximum number of queries for each request. {post}, {comment} and {user} are replaced by the IDs of a post,
+# a comment and a user from the generated data (the requests are made as the owner of the post).
+# Reading posts takes a fixed number of queries, however many posts and comments are returned: the posts, their
+# comment trees, and one query for each relationship returned with them (authors, their profile images and the
+# post images) for the posts and for the comments, plus the current user (and their profile image) and their votes.
+# Requesting more posts must not need more queries (which would be an N+1 pattern):
+BUDGETS = [
+    ("GET", "/post/", {}, 11),
+    ("GET", "/post/?limit=100", {}, 11),
+    ("GET", "/post/?show_comments=true&order_by=hot", {}, 11),
+    ("GET", "/post/?user_id={user}", {}, 11),
+    ("GET", "/post/{post}", {}, 11),
+    ("GET", "/post/{post}/comments", {}, 11),
+    ("GET", "/post/search?q=lorem", {}, 11),
+    ("GET", "/user/{user}", {}, 2),
+    ("GET", "/user/", {}, 2),
+    ("POST", "/post/", {"json": {"title": "Budget", "body": "Checking the query budget"}}, 4),
+    ("POST", "/post/", {"json": {"title": None, "body": "A reply", "parent_id": "{comment}"}}, 6),
+    ("PUT", "/post/{post}", {"json": {"title": "Edited", "body": "Edited body"}}, 7),
+    ("POST", "/post/{post}/vote/?vote_type=down", {}, 5),
+    # Deleting a thread takes the same number of queries, however many replies, votes and images it has:
+    ("DELETE", "/post/{post}", {}, 6),
+]
+
+
+def fill(value, ids: dict):
+    # Replaces the placeholders in the URL and the JSON body:
+    if isinstance(value, str):
+        for name, id in ids.items():
+            if value == f"{{{name}}}": return id
+            value = value.replace(f"{{{name}}}", str(id))
+    if isinstance(value, dict): return {key: fill(item, ids) for key, item in value.items()}
+    return value
+
+
+async def check_budgets() -> bool:
+    # Turning off rate limits, since every request comes from the same client:
+    main.app.state.limiter.enabled = False
+
+    Base.metadata.create_all(bind=engine)
+    dataset = await generate(users=5, posts=30, comments=10, depth=4, votes=3, image_ratio=0.5)
+    post_id = dataset.post_ids[0]
+    ids = {"post": post_id, "user": dataset.post_owners[post_id], "comment": dataset.comment_ids[0]}
+    headers = {"Authorization": f"Bearer {create_access_token(ids['user'])}"}
+
+    passed = True
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://budgets", headers=headers) as client:
+        for method, url, kwargs, budget in BUDGETS:
+            # Measuring requests that are not cached, which send the most queries:
+            await user_cache.clear()
+            await rc.response_cache.clear()
+
+            label = f"{method} {url}"
+            try:
+                with query_budget(budget, label) as queries:
+                    response = await client.request(method, fill(url, ids), **fill(kwargs, ids))
+                print(f"{label}: {queries.count}/{budget} queries ({response.status_code})")
+                if response.status_code >= 400:
+                    print(f"  Request failed: {response.text}")
+                    passed = False
+
+            except QueryBudgetExceeded as e:
+                print(e)
+                passed = False
+
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    passed = asyncio.run(check_budgets())
+    print("All requests are within their budgets" if passed else "Some requests are over their budgets")
+    sys.exit(0 if passed else 1)
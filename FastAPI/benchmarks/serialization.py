@@ -0,0 +1,102 @@
+"""
+Serialization benchmark: loads a feed of posts (each with comments and an image), then compares the time taken to turn
+it into a response by validating it into the response model (as FastAPI does for returned ORM objects)
+with the serializers in serializers.py, checking that both produce the same JSON.
+
+Run from the FastAPI directory (uses DB_URI):
+python -m benchmarks.serialization --posts 1000 --comments 3 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
+from starlette.responses import JSONResponse
+
+from database import engine, AsyncSessionLocal
+from models import Base, User, Post, Image
+from schemas import PostResponse
+from serializers import serialize_post
+from services import post_service as ps
+
+
+def response_model_body(posts: list) -> bytes:
+    # What FastAPI does with the returned objects when the route has a response_model:
+    adapter = TypeAdapter(List[PostResponse])
+    content = adapter.dump_python(adapter.validate_python(posts, from_attributes=True), mode="json")
+    return JSONResponse(content).body
+
+
+def serializer_body(posts: list) -> bytes:
+    return ORJSONResponse([serialize_post(post) for post in posts]).body
+
+
+def timed(function, posts: list, repeat: int) -> tuple:
+    # Returns the fastest time (the least affected by other processes), and the body:
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        body = function(posts)
+        times.append(time.perf_counter() - started_at)
+    return min(times), body
+
+
+async def seed(posts: int, comments: int) -> int:
+    # Creates the posts under a new user, returning the user's ID:
+    rendition = {"name": "thumbnail", "format": "webp", "width": 150, "height": 100, "url": "images/benchmark_thumbnail.webp"}
+
+    async with AsyncSessionLocal() as db:
+        author = User(name="Serialization Benchmark", email=f"serialization-{random.getrandbits(64):x}@example.com", password="-")
+        db.add(author)
+        await db.flush()
+
+        for i in range(posts):
+            post = Post(user_id=author.id, title=f"Post {i}", body="Lorem ipsum dolor sit amet. " * 8, path="",
+                        upvote_count=i % 50, downvote_count=i % 7, comment_count=comments)
+            post.images.append(Image(url="images/benchmark.png", renditions=[rendition] * 2))
+            db.add(post)
+            await db.flush()
+
+            db.add_all(Post(user_id=author.id, title=None, body=f"Comment {j}", parent_id=post.id, path=f"{post.id}/")
+                       for j in range(comments))
+        await db.commit()
+        return author.id
+
+
+async def benchmark(posts: int, comments: int, repeat: int) -> None:
+    Base.metadata.create_all(bind=engine)
+    author_id = await seed(posts, comments)
+
+    async with AsyncSessionLocal() as db:
+        feed, _ = await ps.get_posts(db, user_id=author_id, limit=posts)
+
+    response_model_time, expected = timed(response_model_body, feed, repeat)
+    serializer_time, body = timed(serializer_body, feed, repeat)
+
+    print({
+        "posts": len(feed),
+        "comments_per_post": comments,
+        "response_model_ms": round(response_model_time * 1000, 1),
+        "serializers_ms": round(serializer_time * 1000, 1),
+        "speedup": round(response_model_time / serializer_time, 1),
+        "same_json": json.loads(expected) == json.loads(body),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args.posts, args.comments, args.repeat))
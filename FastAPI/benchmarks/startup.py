@@ -0,0 +1,97 @@
+"""
+Startup benchmark: starts the app in new processes (as a worker does when the server starts or restarts a worker),
+measuring the time taken to import main, to run the startup of the lifespan (warming up the database connections and
+password hashing) and to serve the first request, and reports the median and maximum of each as JSON.
+Regressions (e.g. a module doing work when it is imported) show up as a longer import time.
+
+Run from the FastAPI directory (uses DB_URI, with the tables already created):
+python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports (they are passed on to the processes that are measured):
+load_dotenv()
+
+PHASES = ["import_ms", "startup_ms", "first_request_ms", "total_ms"]
+
+# Run in each new process, printing the times as JSON. The first request is sent through the app directly (rather than
+# over a socket), so only the app is measured:
+MEASURE = """
+import time
+started_at = time.perf_counter()
+
+import asyncio, json
+import httpx
+import main
+imported_at = time.perf_counter()
+
+async def measure():
+    async with main.app.router.lifespan_context(main.app):
+        started_up_at = time.perf_counter()
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            response = await client.get(%(url)r)
+        served_at = time.perf_counter()
+    return started_up_at, served_at, response.status_code
+
+started_up_at, served_at, status = asyncio.run(measure())
+print(json.dumps({"import_ms": (imported_at - started_at) * 1000, "startup_ms": (started_up_at - imported_at) * 1000,
+                  "first_request_ms": (served_at - started_up_at) * 1000, "total_ms": (served_at - started_at) * 1000,
+                  "status": status}))
+"""
+
+
+def measure_startup(url: str) -> dict:
+    result = subprocess.run([sys.executable, "-c", MEASURE % {"url": url}], capture_output=True, text=True)
+    if result.returncode != 0: raise RuntimeError(f"The app failed to start:\n{result.stderr}")
+    # The startup messages are printed before the times, which are on the last line:
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(count: int) -> list:
+    # The modules that took the longest to import (including the modules they imported), from python -X importtime:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit(): imports.append((int(cumulative) / 1000, module.strip()))
+
+    return [{"module": module, "ms": round(ms, 1)} for ms, module in sorted(imports, reverse=True)[:count]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--url", default="/post/?limit=1", help="the first request sent once the app has started")
+    parser.add_argument("--imports", type=int, default=0, help="also list this many of the slowest imports")
+    parser.add_argument("--output", help="file to write the results to (as JSON), as well as printing them")
+    args = parser.parse_args()
+
+    # Making sure the tables are not created while measuring:
+    os.environ.pop("CREATE_SCHEMA", None)
+
+    runs = []
+    for run in range(args.runs):
+        runs.append(measure_startup(args.url))
+        # Progress goes to stderr, so stdout only has the results:
+        print(f"Run {run + 1}: {runs[-1]}", file=sys.stderr, flush=True)
+
+    results = {
+        "runs": args.runs,
+        "statuses": sorted({run["status"] for run in runs}),
+        **{phase: {"median": round(statistics.median(run[phase] for run in runs), 1),
+                   "max": round(max(run[phase] for run in runs), 1)} for phase in PHASES},
+    }
+    if args.imports: results["slowest_imports"] = slowest_imports(args.imports)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file: json.dump(results, file, indent=2)
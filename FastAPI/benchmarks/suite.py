@@ -0,0 +1,210 @@
+"""
+Benchmark suite: generates a dataset (see benchmarks.data_generator), then sends requests through the API for each
+scenario (feed, thread, vote, login and upload), reporting the latency percentiles, the number of database queries
+per request and the throughput of each one as JSON, so the results of different commits can be compared.
+Failed requests (4xx and 5xx responses) are not included in the latency and throughput. A scenario with any failed
+requests is marked as failed, with examples of the responses, and the suite exits with status 1.
+
+Run from the FastAPI directory (uses DB_URI, a new SQLite file is the simplest, e.g. DB_URI=sqlite:///benchmark.db):
+python -m benchmarks.suite --posts 1000 --requests 200 --concurrency 10 --output results.json
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import random
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+import httpx
+from PIL import Image as PILImage
+from sqlalchemy import event
+
+import main
+from database import engine, async_engine
+from enums import Order, VoteType
+from metrics import LatencyStats
+from models import Base
+from security import create_access_token
+from services import response_cache as rc
+from benchmarks.data_generator import PASSWORD, Dataset, generate
+
+SCENARIOS = ["feed", "thread", "vote", "login", "upload"]
+
+# The number of failed responses kept for each scenario, to show why it failed:
+ERROR_SAMPLES = 3
+
+
+class QueryCounter:
+    # Counts the statements sent to the database (by every request, since they run concurrently):
+    def __init__(self):
+        self.count = 0
+        event.listen(async_engine.sync_engine, "before_cursor_execute", self.count_query)
+
+    def count_query(self, *args) -> None:
+        self.count += 1
+
+
+def auth_headers(user_id: int) -> dict:
+    # Tokens are created directly, rather than by logging in (which would hash a password for every user):
+    return {"Authorization": f"Bearer {create_access_token(user_id)}"}
+
+
+def png_file(rng: random.Random) -> bytes:
+    # A different image each time, so every upload is processed (rather than matching an earlier upload):
+    image = PILImage.new("RGB", (800, 600), tuple(rng.randrange(256) for _ in range(3)))
+    image.putpixel((rng.randrange(800), rng.randrange(600)), (0, 0, 0))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def request_for(scenario: str, dataset: Dataset, rng: random.Random, depth: int) -> tuple:
+    # Returns the method, URL and arguments of a request for the scenario, made by a random user:
+    user_id = rng.choice(dataset.user_ids)
+
+    if scenario == "feed":
+        order_by = rng.choice(list(Order)).value
+        return "GET", f"/post/?order_by={order_by}&limit=20", {"headers": auth_headers(user_id)}
+
+    if scenario == "thread":
+        return "GET", f"/post/{rng.choice(dataset.post_ids)}?max_depth={depth}", {"headers": auth_headers(user_id)}
+
+    if scenario == "vote":
+        post_id = rng.choice(dataset.post_ids + dataset.comment_ids)
+        return "POST", f"/post/{post_id}/vote/?vote_type={rng.choice(list(VoteType)).value}", {"headers": auth_headers(user_id)}
+
+    if scenario == "login":
+        email = dataset.emails[dataset.user_ids.index(user_id)]
+        return "POST", "/auth/token", {"data": {"username": email, "password": PASSWORD}}
+
+    if scenario == "upload":
+        # Only the owner of a post can add images to it:
+        post_id = rng.choice(dataset.post_ids)
+        return "POST", f"/post/{post_id}/image/", {"headers": auth_headers(dataset.post_owners[post_id]),
+                                                  "files": {"image": ("benchmark.png", png_file(rng), "image/png")}}
+
+    raise ValueError(f"Unknown scenario '{scenario}'")
+
+
+async def run_scenario(client: httpx.AsyncClient, queries: QueryCounter, scenario: str, dataset: Dataset,
+                       requests: int, concurrency: int, depth: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    # The requests are prepared before timing, so that only the API is measured:
+    prepared = [request_for(scenario, dataset, rng, depth) for _ in range(requests)]
+    latency = LatencyStats(window=requests)
+    errors, uploads = [], []
+
+    async def worker():
+        while prepared:
+            method, url, kwargs = prepared.pop()
+            started_at = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            duration = time.perf_counter() - started_at
+
+            # Failed requests are often much faster (or slower) than successful ones, so they are not measured:
+            if response.status_code >= 400:
+                errors.append(f"{method} {url}: {response.status_code} {response.text[:200]}")
+                continue
+            latency.record(duration)
+            if scenario == "upload": uploads.append((url, kwargs["headers"], response.json()["url"]))
+
+    cache_before, queries_before = rc.stats(), queries.count
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    cache_after, query_count = rc.stats(), queries.count - queries_before
+
+    # Removing the uploaded images (not timed), so the image directory does not fill up with benchmark images:
+    for url, headers, image_url in uploads: await client.delete(f"{url.rstrip('/')}/{image_url}", headers=headers)
+
+    summary = latency.summary()
+    return {
+        "requests": requests,
+        "failed": bool(errors),
+        "errors": len(errors),
+        "error_samples": errors[:ERROR_SAMPLES],
+        "p50_ms": round(summary["p50_ms"], 2),
+        "p99_ms": round(summary["p99_ms"], 2),
+        "mean_ms": round(summary["mean_ms"], 2),
+        "max_ms": round(summary["max_ms"], 2),
+        # Only the requests that succeeded count towards the throughput:
+        "requests_per_second": round(latency.count / elapsed, 1),
+        "queries_per_request": round(query_count / requests, 2),
+        "response_cache_hits": cache_after["hits"] - cache_before["hits"],
+        "response_cache_misses": cache_after["misses"] - cache_before["misses"],
+    }
+
+
+def git_commit() -> str:
+    # The commit being benchmarked, so results can be matched to it:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    # Turning off rate limits, since every request comes from the same client:
+    main.app.state.limiter.enabled = False
+
+    Base.metadata.create_all(bind=engine)
+    started_at = time.perf_counter()
+    dataset = await generate(args.users, args.posts, args.comments, args.depth, args.votes, args.image_ratio, args.seed)
+    generation_seconds = time.perf_counter() - started_at
+
+    queries = QueryCounter()
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for scenario in args.scenarios:
+            # Logins and uploads are much slower than the other requests (hashing and image processing), so fewer are sent:
+            requests = {"login": args.logins, "upload": args.uploads}.get(scenario, args.requests)
+            results[scenario] = await run_scenario(client, queries, scenario, dataset, requests, args.concurrency, args.depth, args.seed)
+            # Progress goes to stderr, so stdout only has the results:
+            print(f"{scenario}: {results[scenario]}", file=sys.stderr, flush=True)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "database": engine.dialect.name,
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "dataset": {**dataset.summary(), "generation_seconds": round(generation_seconds, 1)},
+        "scenarios": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=20, help="comments per top-level post")
+    parser.add_argument("--depth", type=int, default=8, help="maximum depth of the comment trees")
+    parser.add_argument("--votes", type=int, default=10, help="votes per post and comment")
+    parser.add_argument("--image-ratio", type=float, default=0.3, help="fraction of top-level posts with an image")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to (as JSON), as well as printing them")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file: json.dump(results, file, indent=2)
+
+    # The results of a scenario with failed requests do not measure what it was meant to, so the run fails:
+    failed = [scenario for scenario, result in results["scenarios"].items() if result["failed"]]
+    if failed:
+        print(f"Scenarios with failed requests: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
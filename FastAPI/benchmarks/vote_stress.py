@@ -0,0 +1,64 @@
+"""
+Concurrency stress test for voting: many users vote on the same post at once, each changing and removing their
+vote several times, then the post's counters are compared with the votes that were actually saved.
+
+Run from the FastAPI directory (uses DB_URI, PostgreSQL is recommended since SQLite serialises all writes):
+python -m benchmarks.vote_stress --users 200 --rounds 5
+"""
+import argparse
+import asyncio
+import random
+import sys
+
+from dotenv import load_dotenv
+
+# Loading environment variables before local imports:
+load_dotenv()
+
+from sqlalchemy import select, func
+
+from database import engine, AsyncSessionLocal
+from enums import VoteType
+from models import Base, User, Post, Vote
+from services import post_service as ps
+
+
+async def vote_repeatedly(user: User, post_id: int, rounds: int) -> None:
+    for _ in range(rounds):
+        # Each request has its own session (and connection), as it would in the API:
+        async with AsyncSessionLocal() as db:
+            await ps.vote(db, user, post_id, random.choice(list(VoteType)))
+
+
+async def main(users: int, rounds: int) -> bool:
+    Base.metadata.create_all(bind=engine)
+
+    async with AsyncSessionLocal() as db:
+        voters = [User(name=f"Voter {i}", email=f"voter-{random.getrandbits(64):x}@example.com", password="-") for i in range(users)]
+        post = Post(author=voters[0], title="Vote stress test", body="")
+        db.add_all([*voters, post])
+        await db.commit()
+
+    await asyncio.gather(*(vote_repeatedly(voter, post.id, rounds) for voter in voters))
+
+    async with AsyncSessionLocal() as db:
+        post = await db.get(Post, post.id)
+        counts = dict((await db.execute(
+            select(Vote.vote_type, func.count()).where(Vote.post_id == post.id).group_by(Vote.vote_type)
+        )).all())
+
+    expected_up, expected_down = counts.get(VoteType.UP, 0), counts.get(VoteType.DOWN, 0)
+    print(f"upvote_count: {post.upvote_count} (votes: {expected_up})")
+    print(f"downvote_count: {post.downvote_count} (votes: {expected_down})")
+    return post.upvote_count == expected_up and post.downvote_count == expected_down
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    exact = asyncio.run(main(args.users, args.rounds))
+    print("Counters are exact" if exact else "Counters do not match the votes")
+    sys.exit(0 if exact else 1)
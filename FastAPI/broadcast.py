@@ -0,0 +1,115 @@
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional, Set
+
+
+class SubscriptionClosed(Exception):
+    pass
+
+
+class Subscription:
+    # The channels one client (e.g. a WebSocket connection) is subscribed to, and the messages waiting to be sent to it.
+    # If the client does not keep up and too many messages are waiting, it is closed (so a slow client cannot use up
+    # the memory), and the client can connect again and fetch the current state.
+
+    def __init__(self, broadcaster: "Broadcaster", max_queued: int):
+        self.broadcaster = broadcaster
+        self.channels = set()
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.closed = False
+
+    def deliver(self, message: str) -> None:
+        if self.closed: return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.closed = True
+            # Waking up the client, which finds that the subscription is closed:
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        # The next message, or None if there was none within the timeout:
+        try:
+            message = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is None: raise SubscriptionClosed
+        return message
+
+    async def subscribe(self, channels: Iterable[str]) -> None:
+        channels = set(channels) - self.channels
+        self.channels |= channels
+        await self.broadcaster.subscribe(self, channels)
+
+    async def unsubscribe(self, channels: Iterable[str]) -> None:
+        channels = set(channels) & self.channels
+        self.channels -= channels
+        await self.broadcaster.unsubscribe(self, channels)
+
+    async def close(self) -> None:
+        await self.unsubscribe(set(self.channels))
+        self.closed = True
+
+
+class Broadcaster(ABC):
+    # The interface of a publish/subscribe backend, which sends the messages published to a channel to every
+    # subscription to that channel.
+    # Only the in-process broadcaster below is provided, so realtime updates are only complete with a single worker
+    # process. With several workers, a client only receives the changes made by requests that were handled by the
+    # worker it is connected to.
+    # A broadcaster shared by the workers (e.g. implemented with Redis pub/sub) can be used instead by implementing
+    # these methods, with each worker delivering the messages it receives to its own subscriptions.
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        pass
+
+    @abstractmethod
+    async def subscribe(self, subscription: Subscription, channels: Set[str]) -> None:
+        pass
+
+    @abstractmethod
+    async def unsubscribe(self, subscription: Subscription, channels: Set[str]) -> None:
+        pass
+
+    def may_have_subscribers(self, channel: str) -> bool:
+        # Used to skip preparing messages that nobody would receive. Shared backends cannot tell, so always return True:
+        return True
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBroadcaster(Broadcaster):
+    # Delivers messages to the subscriptions of this process.
+
+    def __init__(self):
+        # The subscriptions to each channel:
+        self.subscribers = {}
+        self.published = 0
+        self.delivered = 0
+
+    async def publish(self, channel: str, message: str) -> None:
+        self.published += 1
+        for subscription in list(self.subscribers.get(channel, ())):
+            subscription.deliver(message)
+            self.delivered += 1
+
+    async def subscribe(self, subscription: Subscription, channels: Set[str]) -> None:
+        for channel in channels: self.subscribers.setdefault(channel, set()).add(subscription)
+
+    async def unsubscribe(self, subscription: Subscription, channels: Set[str]) -> None:
+        for channel in channels:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None: continue
+            subscribers.discard(subscription)
+            if not subscribers: del self.subscribers[channel]
+
+    def may_have_subscribers(self, channel: str) -> bool:
+        return channel in self.subscribers
+
+    def stats(self) -> dict:
+        subscriptions = {subscription for subscribers in self.subscribers.values() for subscription in subscribers}
+        return {"channels": len(self.subscribers), "subscriptions": len(subscriptions),
+                "published": self.published, "delivered": self.delivered}
@@ -0,0 +1,119 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from config import WORKERS, get_settings
+
+
+class CacheBackend(ABC):
+    # The interface of a cache storage backend.
+    # Only the in-process backend below is provided. When running several worker processes, each has its own
+    # copy of it, so invalidating an entry only affects the worker that made the change: the other workers keep
+    # serving the old entry until it expires, so their TTLs are capped (see worker_ttl).
+    # A backend shared by the workers (e.g. implemented with Redis) can be used instead by implementing these methods.
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        pass
+
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        # Shared backends should override this to fetch all the keys in one round trip:
+        return [await self.get(key) for key in keys]
+
+    @abstractmethod
+    async def set(self, key: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    async def clear(self, prefix: str = "") -> None:
+        # Removes every entry whose key starts with the prefix (e.g. so a benchmark measures requests that are not cached):
+        pass
+
+
+def worker_ttl(ttl: float) -> float:
+    # The TTL of an in-process cache. With several worker processes, changes are only invalidated in the worker that
+    # made them, so entries are kept for at most cache_max_staleness seconds (how long other workers can serve old data):
+    return min(ttl, get_settings().cache_max_staleness) if WORKERS > 1 else ttl
+
+
+class MemoryCacheBackend(CacheBackend):
+    # A cache in the memory of the process, holding at most max_size entries for at most ttl seconds each.
+    # When full, the least recently used entry is removed.
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Ordered from least to most recently used, with the expiry time stored with each value:
+        self.entries = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None: return None
+
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+    async def clear(self, prefix: str = "") -> None:
+        for key in [key for key in self.entries if key.startswith(prefix)]: del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class Cache:
+    # A cache for one kind of value, with its keys prefixed by the namespace (so that one shared backend
+    # can hold several caches), and counting hits and misses to show how effective it is.
+
+    def __init__(self, namespace: str, backend: CacheBackend):
+        self.namespace = namespace
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, key: Any) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: Any) -> Optional[Any]:
+        value = await self.backend.get(self.key(key))
+
+        if value is None: self.misses += 1
+        else: self.hits += 1
+        return value
+
+    async def get_many(self, keys: List[Any]) -> List[Optional[Any]]:
+        # Not counted as hits or misses:
+        return await self.backend.get_many([self.key(key) for key in keys])
+
+    async def set(self, key: Any, value: Any) -> None:
+        await self.backend.set(self.key(key), value)
+
+    async def delete(self, key: Any) -> None:
+        await self.backend.delete(self.key(key))
+
+    async def clear(self) -> None:
+        # Only removing this cache's entries, since the backend may be shared with other caches:
+        await self.backend.clear(self.key(""))
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requests if requests else None}
@@ -1,17 +1,147 @@
+import os
 import json
-from typing import Any
+import time
+import threading
+from typing import Any, Dict, List, Literal, Optional
 
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
-def read_config(key: str, path: str = "config.json") -> Any:
-    # 'r' means read-only:
-    with open(path, 'r') as file:
-        return json.load(file).get(key)
+
+# The number of worker processes serving the app (the variable read by uvicorn and gunicorn for the number of workers):
+WORKERS = int(os.getenv("WEB_CONCURRENCY") or 1)
+
+
+# The image types that uploads can be (the formats the renditions are created from, see image_processing.py).
+# Others, such as SVG, cannot be decoded by Pillow, so allowing them in the settings is a mistake:
+ImageMimeType = Literal["image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp"]
+
+
+class Settings(BaseModel):
+    # The settings in config.json, validated when the file is loaded (so a mistake is found straight away,
+    # rather than when the setting is used). Settings that are not in the file use the defaults below.
+    # Unknown settings are kept, so they can still be read with read_config.
+    model_config = ConfigDict(extra="allow", frozen=True)
+
+    # These are only read when the app starts:
+    cors_origins: List[str] = []
+    image_directory: str = "images"
+    # Where uploads are processed before they are moved to the image directory (on the same file system, not served):
+    upload_directory: str = "uploads"
+    # The caches are kept in the memory of each worker process, and changes are only invalidated in the worker that made
+    # them. With several workers (WEB_CONCURRENCY), the others serve the old values until they expire, so the TTLs are
+    # capped at cache_max_staleness seconds (see cache.py):
+    user_cache_ttl: float = Field(default=60, gt=0)
+    user_cache_size: int = Field(default=10_000, gt=0)
+    response_cache_ttl: float = Field(default=30, gt=0)
+    response_cache_size: int = Field(default=10_000, gt=0)
+    cache_max_staleness: float = Field(default=5, gt=0)
+    # The database connection pool of each worker process (see database.py).
+    # Connections kept open, and the extra connections that can be opened when they are all in use:
+    db_pool_size: int = Field(default=5, gt=0)
+    db_max_overflow: int = Field(default=10, ge=0)
+    # The longest a request waits for a connection when the pool is exhausted, in seconds:
+    db_pool_timeout: float = Field(default=30, gt=0)
+    # Connections older than this are replaced (before the database or a proxy closes them), in seconds (-1 turns it off):
+    db_pool_recycle: int = Field(default=1800, ge=-1)
+    # Whether connections are checked before use, so a connection closed by the database is replaced rather than failing a request:
+    db_pool_pre_ping: bool = True
+    # The maximum number of connections of all the worker processes together (e.g. the database's connection limit
+    # less those needed by other clients). If set, it is divided between the workers (WEB_CONCURRENCY):
+    db_max_connections: Optional[int] = Field(default=None, gt=0)
+    # The number of compiled SQL statements cached by SQLAlchemy, and of prepared statements cached per connection by
+    # asyncpg (0 turns them off, which is needed behind PgBouncer in transaction mode):
+    db_compiled_cache_size: int = Field(default=500, ge=0)
+    db_prepared_statement_cache_size: int = Field(default=100, ge=0)
+
+    # These are read whenever they are used, so changing them takes effect without a restart:
+    image_mime_types: List[ImageMimeType] = ["image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp"]
+    # The maximum dimension of the full size rendition of images:
+    compression_size: int = Field(default=1000, gt=0)
+    # The maximum dimension of the other renditions of images:
+    rendition_sizes: Dict[str, int] = {"thumbnail": 150, "feed": 600}
+    # Images with more pixels than this are rejected before they are decoded (about 8000x5000):
+    max_image_pixels: int = Field(default=40_000_000, gt=0)
+    # The maximum size of an uploaded image in bytes:
+    max_upload_size: int = Field(default=10 * 1024 * 1024, gt=0)
+    # Whether posts are serialized straight from the database objects, rather than validated by the response model
+    # (see serializers.py):
+    fast_serialization: bool = True
+    # The shortest time between messages with the vote counts of a post, in seconds (see realtime.py):
+    realtime_vote_interval: float = Field(default=1.0, gt=0)
+    # The most realtime connections (WebSockets and event streams) each worker process keeps open at a time:
+    realtime_max_connections: int = Field(default=1000, gt=0)
+
+
+class ConfigFile:
+    # Holds the settings parsed from a JSON file, reloading them when the file is modified.
+    # Rather than checking the file whenever a setting is read, it is checked at most once every check_interval seconds.
+    # A new Settings object replaces the old one in a single assignment, so a reader never sees a partially loaded file.
+    # If the modified file is invalid, the previous settings are kept.
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+
+        self.modified = self.file_modified()
+        self.checked_at = time.monotonic()
+        self._settings = self.load()
+
+    def file_modified(self) -> tuple:
+        file_stat = os.stat(self.path)
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def load(self) -> Settings:
+        # 'r' means read-only:
+        with open(self.path, 'r') as file:
+            return Settings(**json.load(file))
+
+    def reload_if_modified(self) -> None:
+        # Only one thread checks at a time, the others carry on using the current settings:
+        if not self.lock.acquire(blocking=False): return
+        try:
+            self.checked_at = time.monotonic()
+            modified = self.file_modified()
+            if modified == self.modified: return
+
+            # Recording the modification first, so an invalid file is only reported once (rather than on every check):
+            self.modified = modified
+            self._settings = self.load()
+            print(f"Reloaded {self.path}")
+
+        except (OSError, ValueError, ValidationError) as e:
+            # e.g. the file is being written, or has a mistake in it:
+            print(f"Failed to reload {self.path}, keeping the previous settings: {e}")
+
+        finally:
+            self.lock.release()
+
+    @property
+    def settings(self) -> Settings:
+        if time.monotonic() - self.checked_at >= self.check_interval: self.reload_if_modified()
+        return self._settings
+
+
+config_file = ConfigFile("config.json")
+
+
+def get_settings() -> Settings:
+    # Returns the current settings. The returned object does not change, so a request that needs several settings
+    # should read them from the same object to get a consistent set:
+    return config_file.settings
+
+
+def read_config(key: str) -> Any:
+    return getattr(get_settings(), key, None)
 
 
 def write_config(key: str, value: Any, path: str = "config.json") -> None:
-    with open(path, 'r+') as file:
+    with open(path, 'r') as file:
         config = json.load(file)
-        config[key] = value
-        file.seek(0)
+    config[key] = value
+
+    # Writing to a temporary file and renaming it, so the file is never partially written when it is reloaded:
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as file:
         json.dump(config, file, indent=4)
-        file.truncate()
+    os.replace(temp_path, path)
@@ -1,7 +1,18 @@
 # SQLAlchemy allows us to interact with databases using an OOP approach,
 # providing object-relational mapping (ORM) that allows us to define Python classes
 # (called models) that map to database tables.
-from sqlalchemy import create_engine
+import math
+import time
+import sqlite3
+from bisect import bisect_left
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# The asyncio extension provides an async version of the engine and session,
+# so that database round trips can be awaited instead of blocking the event loop:
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 # Session maker is a class that is used to create session objects for database interactions.
 # These represent a connection to the database and provide a way to interact with the database.
@@ -11,11 +22,89 @@ from sqlalchemy.orm import sessionmaker
 # The data models will inherit from this class.
 from sqlalchemy.ext.declarative import declarative_base
 
-# TODO: Use AsyncSession, make DB functions async, and await when calling
 import os
+from config import WORKERS, get_settings
+from metrics import LatencyStats
+
 DB_URI = os.getenv("DB_URI")
 
 
+# The async drivers that replace the default (blocking) driver for each database:
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+def to_async_uri(uri: str) -> str:
+    # Swapping the driver in the URI for its async equivalent,
+    # e.g. postgresql://... becomes postgresql+asyncpg://...
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}'")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+
+# The async URI can be provided explicitly, otherwise it is derived from DB_URI:
+ASYNC_DB_URI = os.getenv("ASYNC_DB_URI") or to_async_uri(DB_URI)
+
+
+def pool_options(settings, workers: int = WORKERS) -> dict:
+    # The pool settings for each worker process. If the connections of all the workers are limited, each worker
+    # gets an equal share, which is used for the pool first, and then for the overflow:
+    pool_size, max_overflow = settings.db_pool_size, settings.db_max_overflow
+    if settings.db_max_connections:
+        per_worker = max(1, settings.db_max_connections // workers)
+        pool_size = min(pool_size, per_worker)
+        max_overflow = min(max_overflow, per_worker - pool_size)
+
+    return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": settings.db_pool_timeout,
+            "pool_recycle": settings.db_pool_recycle, "pool_pre_ping": settings.db_pool_pre_ping}
+
+
+class PoolMetrics:
+    # How long requests wait to get a connection from the pool, and how often connections are opened and invalidated.
+    # A long wait means the pool is too small for the traffic (or connections are held for too long).
+
+    # The upper bounds of the wait time histogram, in seconds (the last bucket counts the longer waits):
+    WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+    def __init__(self):
+        self.wait = LatencyStats()
+        self.histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        # Functions called with each wait, e.g. to add it to the request's totals (see query_monitor.py):
+        self.wait_listeners = []
+
+    def record_wait(self, wait: float) -> None:
+        self.wait.record(wait)
+        self.histogram[bisect_left(self.WAIT_BUCKETS, wait)] += 1
+        for listener in self.wait_listeners: listener(wait)
+
+    def summary(self) -> dict:
+        labels = [f"<={bound * 1000:g}ms" for bound in self.WAIT_BUCKETS] + [f">{self.WAIT_BUCKETS[-1] * 1000:g}ms"]
+        return {"wait": self.wait.summary(), "wait_histogram": dict(zip(labels, self.histogram)),
+                "timeouts": self.timeouts, "connects": self.connects, "invalidations": self.invalidations}
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # The default pool of the async engine, timing how long each connection takes to get
+    # (including opening a new connection, if the pool has none available):
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started_at)
+
+
 # A database engine is a way of connecting the database.
 # The function creates an instance of the Engine class, which acts as an intermediary between the Python code
 # and the database, handling tasks such as connection management, SQL execution and result fetching.
@@ -23,14 +112,71 @@ DB_URI = os.getenv("DB_URI")
 # taking in the URL of the database within the application as well as "connection arguments" kwargs
 # which specify additional requirements that should be passed to the underlying database connection.
 
+# The sync engine is kept for schema creation, scripts and tests:
 engine = create_engine(DB_URI)
 
+# The async engine is used by the API, so that a worker can serve other requests while waiting on the database.
+# Its pool is configured in config.json (only read when the app starts).
+# SQLite keeps its default of opening a connection for each session (which only opens a file), since there is no server
+# to connect to, and pooled aiosqlite connections each keep a thread running until the engine is disposed:
+settings = get_settings()
+async_url = make_url(ASYNC_DB_URI)
+pool_arguments = {} if async_url.get_backend_name() == "sqlite" else {"poolclass": TimedQueuePool, **pool_options(settings)}
+
+# asyncpg caches prepared statements on each connection:
+connect_args = {"prepared_statement_cache_size": settings.db_prepared_statement_cache_size} if async_url.get_driver_name() == "asyncpg" else {}
+
+async_engine = create_async_engine(ASYNC_DB_URI, query_cache_size=settings.db_compiled_cache_size,
+                                   connect_args=connect_args, **pool_arguments)
+
+
+# Counting the connections opened and invalidated (e.g. closed by the database, or failing the pre-ping):
+@event.listens_for(async_engine.sync_engine.pool, "connect")
+def count_connect(dbapi_connection, connection_record):
+    pool_metrics.connects += 1
+
+
+@event.listens_for(async_engine.sync_engine.pool, "invalidate")
+@event.listens_for(async_engine.sync_engine.pool, "soft_invalidate")
+def count_invalidation(dbapi_connection, connection_record, exception):
+    pool_metrics.invalidations += 1
+
+
+def sqlite_has_math_functions() -> bool:
+    # SQLite only has log10 and power (used for the post scores, see ranking.py) if it was compiled with its math functions:
+    try:
+        sqlite3.connect(":memory:").execute("SELECT log10(1), power(1, 1)")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+if async_url.get_backend_name() == "sqlite" and not sqlite_has_math_functions():
+    # Adding the functions to each connection instead:
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def add_math_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function("log10", 1, math.log10, deterministic=True)
+        dbapi_connection.create_function("power", 2, math.pow, deterministic=True)
+
+
+def pool_status() -> dict:
+    # The current state of the async engine's pool, along with its metrics:
+    pool = async_engine.sync_engine.pool
+    status = {"class": type(pool).__name__, **pool_metrics.summary()}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        status.update({"size": pool.size(), "checked_out": pool.checkedout(), "checked_in": pool.checkedin(),
+                       "overflow": max(0, pool.overflow()), "max_overflow": pool._max_overflow, "timeout": pool.timeout()})
+    return status
+
 # Creating a custom session class bound to the engine.
 # auto commit = False means that the database will not automatically commit changes, manual commits are required.
 # auto flush = False means that the session's changes to the database won't be synchronised automatically
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The async session class used by the get_db dependency.
+# expire_on_commit = False means that objects can still be read after a commit without another (implicit) query,
+# since implicit I/O is not possible when using AsyncSession:
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # Calling the declarative base function will return a new base class from which all data models inherit.
 Base = declarative_base()
-
-
@@ -3,11 +3,13 @@ from typing import Annotated, Optional
 from fastapi import Depends, status as st
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt, JWTError
 
-from database import SessionLocal
+from database import SessionLocal, AsyncSessionLocal
 from models import User
 from security import HASH_SECRET_KEY, HASH_ALGORITHM
+from services.user_cache import get_cached_user
 from enums import Role
 from exceptions import JWTDecodeError, InvalidCredentialsError, UserNotFoundError
 
@@ -27,13 +29,25 @@ from exceptions import JWTDecodeError, InvalidCredentialsError, UserNotFoundErro
 # In this case, it is being used to keep the database connection open
 # until the function that calls get_db completes after which the database can be closed.
 
-def get_db():
-    # Using the custom session class to connect to the database.
+async def get_db():
+    # Using the custom async session class to connect to the database.
     # db represents a database connection.
+    # Using "async with" so that the session is closed (and the connection released) once the request is complete:
+    async with AsyncSessionLocal() as db:
+        try:
+            # Returning the database connection that we just created.
+            # Doing this using the "yield" keyword means that the database will not be closed too early.
+            yield db
+
+        except Exception:
+            await db.rollback()
+            raise
+
+
+# The sync equivalent of get_db, for scripts and tests that do not run inside the event loop:
+def get_sync_db():
     db = SessionLocal()
     try:
-        # Returning the database connection that we just created.
-        # Doing this using the "yield" keyword means that the database will not be closed too early.
         yield db
     
     except Exception:
@@ -56,8 +70,9 @@ def get_db():
 # In this case, we are indicating that the database Session object is a dependency that should be injected into the
 # function.
 
-# Session, imported from SQLAlchemy is the type of the dependency - a database session.
-db_dependency = Annotated[Session, Depends(get_db)]
+# AsyncSession, imported from SQLAlchemy is the type of the dependency - a database session whose queries are awaited.
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+sync_db_dependency = Annotated[Session, Depends(get_sync_db)]
 
 # For the authentication dependency, the OAuth2PasswordRequestForm class must be instantiated:
 auth_dependency = Annotated[OAuth2PasswordRequestForm, Depends(OAuth2PasswordRequestForm)]
@@ -80,11 +95,12 @@ async def get_current_user(db: db_dependency, token: token_dependency) -> User:
         raise JWTDecodeError() from e
     if user_id is None:
         raise InvalidCredentialsError
-    return get_user(user_id, db)
+    return await get_user(user_id, db)
 
 
-def get_user(user_id, db: db_dependency) -> User:
-    user = db.query(User).filter_by(id=user_id).first()
+async def get_user(user_id, db: db_dependency) -> User:
+    # The user is usually cached, so most authenticated requests do not need to select it:
+    user = await get_cached_user(db, user_id)
     if user is None:
         raise UserNotFoundError
     return user
@@ -109,9 +125,9 @@ def verify_admin_status(user) -> None:
         raise InvalidCredentialsError
 
 
-async def get_current_admin(token: token_dependency) -> User:
+async def get_current_admin(db: db_dependency, token: token_dependency) -> User:
     # Need to use await, since it is an async function:
-    user = await get_current_user(token)
+    user = await get_current_user(db, token)
     verify_admin_status(user)
     return user
 
@@ -9,6 +9,8 @@ class Role(str, Enum):
 class Order(str, Enum):
     POPULARITY = "popularity"
     DATE = "date"
+    HOT = "hot"
+    CONTROVERSIAL = "controversial"
 
 
 class VoteType(str, Enum):
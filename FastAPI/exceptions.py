@@ -48,4 +48,31 @@ class ImageNotFoundError(HTTPException):
 
 class UserAlreadyExistsError(HTTPException):
     def __init__(self):
-        super().__init__(status_code=st.HTTP_409_CONFLICT, detail="Email already in use. Please log in")
\ No newline at end of file
+        super().__init__(status_code=st.HTTP_409_CONFLICT, detail="Email already in use. Please log in")
+
+class InvalidCursorError(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=st.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+class FileTooLargeError(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=st.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File too large")
+
+
+class ServiceBusyError(HTTPException):
+    def __init__(self, retry_after: int = 1):
+        # Retry-After tells the client how many seconds to wait before trying again:
+        super().__init__(status_code=st.HTTP_503_SERVICE_UNAVAILABLE, detail="Server busy, please try again shortly",
+                         headers={"Retry-After": str(retry_after)})
+
+
+class TooManySubscriptionsError(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=st.HTTP_400_BAD_REQUEST, detail="Too many posts subscribed to")
+
+
+class TooManyConnectionsError(HTTPException):
+    def __init__(self, retry_after: int = 5):
+        super().__init__(status_code=st.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many connections, please try again shortly",
+                         headers={"Retry-After": str(retry_after)})
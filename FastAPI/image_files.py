@@ -0,0 +1,215 @@
+import os
+import stat
+import mimetypes
+from email.utils import formatdate
+from typing import List, Optional, Tuple
+
+import aiofiles
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import Receive, Scope, Send
+
+
+# Image files never change once they are at a URL (they are named after their content, see image_service.py),
+# so clients and CDNs can cache them for a year without revalidating:
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# The formats that an image can be served as instead of the one requested, from most to least preferred.
+# A variant is only served if a file for it exists next to the requested file, and the client accepts it:
+NEGOTIATED_FORMATS = [("image/avif", ".avif"), ("image/webp", ".webp")]
+
+# The suffix of the renditions of the full size image (see image_processing.py), e.g. <hash>_full.webp for <hash>.jpeg:
+FULL_SIZE_SUFFIX = "_full"
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def accepted_types(accept: str) -> set:
+    # The media types that the client accepts (with a non-zero quality), e.g. "image/avif,image/webp,*/*;q=0.8":
+    types = set()
+    for media_range in accept.split(","):
+        media_type, *parameters = [part.strip() for part in media_range.split(";")]
+        quality = next((parameter[2:] for parameter in parameters if parameter.startswith("q=")), "1")
+        try:
+            if float(quality) > 0: types.add(media_type.lower())
+        except ValueError:
+            continue
+    return types
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    # Returns the (start, end) of a single byte range (inclusive), or None if the header should be ignored.
+    # Raises ValueError if the range cannot be satisfied.
+    unit, _, ranges = range_header.partition("=")
+
+    # Only single ranges are supported. Servers may ignore the header otherwise, responding with the whole file:
+    if unit.strip().lower() != "bytes" or "," in ranges: return None
+
+    start, _, end = ranges.strip().partition("-")
+    if not (start or end) or (start and not start.isdigit()) or (end and not end.isdigit()): return None
+
+    if not start:
+        # A suffix range, e.g. "bytes=-500" is the last 500 bytes:
+        if int(end) == 0 or size == 0: raise ValueError
+        return max(size - int(end), 0), size - 1
+
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end: raise ValueError
+    return start, end
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    # If-None-Match uses weak comparison, so a W/ prefix is ignored:
+    if if_none_match.strip() == "*": return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class ImageFiles:
+    # Serves the image directory (replacing StaticFiles), with headers that let clients and CDNs cache images for as long
+    # as possible, conditional requests (ETag / If-None-Match), byte ranges and content negotiation to WebP and AVIF.
+
+    def __init__(self, directory: str):
+        self.directory = os.path.realpath(directory)
+
+    def file_path(self, scope: Scope) -> Optional[str]:
+        # The path of the file in the directory, or None if the path is outside of the directory.
+        # The path of the mount is in the root path, so is removed from the request path:
+        route_path = scope["path"].removeprefix(scope.get("root_path", ""))
+        path = os.path.realpath(os.path.join(self.directory, route_path.lstrip("/")))
+        if os.path.commonpath([path, self.directory]) != self.directory: return None
+        return path
+
+    def variant_paths(self, path: str) -> List[Tuple[str, str]]:
+        # The possible (media type, path) of the variants of a file in other formats, in order of preference.
+        # e.g. images/ab/cd/<hash>.jpeg -> images/ab/cd/<hash>_full.avif, images/ab/cd/<hash>_full.webp
+        #      images/ab/cd/<hash>_thumbnail.jpeg -> images/ab/cd/<hash>_thumbnail.avif, ...
+        stem, extension = os.path.splitext(path)
+        if extension.lower() in (variant_extension for _, variant_extension in NEGOTIATED_FORMATS): return []
+
+        # Renditions are named <hash>_<size>, whereas the full size image is just <hash>:
+        variant_stem = stem if "_" in os.path.basename(stem) else stem + FULL_SIZE_SUFFIX
+        return [(media_type, variant_stem + variant_extension) for media_type, variant_extension in NEGOTIATED_FORMATS]
+
+    @staticmethod
+    def stat_file(path: str) -> Optional[os.stat_result]:
+        try:
+            stat_result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return stat_result if stat.S_ISREG(stat_result.st_mode) else None
+
+    def select_file(self, path: str, accept: str) -> Tuple[Optional[str], Optional[os.stat_result], bool]:
+        # Returns the file to serve, its stat result, and whether the response depends on the Accept header.
+        # Ran in a thread, since checking files blocks:
+        variants = self.variant_paths(path)
+        if variants:
+            accepted = accepted_types(accept)
+            for media_type, variant_path in variants:
+                if media_type not in accepted: continue
+                stat_result = self.stat_file(variant_path)
+                if stat_result is not None: return variant_path, stat_result, True
+
+        return path, self.stat_file(path), bool(variants)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "http"
+
+        if scope["method"] not in ("GET", "HEAD"):
+            response = JSONResponse({"detail": "Method Not Allowed"}, status_code=405, headers={"Allow": "GET, HEAD"})
+            await response(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        path = self.file_path(scope)
+        stat_result = None
+        if path is not None:
+            path, stat_result, negotiated = await anyio.to_thread.run_sync(
+                self.select_file, path, request_headers.get("accept", "")
+            )
+
+        if stat_result is None:
+            await JSONResponse({"detail": "Not Found"}, status_code=404)(scope, receive, send)
+            return
+
+        size = stat_result.st_size
+
+        # A strong ETag, since the name of a file identifies its content (and the variants have different names):
+        etag = f'"{os.path.basename(path)}-{size:x}"'
+        headers = {
+            "cache-control": IMAGE_CACHE_CONTROL,
+            "etag": etag,
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "accept-ranges": "bytes",
+        }
+        # Caches must store a separate copy for each format:
+        if negotiated: headers["vary"] = "Accept"
+
+        # The client already has the file:
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None and etag_matches(etag, if_none_match):
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+
+        headers["content-type"] = self.media_type(path)
+        start, end, status_code = 0, size - 1, 200
+
+        # Byte ranges (e.g. resuming a download). If-Range only allows the range if the file has not changed:
+        range_header = request_headers.get("range")
+        if range_header is not None and request_headers.get("if-range", etag) == etag:
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                await Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})(scope, receive, send)
+                return
+
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = 206
+                headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+        headers["content-length"] = str(end - start + 1)
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+        })
+
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            await self.send_file(scope, send, path, start, end - start + 1, status_code == 200)
+
+    @staticmethod
+    def media_type(path: str) -> str:
+        extension = os.path.splitext(path)[1].lower()
+        for media_type, variant_extension in NEGOTIATED_FORMATS:
+            if extension == variant_extension: return media_type
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    @staticmethod
+    async def send_file(scope: Scope, send: Send, path: str, offset: int, count: int, whole_file: bool) -> None:
+        extensions = scope.get("extensions") or {}
+
+        # Where the server supports it, the file is sent by the kernel (sendfile), without being copied through Python:
+        if "http.response.zerocopysend" in extensions:
+            with open(path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file.fileno(), "offset": offset, "count": count,
+                            "more_body": False})
+            return
+
+        if whole_file and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": path})
+            return
+
+        # Otherwise (e.g. uvicorn), reading the file a chunk at a time:
+        async with aiofiles.open(path, "rb") as file:
+            await file.seek(offset)
+            remaining = count
+            more_body = True
+            while more_body:
+                chunk = await file.read(min(FILE_CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                # Also stopping if the file is shorter than expected (i.e. it changed while being sent):
+                more_body = remaining > 0 and len(chunk) > 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import Counter
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from metrics import LatencyStats
+
+
+# Everything is handled by one thread (the event loop), so while one request runs blocking code
+# (e.g. hashing, image processing or a synchronous database call), every other request has to wait.
+# The monitor measures how long the loop is blocked for, and records which route and which code was blocking it.
+# It is opt-in, enabled by setting LOOP_MONITOR_THRESHOLD_MS to the shortest block worth recording (e.g. 50):
+LOOP_MONITOR_THRESHOLD_MS = os.getenv("LOOP_MONITOR_THRESHOLD_MS")
+
+# The number of frames kept from the top of each stack sample, and the number of different stacks kept for each route:
+STACK_DEPTH = 12
+STACKS_PER_ROUTE = 5
+
+
+class RouteLag:
+    def __init__(self):
+        self.blocked = LatencyStats()
+        self.stacks = Counter()
+
+    def summary(self) -> dict:
+        return {
+            **self.blocked.summary(),
+            "total_ms": self.blocked.total * 1000,
+            "stacks": [{"count": count, "stack": list(stack)} for stack, count in self.stacks.most_common()],
+        }
+
+
+class LoopMonitor:
+    # A task on the event loop wakes up every interval seconds. If it wakes up late by more than the threshold,
+    # something blocked the loop. Meanwhile, a separate thread notices when the task has not woken up in time, and
+    # samples the stack of the event loop thread (showing the blocking code) along with the route of the request
+    # being handled.
+
+    def __init__(self, threshold: float, interval: float = 0.01):
+        self.threshold = threshold
+        self.interval = interval
+
+        self.routes = {}
+        # The scope of the request that each task is handling (so a sample can be attributed to a route):
+        self.task_scopes = {}
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+
+        # The sample taken while the loop is blocked, which is recorded once the loop is unblocked:
+        self.sample = None
+        self.lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self.loop is not None
+
+    def start(self) -> None:
+        # Must be called from the event loop:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+
+        self.heartbeat_task = self.loop.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-monitor", daemon=True).start()
+
+    async def heartbeat(self) -> None:
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            lag = time.monotonic() - self.last_beat - self.interval
+            if lag >= self.threshold: self.record(lag)
+
+    def watch(self) -> None:
+        # Runs in its own thread, so it keeps running while the loop is blocked:
+        while True:
+            time.sleep(self.threshold / 2)
+            if time.monotonic() - self.last_beat < self.threshold + self.interval: continue
+
+            with self.lock:
+                # Only taking one sample for each time the loop is blocked:
+                if self.sample is None: self.sample = (self.current_route(), self.loop_stack())
+
+    def current_route(self) -> str:
+        task = asyncio.current_task(self.loop)
+        scope = self.task_scopes.get(task)
+        if scope is None: return f"(task {task.get_name()})" if task is not None else "(no task)"
+
+        # FastAPI adds the matched route to the scope, giving e.g. "GET /post/{post_id}" rather than "GET /post/5":
+        route = scope.get("route")
+        return f"{scope['method']} {getattr(route, 'path', None) or scope['path']}"
+
+    def loop_stack(self) -> Optional[tuple]:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None: return None
+        return tuple(f"{entry.filename}:{entry.lineno} in {entry.name}" for entry in traceback.extract_stack(frame)[-STACK_DEPTH:])
+
+    def record(self, lag: float) -> None:
+        with self.lock:
+            sample, self.sample = self.sample, None
+        # Blocks just over the threshold can end before the thread has taken a sample:
+        route, stack = sample or ("(not sampled)", None)
+
+        route_lag = self.routes.setdefault(route, RouteLag())
+        route_lag.blocked.record(lag)
+        if stack is not None:
+            route_lag.stacks[stack] += 1
+            # Keeping the most common stacks only:
+            if len(route_lag.stacks) > STACKS_PER_ROUTE * 2:
+                route_lag.stacks = Counter(dict(route_lag.stacks.most_common(STACKS_PER_ROUTE)))
+
+        print(f"Event loop blocked for {lag * 1000:.0f}ms by {route}" + (", at:\n  " + "\n  ".join(stack) if stack else ""))
+
+    def summary(self) -> dict:
+        # The routes that blocked the loop for the longest in total come first (these are the ones to fix first):
+        routes = sorted(self.routes.items(), key=lambda item: item[1].blocked.total, reverse=True)
+        return {"enabled": True, "threshold_ms": self.threshold * 1000,
+                "routes": {route: route_lag.summary() for route, route_lag in routes}}
+
+
+loop_monitor = LoopMonitor(float(LOOP_MONITOR_THRESHOLD_MS) / 1000) if LOOP_MONITOR_THRESHOLD_MS else None
+
+
+class LoopMonitorMiddleware:
+    # Starts the loop monitor with the first request, and records which request each task is handling.
+
+    def __init__(self, app: ASGIApp, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if not self.monitor.started: self.monitor.start()
+
+        task = asyncio.current_task()
+        self.monitor.task_scopes[task] = scope
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.monitor.task_scopes.pop(task, None)
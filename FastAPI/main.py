@@ -1,63 +1,155 @@
 import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
+from sqlalchemy import text
 from dotenv import load_dotenv
 
 
 # Loading environment variables before local imports:
 load_dotenv()
 
-# Declaring FastAPI instance before local imports to avoid circular imports:
-app = FastAPI()
+# Importing the modules only defines things (the routers, the models and the engines), so that starting a worker
+# process is quick: nothing connects to the database or touches the file system until the app starts (see lifespan).
+# The routers share the limiter from rate_limit.py, rather than importing the app, so the app can be created by a factory.
+from rate_limit import limiter
+from services import image_service as imgs
+from services.file_cleanup import file_cleanup
+from routers import admin, auth, posts, realtime, users
+from config import WORKERS, get_settings
+from database import async_engine
+from middleware import UploadSizeLimitMiddleware
+from image_files import ImageFiles
+from loop_monitor import loop_monitor, LoopMonitorMiddleware
+from query_monitor import QUERY_MONITOR, query_monitor, QueryMonitorMiddleware
+from security import bcrypt_context, hash_executor
+from services.realtime import vote_updates
+import models
 
-# Rate limiting with SlowAPI:
-# key_func kwarg takes in a function that returns a unique key for the client (here we are using a function to get the IP address):
-# default_limits apply to all endpoints unless overridden by a decorator.
+# Creating the tables on every start costs a round trip per table, so it is only done when asked for
+# (e.g. CREATE_SCHEMA=true for a new development database), since existing databases are changed with migrations:
+CREATE_SCHEMA = (os.getenv("CREATE_SCHEMA") or "").lower() in ("1", "true", "yes")
 
-# Turning off rate limits for testing, 
-# FIXME: TURN RATE LIMITS BACK ON
-limiter = Limiter(key_func=get_remote_address, default_limits=["10/second"])
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# The number of database connections opened when the app starts, so the first requests do not wait for them:
+DB_WARM_CONNECTIONS = int(os.getenv("DB_WARM_CONNECTIONS") or 1)
 
-from services import image_service as imgs
-from routers import auth, posts, users
-from config import read_config
-from database import engine
-import models
+# The longest the app waits for the queued image files to be deleted when it shuts down:
+SHUTDOWN_TIMEOUT = 10
+
+
+async def create_schema() -> None:
+    # Creating all the tables represented by the models (only the ones that don't already exist):
+    async with async_engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+
+
+async def warm_up_database(connections: int) -> None:
+    # Opening the connections at the same time, then returning them to the pool (where they stay open):
+    async def connect():
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(connect() for _ in range(connections)))
+
+
+async def warm_up_hashing() -> None:
+    # The bcrypt backend is loaded (and checked for known bugs) the first time a password is hashed, which would otherwise
+    # slow down the first login. Loading it on a hashing thread also starts the thread.
+    # (Hashing a dummy password would take as long as a login, for no benefit.)
+    await asyncio.get_running_loop().run_in_executor(hash_executor, bcrypt_context.handler().get_backend)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    timings = {}
+    started_at = time.perf_counter()
+
+    # Creating the static images folder (and the folder for uploads), but not raising an error if they already exist:
+    os.makedirs(imgs.IMAGE_DIRECTORY, exist_ok=True)
+    os.makedirs(imgs.UPLOAD_DIRECTORY, exist_ok=True)
+
+    if app.state.create_schema:
+        await create_schema()
+        timings["schema"] = time.perf_counter() - started_at
+
+    warm_up_started_at = time.perf_counter()
+    await asyncio.gather(warm_up_database(DB_WARM_CONNECTIONS), warm_up_hashing())
+    timings["warm_up"] = time.perf_counter() - warm_up_started_at
+
+    timings["total"] = time.perf_counter() - started_at
+    app.state.startup_timings = timings
+    print(f"Started in {timings['total'] * 1000:.0f}ms ({', '.join(f'{name}: {seconds * 1000:.0f}ms' for name, seconds in timings.items() if name != 'total')})")
+    # Only in-process realtime updates are implemented (see broadcast.py):
+    if WORKERS > 1: print(f"Running {WORKERS} workers: realtime updates only reach the clients of the worker that made the change")
+
+    yield
+
+    vote_updates.cancel()
+
+    # Finishing the work that was handed off to the background, then closing the pools:
+    try:
+        await asyncio.wait_for(file_cleanup.join(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Shutting down with {file_cleanup.pending} image files left to delete")
+
+    imgs.shutdown_image_pool()
+    await async_engine.dispose()
+
+
+def create_app(create_schema: bool = None) -> FastAPI:
+    # Creates the application. Used with "uvicorn main:create_app --factory", or through the app instance below.
+    # Responses are encoded with orjson, which is several times faster than the standard json module:
+    app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+    app.state.create_schema = CREATE_SCHEMA if create_schema is None else create_schema
+
+    # Rate limiting with SlowAPI (see rate_limit.py):
+    app.state.limiter = limiter
+    app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+    # Stating that the auth.py file is a sub-application of the main application:
+    # Need to do this for each router that we want to use in the application:
+    app.include_router(auth.router)
+    app.include_router(users.router)
+    app.include_router(posts.router)
+    app.include_router(admin.router)
+    app.include_router(realtime.router)
+
+    # Rejecting uploads that are larger than the maximum image size (with some allowance for the rest of the form):
+    app.add_middleware(UploadSizeLimitMiddleware, max_body_size=lambda: get_settings().max_upload_size + 64 * 1024)
+
+    # Mounting the static post_images folder.
+    # Rather than StaticFiles, ImageFiles adds long-lived caching headers, ETags, byte ranges and WebP/AVIF negotiation:
+    app.mount(f"/{imgs.IMAGE_DIRECTORY}", ImageFiles(directory=imgs.IMAGE_DIRECTORY), name=imgs.IMAGE_DIRECTORY)
 
-# Creating all the tables represented by the models using the engine.
-# The database URL was used when creating the engine.
-# This will only be run if the database doesn't already exist.
-models.Base.metadata.create_all(bind=engine)
+    # Cross-Origin Resource Sharing is a browser security feature, preventing malicious websites from accessing 
+    # data from another domain without permission. If we want our API to be accessible from web applications hosted
+    # on different domains, we need to add the domains that are permitted.
+    origins = get_settings().cors_origins
 
-# Stating that the auth.py file is a sub-application of the main application:
-# Need to do this for each router that we want to use in the application:
-app.include_router(auth.router)
-app.include_router(users.router)
-app.include_router(posts.router)
+    # allow_credentials means authentication is allowed:
+    # '*' indicates all HTTP methods and headers are allowed:
+    # expose_headers lists the response headers that browser clients are allowed to read (used for pagination cursors):
+    app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, 
+                       allow_methods=['*'], allow_headers=['*'], expose_headers=['X-Next-Cursor'])
 
-# Creating the static images folder, but not raising an error if it already exists:
-os.makedirs(imgs.IMAGE_DIRECTORY, exist_ok=True)
+    # Counting the database queries of each request, and reporting slow queries and N+1 patterns
+    # (only if enabled with QUERY_MONITOR, see query_monitor.py):
+    if QUERY_MONITOR: app.add_middleware(QueryMonitorMiddleware, monitor=query_monitor)
 
-# Mounting the static post_images folder:
-app.mount(f"/{imgs.IMAGE_DIRECTORY}", StaticFiles(directory=imgs.IMAGE_DIRECTORY), name=imgs.IMAGE_DIRECTORY)
+    # Recording the routes that block the event loop (only if enabled with LOOP_MONITOR_THRESHOLD_MS, see loop_monitor.py):
+    if loop_monitor is not None: app.add_middleware(LoopMonitorMiddleware, monitor=loop_monitor)
 
+    return app
 
-# Cross-Origin Resource Sharing is a browser security feature, preventing malicious websites from accessing 
-# data from another domain without permission. If we want our API to be accessible from web applications hosted
-# on different domains, we need to add the domains that are permitted.
-origins = read_config("cors_origins")
 
-# allow_credentials means authentication is allowed:
-# '*' indicates all HTTP methods and headers are allowed:
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, 
-                   allow_methods=['*'], allow_headers=['*'])
+# The app used by "uvicorn main:app" (creating it does not connect to the database or start any tasks):
+app = create_app()
 
 
 # Alembic is a lightweight database migration tool for SQLAlchemy (version control for DB schema).
@@ -76,6 +168,8 @@ app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True
 cd FastAPI
 source venv/bin/activate
 uvicorn main:app --reload
+(for a new database, create the tables when starting: CREATE_SCHEMA=true uvicorn main:app --reload)
+(for a database created by an earlier version, fill in the new columns first: python backfill.py)
 
 
 2) Run the Postman Collection (on a new terminal):
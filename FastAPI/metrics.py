@@ -0,0 +1,33 @@
+from collections import deque
+
+
+class LatencyStats:
+    # Summarises a series of durations (in seconds): the count and mean of all of them,
+    # and percentiles of the most recent ones (so that old measurements do not hide a recent slowdown).
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        self.recent.append(duration)
+
+    def percentile(self, percent: float) -> float:
+        if not self.recent: return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def summary(self) -> dict:
+        # In milliseconds, since that is easier to read:
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.maximum * 1000,
+        }
@@ -0,0 +1,51 @@
+from typing import Callable
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from exceptions import FileTooLargeError
+
+
+class UploadSizeLimitMiddleware:
+    # Limits the size of file upload (multipart) request bodies.
+    # Requests whose Content-Length is too large are rejected before any of the body is read,
+    # and other uploads (e.g. chunked, without a Content-Length) are stopped as soon as the limit is exceeded.
+
+    def __init__(self, app: ASGIApp, max_body_size: Callable[[], int]):
+        self.app = app
+        # A function returning the limit, so that it is read from the current settings for each request:
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        max_body_size = self.max_body_size()
+        content_length = headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body_size:
+            error = FileTooLargeError()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                # Raised while the body is being parsed, so it is returned as a 413 response by the exception handlers:
+                if received > max_body_size: raise FileTooLargeError()
+
+            return message
+
+        await self.app(scope, limited_receive, send)
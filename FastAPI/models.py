@@ -1,14 +1,22 @@
 import os
 
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, literal_column
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum, DateTime, UniqueConstraint
+from sqlalchemy import Column, Integer, Float, String, ForeignKey, Enum, DateTime, UniqueConstraint, Index, DDL, JSON, event
+from sqlalchemy.dialects.sqlite import DATETIME as SQLiteDateTime
 
 from database import Base
 from enums import Role, VoteType
 
 BASE_URL = 'http://localhost:8000'
 
+# SQLite stores server_default timestamps without microseconds, so values compared against them
+# (e.g. pagination cursors) need to be written in the same format:
+Timestamp = DateTime().with_variant(SQLiteDateTime(truncate_microseconds=True), "sqlite")
+
+# Paths are compared byte by byte (rather than using the locale's collation rules) so that a subtree is a range of the index:
+PathString = String().with_variant(String(collation="C"), "postgresql")
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
@@ -20,7 +28,9 @@ class User(Base):
     # "back_populates" provides bidirectional relationship where User can access 'posts' and each Post can access 'user'
     posts = relationship("Post", back_populates="author")
 
-    profile_image = relationship("Image", back_populates="user", uselist=False, cascade="all, delete-orphan")
+    # AsyncSession cannot lazy load during serialization, so relationships included in responses
+    # are loaded up-front, using a single "SELECT ... WHERE id IN (...)" for all the loaded rows:
+    profile_image = relationship("Image", back_populates="user", uselist=False, cascade="all, delete-orphan", lazy="selectin")
 
 
 class Post(Base):
@@ -38,18 +48,26 @@ class Post(Base):
     # If the post is a comment, this is the ID of the parent:
     parent_id = Column(Integer, ForeignKey("posts.id"), nullable=True, index=True)  # FIXME: CHANGED
 
+    # Materialized path: the IDs of all the ancestors of the post, from the top-level post down, e.g. "1/5/12/".
+    # This is empty for top-level posts. It allows all ancestors to be updated in one statement,
+    # and all descendants to be found with one index range scan (see services/utils.py):
+    path = Column(PathString, nullable=False, default="", index=True)
+
     # Keeping  counters here so they are not counted each time:
     comment_count = Column(Integer, default=0)
     upvote_count = Column(Integer, index=True, default=0)
     downvote_count = Column(Integer, default=0)
-    created_at = Column(DateTime, index=True, server_default=func.now())
+    created_at = Column(Timestamp, index=True, server_default=func.now())
+    # The scores used by the "hot" and "controversial" orders, updated when the post is voted on (see ranking.py):
+    hot_score = Column(Float, nullable=False, default=0)
+    controversial_score = Column(Float, nullable=False, default=0)
 
 
     # The user object who created the post: 
-    author = relationship("User", back_populates="posts")
+    author = relationship("User", back_populates="posts", lazy="selectin")
 
     # Sorting the images by their timestamp, so no need to re-order:
-    images = relationship("Image", back_populates="post", cascade="all, delete-orphan")
+    images = relationship("Image", back_populates="post", cascade="all, delete-orphan", lazy="selectin")
 
 
     # Using self-referencing relationship for the hierarchical structure of posts/comments:
@@ -57,6 +75,19 @@ class Post(Base):
     
     votes = relationship("Vote", back_populates="post", cascade="all, delete-orphan")
 
+    # Fetching server-generated values (i.e. created_at) using RETURNING when a post is inserted,
+    # rather than with another query when they are accessed:
+    __mapper_args__ = {"eager_defaults": True}
+
+    # Replies are fetched by parent and paged by ID, so this index serves comment trees without sorting.
+    # Feeds are filtered by parent (top-level posts have none) and paged in the order of each Order option,
+    # so every page is an index range scan, regardless of how deep into the feed it is:
+    __table_args__ = (Index("ix_posts_parent_id_id", "parent_id", "id"),
+                      Index("ix_posts_parent_id_created_at_id", "parent_id", "created_at", "id"),
+                      Index("ix_posts_parent_id_upvote_count_id", "parent_id", "upvote_count", "id"),
+                      Index("ix_posts_parent_id_hot_score_id", "parent_id", "hot_score", "id"),
+                      Index("ix_posts_parent_id_controversial_score_id", "parent_id", "controversial_score", "id"), )
+
 
 class Image(Base):
     __tablename__ = "images"
@@ -66,6 +97,12 @@ class Image(Base):
     # Only has a value for post images:
     post_id = Column(Integer, ForeignKey("posts.id"), nullable=True, index=True)
     url = Column(String, index=True)
+    # The resized versions of the image, e.g. [{"name": "thumbnail", "format": "webp", "width": 150, "height": 100, "url": ...}].
+    # Stored with the image since they are always returned with it:
+    renditions = Column(JSON, nullable=True)
+    # The SHA-256 hash of the uploaded file. Records with the same content share the same files,
+    # which are only deleted once no record references them (see image_service.py):
+    content_hash = Column(String(64), nullable=True, index=True)
     uploaded_at = Column(DateTime, server_default=func.now(), index=True)
 
     user = relationship("User", back_populates="profile_image")
@@ -73,10 +110,7 @@ class Image(Base):
 
     @property
     def full_url(self):
-        if not self.url.startswith("http"):
-            full_url = f"{BASE_URL}/{self.url}"
-            print(f"Constructed full URL: {full_url}")  # Debugging line
-            return full_url
+        if not self.url.startswith("http"): return f"{BASE_URL}/{self.url}"
         return self.url
 
 
@@ -90,4 +124,57 @@ class Vote(Base):
     post = relationship("Post", back_populates="votes")
     # Setting a constraint that the combination of post_id and user_id should be unique.
     # Do not remove the comma, table args must be a tuple:
-    __table_args__ = (UniqueConstraint('post_id', 'user_id', name='unique_post_user_vote'), )
\ No newline at end of file
+    __table_args__ = (UniqueConstraint('post_id', 'user_id', name='unique_post_user_vote'), )
+
+
+# Search indexes:
+# A B-tree index (such as the ones on Post.title and User.name) cannot be used for a search with a leading wildcard,
+# so dedicated indexes are created for each database (when the tables are created, or by backfill.py for existing ones).
+
+# PostgreSQL: trigram indexes serve case-insensitive substring (ILIKE '%term%') searches,
+# and a full text index on the title and body serves ranked searches.
+TRIGRAM_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+event.listen(Base.metadata, "before_create", DDL(TRIGRAM_EXTENSION_DDL).execute_if(dialect="postgresql"))
+
+# Written using literals rather than bound parameters, so that queries match the index expression exactly:
+POST_SEARCH_DOCUMENT = func.to_tsvector(literal_column("'english'"), func.coalesce(Post.title, literal_column("''"))
+                                        + literal_column("' '") + func.coalesce(Post.body, literal_column("''")))
+
+Index("ix_posts_title_trgm", Post.title, postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+Index("ix_users_name_trgm", User.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+
+# The expression must be the same as POST_SEARCH_DOCUMENT for the index to be used:
+POSTGRESQL_SEARCH_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_posts_search_document ON posts "
+    "USING gin (to_tsvector('english', coalesce(title, '') || ' ' || coalesce(body, '')))",
+)
+
+# SQLite: an FTS5 table (with the trigram tokenizer, which also matches substrings) that shadows the posts table.
+# The row ID of each entry is the post ID. Triggers keep it in sync when posts (or author names) change:
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, body, author, tokenize='trigram')",
+
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts (rowid, title, body, author)
+        VALUES (new.id, new.title, new.body, (SELECT name FROM users WHERE id = new.user_id));
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, body ON posts BEGIN
+        UPDATE posts_fts SET title = new.title, body = new.body WHERE rowid = new.id;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+        DELETE FROM posts_fts WHERE rowid = old.id;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF name ON users BEGIN
+        UPDATE posts_fts SET author = new.name WHERE rowid IN (SELECT id FROM posts WHERE user_id = new.id);
+    END""",
+)
+
+# The statements are idempotent, so they can also be run on existing databases (see backfill.py):
+SEARCH_DDL = {"postgresql": POSTGRESQL_SEARCH_DDL, "sqlite": SQLITE_SEARCH_DDL}
+
+for dialect, statements in SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Post.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
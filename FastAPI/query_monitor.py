@@ -0,0 +1,247 @@
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from database import async_engine, pool_metrics
+from metrics import LatencyStats
+
+
+# Counts the statements each request sends to the database, and the time spent waiting for them, using SQLAlchemy's
+# cursor events. This shows which routes make the most round trips, and finds two common problems:
+# - Slow statements, which are printed (with the route that sent them) when they take longer than SLOW_QUERY_THRESHOLD_MS.
+# - N+1 patterns: the same statement (with different parameters) sent many times by one request, e.g. loading a
+#   relationship for each post of a feed separately, rather than for all of them at once.
+#   These are printed when a statement is repeated N_PLUS_ONE_THRESHOLD times in a request.
+# - Requests that spent longer waiting for a database connection than running their statements (meaning the pool was
+#   exhausted), which are printed when they waited longer than POOL_WAIT_THRESHOLD_MS.
+# Timing every statement adds to each request, so the monitor is opt-in, enabled by setting QUERY_MONITOR=true.
+# The events are also listened to while count_queries is used (e.g. by benchmarks/query_budgets.py), whether or not it is:
+QUERY_MONITOR = (os.getenv("QUERY_MONITOR") or "").lower() in ("1", "true", "yes")
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS") or 100)
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD") or 5)
+POOL_WAIT_THRESHOLD_MS = float(os.getenv("POOL_WAIT_THRESHOLD_MS") or 50)
+
+# The number of statements kept for each route (the most repeated ones), and the length they are shortened to:
+STATEMENTS_PER_ROUTE = 5
+STATEMENT_LENGTH = 300
+
+# Lists of parameters, e.g. "IN (?, ?, ?)" or "VALUES ($1, $2)", which are replaced by "(?)" so that statements
+# with different numbers of parameters have the same shape:
+PARAMETER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+))*\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    return WHITESPACE.sub(" ", PARAMETER_LIST.sub("(?)", statement)).strip()
+
+
+class QueryCount:
+    # The statements sent while counting (by a request, or by the code in a count_queries block).
+    # Counts are added to the enclosing count too, so a request made inside a count_queries block is included in it.
+
+    def __init__(self, scope: Optional[Scope] = None, parent: Optional["QueryCount"] = None):
+        self.scope = scope
+        self.parent = parent
+        self.count = 0
+        self.duration = 0.0
+        # The time spent waiting for connections from the pool:
+        self.pool_wait = 0.0
+        self.shapes = Counter()
+
+    @property
+    def route(self) -> str:
+        # FastAPI adds the matched route to the scope, giving e.g. "GET /post/{post_id}" rather than "GET /post/5":
+        if self.scope is None: return self.parent.route if self.parent is not None else "(no request)"
+        route = self.scope.get("route")
+        return f"{self.scope['method']} {getattr(route, 'path', None) or self.scope['path']}"
+
+    def record(self, shape: str, duration: float) -> None:
+        count = self
+        while count is not None:
+            count.count += 1
+            count.duration += duration
+            count.shapes[shape] += 1
+            count = count.parent
+
+    def record_pool_wait(self, wait: float) -> None:
+        count = self
+        while count is not None:
+            count.pool_wait += wait
+            count = count.parent
+
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> list:
+        # The statements sent at least 'threshold' times, most repeated first:
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+class RouteQueries:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.slow_queries = 0
+        self.db_time = LatencyStats()
+        self.pool_wait = LatencyStats()
+        # The requests that spent longer waiting for a connection than running their statements:
+        self.pool_bound = 0
+        self.n_plus_one = Counter()
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "queries_per_request": self.queries / self.requests if self.requests else 0.0,
+            "max_queries": self.max_queries,
+            "slow_queries": self.slow_queries,
+            "db_time": self.db_time.summary(),
+            "pool_wait": self.pool_wait.summary(),
+            "pool_bound": self.pool_bound,
+            "n_plus_one": [{"requests": count, "statement": shape} for shape, count in self.n_plus_one.most_common()],
+        }
+
+
+class QueryMonitor:
+    def __init__(self, slow_threshold: float, n_plus_one_threshold: int, pool_wait_threshold: float):
+        self.slow_threshold = slow_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.pool_wait_threshold = pool_wait_threshold
+        self.routes = {}
+        # The count of the request (or count_queries block) being handled by the current task:
+        self.current = ContextVar("query_count", default=None)
+        # The number of reasons to listen to the events (enabling the monitor, and each count_queries block in progress):
+        self.listeners = 0
+
+    def listen(self) -> None:
+        self.listeners += 1
+        if self.listeners > 1: return
+        event.listen(async_engine.sync_engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(async_engine.sync_engine, "after_cursor_execute", self.after_cursor_execute)
+        # Adding the time spent waiting for connections to the request that waited:
+        pool_metrics.wait_listeners.append(self.record_pool_wait)
+
+    def stop_listening(self) -> None:
+        self.listeners -= 1
+        if self.listeners > 0: return
+        event.remove(async_engine.sync_engine, "before_cursor_execute", self.before_cursor_execute)
+        event.remove(async_engine.sync_engine, "after_cursor_execute", self.after_cursor_execute)
+        pool_metrics.wait_listeners.remove(self.record_pool_wait)
+
+    def route_queries(self, route: str) -> RouteQueries:
+        return self.routes.setdefault(route, RouteQueries())
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        context.query_started_at = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        duration = time.perf_counter() - context.query_started_at
+        count = self.current.get()
+        if count is None and duration < self.slow_threshold: return
+
+        shape = statement_shape(statement)
+        if count is not None: count.record(shape, duration)
+
+        if duration >= self.slow_threshold:
+            route = count.route if count is not None else "(no request)"
+            self.route_queries(route).slow_queries += 1
+            print(f"Slow query ({duration * 1000:.0f}ms) in {route}: {shape[:STATEMENT_LENGTH]}")
+
+    def record_pool_wait(self, wait: float) -> None:
+        count = self.current.get()
+        if count is not None: count.record_pool_wait(wait)
+
+    @contextmanager
+    def counting(self, scope: Optional[Scope] = None) -> Iterator[QueryCount]:
+        count = QueryCount(scope, parent=self.current.get())
+        token = self.current.set(count)
+        try:
+            yield count
+        finally:
+            self.current.reset(token)
+
+    def record_request(self, count: QueryCount) -> None:
+        route_queries = self.route_queries(count.route)
+        route_queries.requests += 1
+        route_queries.queries += count.count
+        route_queries.max_queries = max(route_queries.max_queries, count.count)
+        route_queries.db_time.record(count.duration)
+        route_queries.pool_wait.record(count.pool_wait)
+
+        if count.pool_wait >= self.pool_wait_threshold and count.pool_wait > count.duration:
+            route_queries.pool_bound += 1
+            print(f"{count.route} waited {count.pool_wait * 1000:.0f}ms for database connections, "
+                  f"and {count.duration * 1000:.0f}ms for its {count.count} queries (the pool may be too small)")
+
+        for shape, repeats in count.repeated(self.n_plus_one_threshold):
+            route_queries.n_plus_one[shape[:STATEMENT_LENGTH]] += 1
+            print(f"Possible N+1 query in {count.route}, sent {repeats} times: {shape[:STATEMENT_LENGTH]}")
+            # Keeping the most common statements only:
+            if len(route_queries.n_plus_one) > STATEMENTS_PER_ROUTE * 2:
+                route_queries.n_plus_one = Counter(dict(route_queries.n_plus_one.most_common(STATEMENTS_PER_ROUTE)))
+
+    def summary(self) -> dict:
+        # The routes that spent the longest waiting for the database in total come first:
+        routes = sorted(self.routes.items(), key=lambda item: item[1].db_time.total, reverse=True)
+        return {"slow_threshold_ms": self.slow_threshold * 1000, "n_plus_one_threshold": self.n_plus_one_threshold,
+                "pool_wait_threshold_ms": self.pool_wait_threshold * 1000,
+                "routes": {route: route_queries.summary() for route, route_queries in routes}}
+
+
+query_monitor = QueryMonitor(SLOW_QUERY_THRESHOLD_MS / 1000, N_PLUS_ONE_THRESHOLD, POOL_WAIT_THRESHOLD_MS / 1000)
+if QUERY_MONITOR: query_monitor.listen()
+
+
+class QueryMonitorMiddleware:
+    # Counts the statements sent while handling each request, recording them for the request's route.
+
+    def __init__(self, app: ASGIApp, monitor: QueryMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with self.monitor.counting(scope) as count:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.monitor.record_request(count)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCount]:
+    # Counts the statements sent by the code in the block (including requests made to the app in it), e.g.
+    #     with count_queries() as queries:
+    #         client.get("/post/")
+    #     print(queries.count)
+    query_monitor.listen()
+    try:
+        with query_monitor.counting() as count:
+            yield count
+    finally:
+        query_monitor.stop_listening()
+
+
+@contextmanager
+def query_budget(max_queries: int, label: str = "") -> Iterator[QueryCount]:
+    # Fails if the code in the block sends more than max_queries statements, listing the statements it sent.
+    # Used to check that changes do not add round trips to a route (see benchmarks/query_budgets.py), e.g.
+    #     with query_budget(4, "GET /post/"):
+    #         client.get("/post/")
+    with count_queries() as count:
+        yield count
+
+    if count.count > max_queries:
+        statements = "\n".join(f"  {repeats}x {shape[:STATEMENT_LENGTH]}" for shape, repeats in count.shapes.most_common())
+        raise QueryBudgetExceeded(f"{label or 'Block'} sent {count.count} queries (budget {max_queries}):\n{statements}")
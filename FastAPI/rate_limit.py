@@ -0,0 +1,296 @@
+import os
+import mmap
+import stat
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from typing import Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from limits import RateLimitItem, parse
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+from limits.storage import Storage
+from limits.strategies import FixedWindowRateLimiter, STRATEGIES
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the in-memory storage is used by default instead:
+    fcntl = None
+
+
+# SlowAPI's default storage is in the memory of each process, so with several worker processes each one counts
+# the requests it handles separately, and every limit is multiplied by the number of workers.
+# SharedMemoryStorage keeps the counters in a memory-mapped file that all the workers on the host open, so they
+# share the same counters without needing an external service (for deployments with several hosts, a
+# shared server can be used instead by setting RATE_LIMIT_STORAGE_URI, e.g. to "redis://localhost:6379").
+# The file is named after the user, the app's directory and its database, so that other deployments on the same host
+# (or other users) do not share its counters:
+DEPLOYMENT_ID = hashlib.blake2b(f"{os.path.dirname(os.path.abspath(__file__))}\n{os.getenv('DB_URI')}".encode(), digest_size=8).hexdigest()
+DEFAULT_STORAGE_PATH = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                    f"socialapp-rate-limits-{os.getuid() if hasattr(os, 'getuid') else 0}-{DEPLOYMENT_ID}")
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI") or (f"sharedmem://{DEFAULT_STORAGE_PATH}" if fcntl else "memory://")
+
+# The file starts with a header identifying its layout, followed by a hash table of counters.
+# Each slot holds the hash of a key, the time its window ends, and the number of hits in the window:
+HEADER = struct.Struct("<8sQ")
+SLOT = struct.Struct("<Qdq")
+MAGIC = b"SALIMIT1"
+
+# Enough for tens of thousands of clients (slots whose windows have ended are reused), using 1.5MB:
+DEFAULT_SLOTS = 65536
+# The number of slots checked for a key before the one whose window ends soonest is reused:
+MAX_PROBES = 32
+
+# Leases (see BatchedFixedWindowRateLimiter) take at most this fraction of what is left of a limit,
+# and at most MAX_LEASE hits:
+LEASE_FRACTION = 16
+MAX_LEASE = 50
+# The number of leases kept before those whose windows have ended are removed:
+MAX_LEASES = 10000
+
+
+def key_hash(key: str) -> int:
+    # 64 bits, so different keys practically never share a slot. 0 marks a slot that has never been used:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+
+def open_storage_file(path: str) -> int:
+    # The file is in a directory that every user can write to, so another user could have created it (or a link with its
+    # name) to read or change the counters. Links are not followed, and the file must be a regular file owned by this user:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+    info = os.fstat(fd)
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        os.close(fd)
+        raise PermissionError(f"The rate limit storage '{path}' must be a file only accessible by this user")
+    return fd
+
+
+class SharedMemoryStorage(Storage):
+    # A storage for the limits package, with fixed window counters in a memory-mapped file.
+    # Each operation locks the file, so the workers (and threads) update the counters one at a time.
+    # Used with the URI "sharedmem:///path/to/file" (workers using the same file share the counters).
+
+    STORAGE_SCHEME = ["sharedmem"]
+
+    def __init__(self, uri: Optional[str] = None, wrap_exceptions: bool = False, slots: int = DEFAULT_SLOTS, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        parsed = urlparse(uri or "")
+        self.path = parsed.path or DEFAULT_STORAGE_PATH
+        # The number of slots can also be given in the URI (e.g. "sharedmem:///dev/shm/limits?slots=131072"):
+        self.slots = int(parse_qs(parsed.query).get("slots", [slots])[0])
+
+        # flock only excludes other processes (threads share the file), so threads are excluded separately:
+        self.thread_lock = threading.Lock()
+        self.fd = open_storage_file(self.path)
+        size = HEADER.size + SLOT.size * self.slots
+
+        with self.locked():
+            if os.fstat(self.fd).st_size != size: os.ftruncate(self.fd, size)
+            self.memory = mmap.mmap(self.fd, size)
+            # The file is left over from an earlier run with a different layout, or has just been created:
+            if HEADER.unpack_from(self.memory, 0) != (MAGIC, self.slots): self.initialize()
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    def locked(self):
+        return FileLock(self)
+
+    def initialize(self) -> None:
+        self.memory[:] = bytes(len(self.memory))
+        HEADER.pack_into(self.memory, 0, MAGIC, self.slots)
+
+    def offset(self, index: int) -> int:
+        return HEADER.size + SLOT.size * index
+
+    def find(self, key: str, now: float) -> Tuple[int, bool]:
+        # Returns the slot holding the key and True, or the slot to add it to and False.
+        # Must be called with the file locked.
+        hashed = key_hash(key)
+        start = hashed % self.slots
+        free, soonest, soonest_expiry = None, start, float("inf")
+
+        for probe in range(MAX_PROBES):
+            index = (start + probe) % self.slots
+            slot_hash, expiry, _ = SLOT.unpack_from(self.memory, self.offset(index))
+
+            if slot_hash == hashed: return index, True
+            # The key is not in the table, since it would have been added to the first unused slot:
+            if slot_hash == 0: return (free if free is not None else index), False
+
+            if expiry <= now and free is None: free = index
+            if expiry < soonest_expiry: soonest, soonest_expiry = index, expiry
+
+        # If every slot is in use, the one whose window ends soonest is reused:
+        return (free if free is not None else soonest), False
+
+    def read(self, key: str) -> Tuple[int, float]:
+        # Returns the count and the end of the current window of the key (the count is 0 if its window has ended):
+        now = time.time()
+        with self.locked():
+            index, found = self.find(key, now)
+            _, expiry, count = SLOT.unpack_from(self.memory, self.offset(index))
+
+        if not found or expiry <= now: return 0, now
+        return count, expiry
+
+    def incr_with_expiry(self, key: str, expiry: int, amount: int = 1, elastic_expiry: bool = False) -> Tuple[int, float]:
+        # Adds to the count of the key, returning the new count and the end of its window.
+        # If its window has ended, a new one starts (lasting 'expiry' seconds):
+        now = time.time()
+        with self.locked():
+            index, found = self.find(key, now)
+            offset = self.offset(index)
+            _, window_end, count = SLOT.unpack_from(self.memory, offset)
+
+            if not found or window_end <= now: window_end, count = now + expiry, 0
+            elif elastic_expiry: window_end = now + expiry
+            count += amount
+
+            SLOT.pack_into(self.memory, offset, key_hash(key), window_end, count)
+        return count, window_end
+
+    # The methods used by the limits package.
+    # elastic_expiry is only passed by limits 3.x (it was removed in 4.0):
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        return self.incr_with_expiry(key, expiry, amount, elastic_expiry)[0]
+
+    def get(self, key: str) -> int:
+        return self.read(key)[0]
+
+    def get_expiry(self, key: str) -> float:
+        return self.read(key)[1]
+
+    def check(self) -> bool:
+        return not self.memory.closed
+
+    def reset(self) -> Optional[int]:
+        # Clears every counter, returning the number of keys that were cleared:
+        with self.locked():
+            cleared = sum(1 for index in range(self.slots) if SLOT.unpack_from(self.memory, self.offset(index))[0])
+            self.initialize()
+        return cleared
+
+    def clear(self, key: str) -> None:
+        # The slot keeps the key's hash (rather than being marked as unused), so keys added after it can still be found:
+        with self.locked():
+            index, found = self.find(key, time.time())
+            if found: SLOT.pack_into(self.memory, self.offset(index), key_hash(key), 0.0, 0)
+
+
+class FileLock:
+    def __init__(self, storage: SharedMemoryStorage):
+        self.storage = storage
+
+    def __enter__(self):
+        self.storage.thread_lock.acquire()
+        try:
+            fcntl.flock(self.storage.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.storage.thread_lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.storage.fd, fcntl.LOCK_UN)
+        self.storage.thread_lock.release()
+
+
+class Lease:
+    def __init__(self, remaining: int, count: int, window_end: float):
+        # The hits that this process can still allow without checking the storage,
+        # the shared count when the lease was taken, and the end of the window that the lease is for:
+        self.remaining = remaining
+        self.count = count
+        self.window_end = window_end
+
+
+class BatchedFixedWindowRateLimiter(FixedWindowRateLimiter):
+    # Fixed windows (like the default strategy), but each process takes hits from the shared counters in batches
+    # ("leases"), then allows the hits in its lease without checking the storage again.
+    #
+    # A lease is added to the shared count when it is taken, so the workers together never allow more than the limit.
+    # Hits that are leased but unused when the window ends are lost, so leases are kept small: at most
+    # 1/LEASE_FRACTION of what was left of the limit when it was taken. Near the limit (and for small limits,
+    # e.g. "10/minute"), leases are a single hit, so every hit is checked against the shared count.
+
+    def __init__(self, storage: Storage):
+        super().__init__(storage)
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def take_lease(self, item: RateLimitItem, key: str, size: int) -> Tuple[int, float]:
+        # Returns the shared count after adding the lease, and the end of the window:
+        if isinstance(self.storage, SharedMemoryStorage): return self.storage.incr_with_expiry(key, item.get_expiry(), size)
+        count = self.storage.incr(key, item.get_expiry(), amount=size)
+        return count, self.storage.get_expiry(key)
+
+    def hit(self, item: RateLimitItem, *identifiers: str, cost: int = 1) -> bool:
+        key = item.key_for(*identifiers)
+        now = time.time()
+
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease.window_end <= now: lease = None
+
+            if lease is not None and lease.remaining >= cost:
+                lease.remaining -= cost
+                return True
+
+            # Once the limit has been reached, the rest of the window is rejected without checking the storage:
+            if lease is not None and lease.count >= item.amount: return False
+
+            # Estimating what is left of the limit from the count when the last lease was taken:
+            left = item.amount - (lease.count if lease is not None else 0)
+            size = max(cost, min(MAX_LEASE, left // LEASE_FRACTION))
+
+        count, window_end = self.take_lease(item, key, size)
+        # The lease only includes the hits that were within the limit:
+        allowed = max(0, min(size, item.amount - (count - size)))
+
+        with self.lock:
+            if len(self.leases) >= MAX_LEASES: self.remove_expired_leases(now)
+            self.leases[key] = Lease(allowed - cost if allowed >= cost else 0, count, window_end)
+        return allowed >= cost
+
+    def unused(self, key: str) -> int:
+        # The hits counted by the storage that this process has not used yet:
+        lease = self.leases.get(key)
+        return lease.remaining if lease is not None and lease.window_end > time.time() else 0
+
+    def test(self, item: RateLimitItem, *identifiers: str, cost: int = 1) -> bool:
+        key = item.key_for(*identifiers)
+        return self.storage.get(key) - self.unused(key) < item.amount - cost + 1
+
+    def get_window_stats(self, item: RateLimitItem, *identifiers: str):
+        stats = super().get_window_stats(item, *identifiers)
+        return stats._replace(remaining=min(item.amount, stats.remaining + self.unused(item.key_for(*identifiers))))
+
+    def remove_expired_leases(self, now: float) -> None:
+        self.leases = {key: lease for key, lease in self.leases.items() if lease.window_end > now}
+        # If there are still too many, the unused hits in the leases are given up (which only makes the limits stricter):
+        if len(self.leases) >= MAX_LEASES: self.leases.clear()
+
+
+# Making the strategy available to the Limiter by name:
+STRATEGIES["batched-fixed-window"] = BatchedFixedWindowRateLimiter
+
+
+# Rate limiting with SlowAPI, shared by the routers (which decorate their endpoints with limiter.limit) and the app.
+# key_func kwarg takes in a function that returns a unique key for the client (here we are using a function to get the IP address):
+# default_limits apply to all endpoints unless overridden by a decorator.
+# The counters are shared by the worker processes on the host, and each worker takes hits from them in batches:
+limiter = Limiter(key_func=get_remote_address, default_limits=["10/second"],
+                  storage_uri=RATE_LIMIT_STORAGE_URI, strategy="batched-fixed-window")
+
+
+def hit(limit: str, key: str, scope: str) -> bool:
+    # Counts a hit outside of the decorators (e.g. for WebSocket connections, which SlowAPI does not limit),
+    # returning whether it is within the limit. A scope shared with limiter.shared_limit uses the same counters:
+    if not limiter.enabled: return True
+    return limiter.limiter.hit(parse(limit), key, scope)
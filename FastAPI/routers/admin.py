@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Path, status as st
+from starlette.requests import Request
+
+from rate_limit import limiter
+from services import user_service as us
+from services.user_cache import user_cache
+from services import response_cache
+from security import hashing_metrics
+from services.file_cleanup import file_cleanup
+from services import realtime
+from loop_monitor import loop_monitor
+from query_monitor import QUERY_MONITOR, query_monitor
+from database import pool_status
+from schemas import UpdateUserRoleRequest, PrivateUserResponse
+from dependencies import db_dependency, admin_dependency
+
+
+router = APIRouter(prefix="/admin", tags=["Admin"])
+
+
+@router.get("/metrics", status_code=st.HTTP_200_OK)
+@limiter.limit("60/minute")
+async def read_metrics(admin: admin_dependency, request: Request):
+    # The metrics are per worker process (unless the caches use a shared backend):
+    return {"user_cache": user_cache.stats(), "response_cache": response_cache.stats(), "password_hashing": hashing_metrics.summary(),
+            "file_cleanup": file_cleanup.stats(), "database_pool": pool_status(),
+            "realtime": realtime.stats(), "startup": getattr(request.app.state, "startup_timings", None)}
+
+
+@router.get("/loop-lag", status_code=st.HTTP_200_OK)
+@limiter.limit("60/minute")
+async def read_loop_lag(admin: admin_dependency, request: Request):
+    # The routes that blocked the event loop, with samples of the code that was running at the time:
+    if loop_monitor is None: return {"enabled": False}
+    return loop_monitor.summary()
+
+
+@router.get("/queries", status_code=st.HTTP_200_OK)
+@limiter.limit("60/minute")
+async def read_queries(admin: admin_dependency, request: Request):
+    # The number of database queries and the time spent on them by each route, with the statements repeated by requests:
+    if not QUERY_MONITOR: return {"enabled": False}
+    return query_monitor.summary()
+
+
+@router.put("/user/{user_id}/role", response_model=PrivateUserResponse, status_code=st.HTTP_200_OK)
+@limiter.limit("10/minute")
+async def update_user_role(db: db_dependency, admin: admin_dependency, role_data: UpdateUserRoleRequest, request: Request, user_id: int = Path(ge=0)):
+    return await us.update_user_role(db, user_id, role_data.role)
@@ -3,8 +3,10 @@ from typing import List, Optional
 from fastapi import APIRouter, Path, File, Query, UploadFile, status as st
 from starlette.requests import Request
 
-from main import app
+from rate_limit import limiter
 from services import post_service as ps
+from services import response_cache as rc
+from serializers import serialize_posts, posts_response
 from schemas import CreatePostRequest, UpdatePostRequest, PostResponse, VoteResponse, ImageResponse
 from dependencies import db_dependency, user_dependency, optional_user_dependency
 from enums import Order, VoteType
@@ -15,59 +17,103 @@ router = APIRouter(prefix="/post", tags=["Post"])
 
 @router.post("/", response_model=PostResponse, status_code=st.HTTP_201_CREATED)
 # Using stricter rate limiting to prevent spam posts:
-@app.state.limiter.limit("10/minute, 20/hour, 50/day")
+@limiter.limit("10/minute, 20/hour, 50/day")
 async def create_post(db: db_dependency, user: user_dependency, post_data: CreatePostRequest, request: Request):
-    return ps.create_post(db, user, post_data)
+    return await ps.create_post(db, user, post_data)
+
+
+# Declared before "/{post_id}", since routes are matched in order:
+@router.get("/search", response_model=List[PostResponse], status_code=st.HTTP_200_OK)
+@limiter.limit("100/minute")
+# Full text search of post titles and bodies, ordered by relevance.
+# The cursor for the next page is returned in the X-Next-Cursor header:
+async def search_posts(db: db_dependency, user: optional_user_dependency, request: Request,
+                       q: str = Query(min_length=1, max_length=200), show_comments: bool = Query(False),
+                       max_depth: int = Query(ps.COMMENT_MAX_DEPTH, ge=0, le=100), reply_limit: int = Query(ps.COMMENT_REPLY_LIMIT, ge=1, le=500),
+                       cursor: Optional[str] = Query(None), limit: int = Query(ps.POSTS_PAGE_SIZE, ge=1, le=100)):
+    posts, next_cursor = await ps.search_posts(db, q, user=user, show_comments=show_comments, max_depth=max_depth,
+                                               reply_limit=reply_limit, cursor=cursor, limit=limit)
+    return posts_response(serialize_posts(posts), next_cursor)
 
 
 @router.get("/{post_id}", response_model=PostResponse, status_code=st.HTTP_200_OK)
-@app.state.limiter.limit("100/minute")
+@limiter.limit("100/minute")
 # User is optional, but providing it allows for additional data to be returned with the request:
-async def read_post(db: db_dependency, request: Request, user: optional_user_dependency, post_id: int = Path(ge=0)):
-    return ps.get_post(db, post_id, user=user)
+async def read_post(db: db_dependency, request: Request, user: optional_user_dependency, post_id: int = Path(ge=0),
+                    max_depth: int = Query(ps.COMMENT_MAX_DEPTH, ge=0, le=100), reply_limit: int = Query(ps.COMMENT_REPLY_LIMIT, ge=1, le=500)):
+    async def load():
+        return [await ps.get_post(db, post_id, max_depth=max_depth, reply_limit=reply_limit)], None
+
+    # The response is cached (see response_cache.py), with the user's votes added to it:
+    key = rc.cache_key("post", post_id=post_id, max_depth=max_depth, reply_limit=reply_limit)
+    return await rc.cached_posts_response(db, user, key, load, single=True)
+
+
+@router.get("/{post_id}/comments", response_model=List[PostResponse], status_code=st.HTTP_200_OK)
+@limiter.limit("100/minute")
+# Loads more replies to a post, using the 'replies_cursor' returned with the post.
+# The cursor for the next page is returned in the X-Next-Cursor header:
+async def read_comments(db: db_dependency, request: Request, user: optional_user_dependency, post_id: int = Path(ge=0),
+                        cursor: Optional[str] = Query(None), max_depth: int = Query(ps.COMMENT_MAX_DEPTH, ge=1, le=100),
+                        reply_limit: int = Query(ps.COMMENT_REPLY_LIMIT, ge=1, le=500)):
+    comments, next_cursor = await ps.get_comments(db, post_id, user=user, cursor=cursor, max_depth=max_depth, reply_limit=reply_limit)
+    return posts_response(serialize_posts(comments), next_cursor)
 
 
 @router.get("/", response_model=List[PostResponse], status_code=st.HTTP_200_OK)
-@app.state.limiter.limit("100/minute")
+@limiter.limit("100/minute")
+# Posts are returned a page at a time. The cursor for the next page is returned in the X-Next-Cursor header,
+# and should be passed back (with the same filters and order) to continue the feed:
 async def read_posts(db: db_dependency, user: optional_user_dependency, request: Request,
                         user_id: int = Query(default=None, ge=0), user_vote: VoteType = Query(default=None),
                         username: str = Query(None), title: str = Query(None), parent_id: int = Query(None), 
-                        order_by: Order = Query(Order.DATE), show_comments: bool = Query(False)):
-    return ps.get_posts(db, user=user, user_id=user_id, user_vote=user_vote, username=username, title=title, parent_id=parent_id, 
-                        order_by=order_by, show_comments=show_comments)
+                        order_by: Order = Query(Order.DATE), show_comments: bool = Query(False),
+                        max_depth: int = Query(ps.COMMENT_MAX_DEPTH, ge=0, le=100), reply_limit: int = Query(ps.COMMENT_REPLY_LIMIT, ge=1, le=500),
+                        cursor: Optional[str] = Query(None), limit: int = Query(ps.POSTS_PAGE_SIZE, ge=1, le=100)):
+    # Feeds are cached (see response_cache.py), except for searches and feeds of the user's votes (which are specific to the user):
+    if not (user_vote or username or title):
+        key = rc.cache_key("posts", user_id=user_id, parent_id=parent_id, order_by=order_by, show_comments=show_comments,
+                           max_depth=max_depth, reply_limit=reply_limit, cursor=cursor, limit=limit)
+        load = lambda: ps.get_posts(db, user_id=user_id, parent_id=parent_id, order_by=order_by, show_comments=show_comments,
+                                    max_depth=max_depth, reply_limit=reply_limit, cursor=cursor, limit=limit)
+        return await rc.cached_posts_response(db, user, key, load, tags={rc.feed_tag(parent_id, show_comments, order_by)})
+
+    posts, next_cursor = await ps.get_posts(db, user=user, user_id=user_id, user_vote=user_vote, username=username, title=title, parent_id=parent_id, 
+                        order_by=order_by, show_comments=show_comments, max_depth=max_depth, reply_limit=reply_limit, cursor=cursor, limit=limit)
+    return posts_response(serialize_posts(posts), next_cursor)
 
 
 @router.put("/{post_id}", status_code=st.HTTP_204_NO_CONTENT)
-@app.state.limiter.limit("10/minute")
+@limiter.limit("10/minute")
 async def update_post(db: db_dependency, user: user_dependency, post_data: UpdatePostRequest, request: Request, post_id: int = Path(ge=0)):
-    ps.update_post(db, user, post_id, post_data)
+    await ps.update_post(db, user, post_id, post_data)
 
 
 @router.delete("/{post_id}", status_code=st.HTTP_204_NO_CONTENT)
-@app.state.limiter.limit("10/minute")
+@limiter.limit("10/minute")
 async def delete_post(db: db_dependency, user: user_dependency, request: Request, post_id: int = Path(ge=0)):
-    ps.delete_post(db, user, post_id)
+    await ps.delete_post(db, user, post_id)
 
 
 @router.post("/{post_id}/image/", response_model=ImageResponse, status_code=st.HTTP_201_CREATED)
-@app.state.limiter.limit("10/minute")
+@limiter.limit("10/minute")
 async def create_post_image(db: db_dependency, user: user_dependency, request: Request, post_id: int = Path(ge=0), image: UploadFile = File(...)):
     return await ps.create_post_image(db, user, post_id, image)
 
 
 @router.get("/{post_id}/images", response_model=List[ImageResponse], status_code=st.HTTP_200_OK)
-@app.state.limiter.limit("100/minute")
+@limiter.limit("100/minute")
 async def read_post_images(db: db_dependency, request: Request, post_id: int = Path(ge=0)):
-    return ps.get_post_images(db, post_id)
+    return await ps.get_post_images(db, post_id)
 
 
 @router.delete("/{post_id}/image/{url:path}", status_code=st.HTTP_204_NO_CONTENT)
-@app.state.limiter.limit("10/minute")
+@limiter.limit("10/minute")
 async def delete_post_image(db: db_dependency, user: user_dependency, request: Request, post_id: int = Path(ge=0), url: str = Path(...)):
-    ps.delete_post_image(db, user, post_id, url)
+    await ps.delete_post_image(db, user, post_id, url)
 
 
 @router.post("/{post_id}/vote/", response_model=VoteResponse, status_code=st.HTTP_201_CREATED)
-@app.state.limiter.limit("30/minute")
+@limiter.limit("30/minute")
 async def vote(db: db_dependency, user: user_dependency, request: Request, post_id: int = Path(ge=0), vote_type: VoteType = Query(...)):
-    return ps.vote(db, user, post_id, vote_type)
+    return await ps.vote(db, user, post_id, vote_type)
@@ -0,0 +1,128 @@
+import asyncio
+from typing import List
+
+import orjson
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect, status as st
+from fastapi.responses import StreamingResponse
+from slowapi.util import get_remote_address
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+
+import rate_limit
+from rate_limit import limiter
+from services import realtime
+from broadcast import Subscription, SubscriptionClosed
+from exceptions import TooManyConnectionsError, TooManySubscriptionsError
+
+
+router = APIRouter(prefix="/realtime", tags=["Realtime"])
+
+# How often a comment is sent to idle event streams, so proxies do not close them:
+KEEP_ALIVE_INTERVAL = 15
+
+# The connections a client can open per minute. WebSockets and event streams share the same counter:
+CONNECTION_LIMIT = "30/minute"
+CONNECTION_SCOPE = "realtime"
+
+
+def parse_message(text: str) -> dict:
+    try:
+        message = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        message = None
+    if not isinstance(message, dict): raise ValueError("Messages must be JSON objects")
+    return message
+
+
+def post_ids_from(message: dict, key: str) -> List[int]:
+    post_ids = message.get(key, [])
+    if not isinstance(post_ids, list) or not all(isinstance(post_id, int) and post_id >= 0 for post_id in post_ids):
+        raise ValueError(f"'{key}' must be a list of post IDs")
+    return post_ids
+
+
+async def receive_subscriptions(websocket: WebSocket, subscription: Subscription) -> None:
+    # Messages from the client change its subscriptions, e.g. {"subscribe": [1, 2], "unsubscribe": [3]}:
+    while True:
+        text = await websocket.receive_text()
+        try:
+            message = parse_message(text)
+            await realtime.unsubscribe(subscription, post_ids_from(message, "unsubscribe"))
+            await realtime.subscribe(subscription, post_ids_from(message, "subscribe"))
+        except (ValueError, TooManySubscriptionsError) as e:
+            await websocket.send_json({"type": "error", "detail": getattr(e, "detail", str(e))})
+            continue
+
+        await websocket.send_json({"type": "subscribed", "post_ids": sorted(int(channel.split(":")[1]) for channel in subscription.channels)})
+
+
+async def send_messages(websocket: WebSocket, subscription: Subscription) -> None:
+    while True:
+        await websocket.send_text(await subscription.get())
+
+
+@router.websocket("/ws")
+# Clients connect with the top-level posts they want to follow (e.g. /realtime/ws?post_id=1&post_id=2), and can change
+# them by sending messages. The messages they receive are described in realtime.py:
+async def realtime_websocket(websocket: WebSocket, post_id: List[int] = Query(default=[])):
+    await websocket.accept()
+    # Checked after accepting, so the client receives the reason it was closed:
+    if not rate_limit.hit(CONNECTION_LIMIT, get_remote_address(websocket), CONNECTION_SCOPE):
+        await websocket.close(code=st.WS_1008_POLICY_VIOLATION, reason="Rate limit exceeded")
+        return
+    try:
+        subscription = realtime.subscription()
+    except TooManyConnectionsError as e:
+        await websocket.close(code=st.WS_1013_TRY_AGAIN_LATER, reason=e.detail)
+        return
+
+    tasks = []
+    try:
+        await realtime.subscribe(subscription, post_id)
+        tasks = [asyncio.create_task(receive_subscriptions(websocket, subscription)),
+                 asyncio.create_task(send_messages(websocket, subscription))]
+        # Running until the client disconnects (or falls too far behind):
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done: task.result()
+
+    except TooManySubscriptionsError as e:
+        await websocket.close(code=st.WS_1008_POLICY_VIOLATION, reason=e.detail)
+    except SubscriptionClosed:
+        # The client can connect again, and fetch the posts to catch up:
+        await websocket.close(code=st.WS_1013_TRY_AGAIN_LATER, reason="Too many messages waiting")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks: task.cancel()
+        await realtime.close(subscription)
+
+
+async def event_stream(subscription: Subscription):
+    try:
+        while True:
+            message = await subscription.get(timeout=KEEP_ALIVE_INTERVAL)
+            yield f"data: {message}\n\n" if message is not None else ": keep-alive\n\n"
+    except SubscriptionClosed:
+        # Telling the client to reconnect and catch up (EventSource reconnects automatically):
+        yield "event: closed\ndata: {}\n\n"
+    finally:
+        await realtime.close(subscription)
+
+
+@router.get("/events", status_code=st.HTTP_200_OK)
+@limiter.shared_limit(CONNECTION_LIMIT, scope=CONNECTION_SCOPE)
+# Server-sent events, for clients that cannot use WebSockets (e.g. new EventSource("/realtime/events?post_id=1")).
+# Following different posts requires a new connection:
+async def realtime_events(request: Request, post_id: List[int] = Query(default=[])):
+    subscription = realtime.subscription()
+    try:
+        await realtime.subscribe(subscription, post_id)
+    except TooManySubscriptionsError:
+        await realtime.close(subscription)
+        raise
+
+    # The subscription is also closed after the response (in case the client disconnected before the stream started).
+    # X-Accel-Buffering stops nginx from buffering the events:
+    return StreamingResponse(event_stream(subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(realtime.close, subscription))
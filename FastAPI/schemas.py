@@ -23,10 +23,25 @@ class UpdateUserPasswordRequest(BaseModel):
     new_password: str = Field(min_length=6, max_length=100)
 
 
+class UpdateUserRoleRequest(BaseModel):
+    role: Role
+
+
+
+class ImageRenditionResponse(BaseModel):
+    name: str
+    format: str
+    width: int
+    height: int
+    url: str
+
 
 class ImageResponse(BaseModel):
     url: str
 
+    # Resized versions of the image (in the original format and WebP), so clients can use the smallest one that fits:
+    renditions: Optional[List[ImageRenditionResponse]] = None
+
     @classmethod
     def from_orm(cls, image):
         return cls(url=image.full_url)
@@ -99,6 +114,9 @@ class PostResponse(BaseModel):
 
     current_user_vote: Optional[VoteType] = None
 
+    # Present if the post has more replies than were returned, used to load them from /post/{id}/comments:
+    replies_cursor: Optional[str] = None
+
     class Config: 
         from_attributes = True
 
@@ -1,15 +1,79 @@
 import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 from fastapi import File, UploadFile
 from passlib.context import CryptContext
 from jose import jwt
 
+from exceptions import ServiceBusyError
+from metrics import LatencyStats
+
 
 # Indicating that we want to use the bcrypt hashing algorithm:
 # Setting deprecated to "auto" means that any password hashes that are not using bcrypt will be automatically updated:
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Hashing (or verifying) a password with bcrypt takes a few hundred milliseconds of CPU time by design.
+# Doing it on the event loop would stop every other request from being handled in the meantime,
+# so it is done on a dedicated pool of threads (bcrypt releases the GIL while hashing, so the threads run in parallel).
+HASH_WORKERS = int(os.getenv("HASH_WORKERS") or os.cpu_count() or 1)
+# The number of hashes that can be waiting for a thread. Beyond that, requests are rejected straight away (with a 503)
+# rather than waiting for longer than a client would:
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT") or HASH_WORKERS * 4)
+
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+class HashingMetrics:
+    def __init__(self):
+        # The number of hashes running or waiting for a thread:
+        self.in_flight = 0
+        self.rejected = 0
+        # The time spent waiting for a thread, and the time spent hashing:
+        self.queue_wait = LatencyStats()
+        self.latency = LatencyStats()
+
+    def summary(self) -> dict:
+        return {"workers": HASH_WORKERS, "queue_limit": HASH_QUEUE_LIMIT, "in_flight": self.in_flight,
+                "rejected": self.rejected, "queue_wait": self.queue_wait.summary(), "latency": self.latency.summary()}
+
+
+hashing_metrics = HashingMetrics()
+
+
+async def run_hashing(function, *args):
+    # Runs a hashing function on the hashing threads, unless too many are already waiting:
+    if hashing_metrics.in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        hashing_metrics.rejected += 1
+        raise ServiceBusyError
+
+    def timed_function():
+        started_at = time.perf_counter()
+        return function(*args), started_at, time.perf_counter()
+
+    hashing_metrics.in_flight += 1
+    queued_at = time.perf_counter()
+    try:
+        result, started_at, finished_at = await asyncio.get_running_loop().run_in_executor(hash_executor, timed_function)
+    finally:
+        hashing_metrics.in_flight -= 1
+
+    # Recording the times on the event loop (rather than in the threads), so the metrics are only updated by one thread:
+    hashing_metrics.queue_wait.record(started_at - queued_at)
+    hashing_metrics.latency.record(finished_at - started_at)
+    return result
+
+
+async def hash_password(password: str) -> str:
+    return await run_hashing(bcrypt_context.hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await run_hashing(bcrypt_context.verify, password, password_hash)
+
 
 # A JWT needs an algorithm and secret key:
 # Secret key should be a random string. This was generated using openssl rand -hex 32:
@@ -38,7 +102,7 @@ def create_access_token(user_id: int, ttl: timedelta = TOKEN_TTL) -> str:
 
 def check_for_malware(image: UploadFile = File(...)):
     # TODO: Malware scanning with ClamAV
-    # TODO: Check for size (large files should not be uploaded)
+    # The size is limited by UploadSizeLimitMiddleware and image_service.save_file.
     # If check fails, raise exception.
     pass
 
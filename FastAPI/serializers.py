@@ -0,0 +1,80 @@
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, List, Optional, Type
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+from config import get_settings
+from schemas import ImageRenditionResponse, ImageResponse, UserResponse, PostResponse
+
+
+# Returning ORM objects from a route makes FastAPI validate them into the response model (PostResponse), one object
+# and one field at a time, then encode the result. For a feed of posts with their comment trees, this takes most of
+# the time spent handling the request.
+# The objects have already been loaded from the database, so they do not need validating. Instead, the serializers
+# below copy the fields of the response models straight into dicts, which are encoded by orjson.
+#
+# The serializers are built once, from the fields of the response models (so they return the same fields as the models).
+# Setting fast_serialization to false in config.json uses the response models instead (e.g. to compare the responses).
+
+Serializer = Callable[[Any], Optional[dict]]
+
+
+def compile_serializer(schema: Type[BaseModel], nested: Dict[str, Serializer] = {}, from_dict: bool = False) -> Serializer:
+    # Returns a function converting an object (or a dict, if from_dict is true) to a dict with the fields of the schema.
+    # 'nested' gives the serializers of the fields that hold other objects.
+    fields = schema.model_fields
+    # Fields that every object has are read with a single call. Fields with defaults may not be set on the object:
+    names = [name for name, field in fields.items() if name in nested or field.is_required()]
+    defaults = {name: field.default for name, field in fields.items() if name not in nested and not field.is_required()}
+
+    # The values of database objects are read from the object's __dict__ (where SQLAlchemy stores the loaded values),
+    # which is much faster than reading each attribute:
+    get_values, read_values = itemgetter(*names), attrgetter(*names)
+    # A getter for a single field returns its value, rather than a tuple of values:
+    if len(names) == 1: get_values, read_values = (lambda values: (values[names[0]],)), (lambda instance: (getattr(instance, names[0]),))
+
+    def serialize(instance: Any) -> Optional[dict]:
+        if instance is None: return None
+
+        values = instance if from_dict else instance.__dict__
+        try:
+            data = dict(zip(names, get_values(values)))
+        except KeyError:
+            if from_dict: raise
+            # An attribute has not been loaded, so the attributes are read from the object (which loads it):
+            data = dict(zip(names, read_values(instance)))
+
+        for name, default in defaults.items(): data[name] = values.get(name, default)
+        for name, serializer in nested.items(): data[name] = serializer(data[name])
+        return data
+
+    return serialize
+
+
+def many(serializer: Serializer) -> Callable[[Optional[list]], Optional[List[dict]]]:
+    return lambda instances: [serializer(instance) for instance in instances] if instances is not None else None
+
+
+serialize_rendition = compile_serializer(ImageRenditionResponse, from_dict=True)
+serialize_image = compile_serializer(ImageResponse, nested={"renditions": many(serialize_rendition)})
+serialize_user = compile_serializer(UserResponse, nested={"profile_image": serialize_image})
+# The replies are serialized by the same serializer (which is looked up when it is called, since it is not defined yet):
+serialize_post = compile_serializer(PostResponse, nested={
+    "comments": many(lambda comment: serialize_post(comment)),
+    "images": many(serialize_image),
+    "author": serialize_user,
+})
+
+
+def serialize_posts(posts: list) -> List[dict]:
+    # Returns the content of the response for the posts (and their comment trees):
+    if get_settings().fast_serialization: return [serialize_post(post) for post in posts]
+    return [PostResponse.model_validate(post).model_dump(mode="json") for post in posts]
+
+
+def posts_response(content: List[dict], next_cursor: Optional[str] = None, single: bool = False) -> ORJSONResponse:
+    # Returned by the routes as it is (FastAPI does not validate responses that are returned directly):
+    response = ORJSONResponse(content[0] if single else content)
+    if next_cursor: response.headers["X-Next-Cursor"] = next_cursor
+    return response
@@ -0,0 +1,119 @@
+import asyncio
+from typing import List, Optional
+
+import aiofiles.os
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+from models import Image
+
+
+# Deleting a post (and its replies) can release many image files. Rather than deleting them while the client waits,
+# they are added to a queue, and a background task deletes them after the response has been sent.
+# A file that cannot be deleted (e.g. because of a temporary storage error) is tried again later, waiting twice as long
+# after each failure, up to MAX_ATTEMPTS times.
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+
+class CleanupItem:
+    def __init__(self, paths: List[str], content_hash: Optional[str]):
+        # The files of an image (the image and its renditions), which share the image's content hash:
+        self.paths = paths
+        self.content_hash = content_hash
+        self.attempts = 0
+
+
+class FileCleanupQueue:
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, retry_delay: float = RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self.queue = None
+        self.task = None
+        self.loop = None
+        # The items that have not been finished with (including those waiting to be tried again):
+        self.pending = 0
+        self.idle = None
+
+        self.deleted = 0
+        self.retries = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        # Started when the first files are added (so it runs on the event loop that serves the requests).
+        # If the event loop has changed (e.g. between tests), the items queued on the previous one are lost:
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.pending = 0
+        self.task = self.loop.create_task(self.run())
+
+    def add(self, paths: List[str], content_hash: Optional[str] = None) -> None:
+        if self.task is None or self.task.done() or self.loop is not asyncio.get_running_loop(): self.start()
+        self.pending += 1
+        self.idle.clear()
+        self.queue.put_nowait(CleanupItem(paths, content_hash))
+
+    async def run(self) -> None:
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.clean(item)
+            except Exception as e:
+                self.retry(item, e)
+            else:
+                self.finish()
+
+    async def still_referenced(self, content_hash: Optional[str]) -> bool:
+        # The files are shared by every image record with the same content, so they are only deleted if no record
+        # references them. This is checked just before deleting them, since an image with the same content may have
+        # been uploaded after the files were added to the queue.
+        # Images stored before content addressing have unique files, so they are always deleted:
+        if content_hash is None: return False
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(select(Image.id).where(Image.content_hash == content_hash).limit(1))).first() is not None
+
+    async def clean(self, item: CleanupItem) -> None:
+        if await self.still_referenced(item.content_hash): return
+
+        remaining = []
+        for path in item.paths:
+            try:
+                await aiofiles.os.remove(path)
+                self.deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Failed to delete {path}: {e}")
+                remaining.append(path)
+
+        # Only trying the files that were not deleted again:
+        item.paths = remaining
+        if remaining: raise OSError(f"{len(remaining)} files could not be deleted")
+
+    def retry(self, item: CleanupItem, error: Exception) -> None:
+        item.attempts += 1
+        if item.attempts >= self.max_attempts:
+            print(f"Giving up on deleting {item.paths} after {item.attempts} attempts: {error}")
+            self.failed += 1
+            self.finish()
+            return
+
+        self.retries += 1
+        asyncio.get_running_loop().call_later(self.retry_delay * 2 ** (item.attempts - 1), self.queue.put_nowait, item)
+
+    def finish(self) -> None:
+        self.pending -= 1
+        if self.pending == 0: self.idle.set()
+
+    async def join(self) -> None:
+        # Waits until every file added so far has been deleted (or given up on), e.g. before shutting down:
+        if self.idle is not None: await self.idle.wait()
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "deleted": self.deleted, "retries": self.retries, "failed": self.failed}
+
+
+file_cleanup = FileCleanupQueue()
@@ -0,0 +1,87 @@
+# Image decoding, resizing and encoding is CPU bound, so it is run in worker processes (see image_service.py),
+# rather than on the event loop.
+# This module only depends on Pillow, so that it is quick to import in the worker processes.
+import os
+
+from PIL import Image, ImageOps
+
+
+# Every rendition is also saved as WebP, which is typically much smaller than the original format:
+WEBP_FORMAT = "WEBP"
+WEBP_QUALITY = 80
+
+# The formats that uploads are decoded as, and the extension their files are stored with. The extension is never taken
+# from the uploaded file's name (which the client chooses), since it sets the content type the file is served with:
+FORMAT_EXTENSIONS = {"JPEG": ".jpeg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp", "BMP": ".bmp"}
+
+
+def rendition_path(path: str, name: str, extension: str) -> str:
+    # e.g. images/<hash>.jpeg -> images/<hash>_thumbnail.webp
+    return f"{os.path.splitext(path)[0]}_{name}{extension}"
+
+
+def render_image(source: str, destination: str, staging: str, sizes: dict, max_pixels: int, full_size_name: str) -> tuple:
+    # Creates a resized copy of the uploaded image (at source) for each of the given {name: maximum dimension} sizes,
+    # in both the original format and WebP. The full size rendition in the original format is stored at destination
+    # (the URL of the image without its extension, which is added for the decoded format), and the others next to it.
+    # The files are saved in the staging directory (which is not served), so nothing appears at the image's URLs until
+    # every rendition has been created. Returns the image's URL, the details of each rendition, and the
+    # (staged path, final path) of each file, to be moved into place by the caller.
+    renditions, files = [], []
+    prefix = os.path.join(staging, os.path.splitext(os.path.basename(source))[0])
+
+    def save(image, path: str, **kwargs) -> None:
+        staged_path = f"{prefix}_{os.path.basename(path)}"
+        image.save(staged_path, **kwargs)
+        files.append((staged_path, path))
+
+    try:
+        # Only the supported formats are tried, so other files are rejected without being decoded:
+        with Image.open(source, formats=list(FORMAT_EXTENSIONS)) as img:
+            # Opening an image only reads its header, so the size can be checked before decoding it.
+            # This prevents "decompression bombs" (small files that decode to huge images) from using all the memory:
+            if img.width * img.height > max_pixels:
+                raise ValueError(f"Image has too many pixels ({img.width}x{img.height})")
+
+            original_format = img.format
+            extension = FORMAT_EXTENSIONS[original_format]
+            destination += extension
+
+            # JPEGs can be decoded at a reduced scale (1/2, 1/4 or 1/8), which is much faster than decoding the full image.
+            # The scale chosen is the smallest that is still at least as large as the largest rendition.
+            # This has no effect for other formats:
+            largest = max(sizes.values())
+            img.draft(img.mode, (largest, largest))
+
+            # Automatically correcting the orientation from EXIF data:
+            rendition = ImageOps.exif_transpose(img)
+
+            # Resizing from largest to smallest, so each rendition is resized from the previous one (rather than the original):
+            for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+                # Resizing the image while preserving the aspect ratio:
+                rendition = rendition.copy()
+                rendition.thumbnail((size, size))
+
+                original_path = destination if name == full_size_name else rendition_path(destination, name, extension)
+                save(rendition, original_path, format=original_format, optimize=True)
+                renditions.append({"name": name, "format": original_format.lower(), "width": rendition.width,
+                                   "height": rendition.height, "url": original_path})
+
+                if original_format != WEBP_FORMAT:
+                    # WebP supports RGB(A) images only (i.e. not palette or CMYK images):
+                    webp = rendition
+                    if webp.mode not in ("RGB", "RGBA"):
+                        has_alpha = "A" in webp.getbands() or "transparency" in webp.info
+                        webp = webp.convert("RGBA" if has_alpha else "RGB")
+                    webp_path = rendition_path(destination, name, ".webp")
+                    save(webp, webp_path, format=WEBP_FORMAT, quality=WEBP_QUALITY)
+                    renditions.append({"name": name, "format": WEBP_FORMAT.lower(), "width": rendition.width,
+                                       "height": rendition.height, "url": webp_path})
+
+    except BaseException:
+        # Removing the files saved before the failure:
+        for staged_path, _ in files:
+            if os.path.exists(staged_path): os.remove(staged_path)
+        raise
+
+    return destination, renditions, files
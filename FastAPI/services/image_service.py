@@ -1,67 +1,208 @@
 import os
 import uuid
-from PIL import Image, ImageOps
-
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import aiofiles
+import aiofiles.os
 from fastapi import File, UploadFile
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from security import check_for_malware
-from config import read_config
-from exceptions import UnsupportedFileTypeError, UnableToProcessInputError
+from config import get_settings
+from exceptions import UnsupportedFileTypeError, UnableToProcessInputError, FileTooLargeError
+from models import Image
+from services.file_cleanup import file_cleanup
 
-# The directory where the images for posts are saved (ran when the module is imported from main):
-IMAGE_DIRECTORY = read_config("image_directory")
+# The directory where the images for posts are saved (ran when the module is imported from main).
+# It is mounted by main.py, so changing it requires a restart:
+IMAGE_DIRECTORY = get_settings().image_directory
 
-# The image MIME (content) types that are allowed:
-IMAGE_MIME_TYPES = read_config("image_mime_types")
+# Uploads and their renditions are saved here until they have been processed, outside of the image directory, so that
+# only complete, processed files are ever served. It must be on the same file system as the image directory, so files
+# can be moved from one to the other by renaming them:
+UPLOAD_DIRECTORY = get_settings().upload_directory
 
-# Maximum dimension for compressed images:
-COMPRESSION_DIMENSION = read_config("compression_size")
+# Images are stored under the hash of their content, in nested subdirectories named after the start of the hash,
+# e.g. images/ab/cd/abcd....jpeg, so that no directory holds too many files (which slows down lookups and listings).
+# Two levels of 2 hex characters give 65,536 directories:
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
 
+# The allowed image MIME (content) types, the maximum upload size and the image sizes are read from the settings
+# for each upload (rather than here), so that they can be changed without a restart.
 
-def save_file(upload_file: UploadFile) -> str:
-    # Generating a unique filename for the uploaded file:
-    file_uuid = uuid.uuid4()
-    file_url = os.path.join(IMAGE_DIRECTORY, f"{file_uuid}{os.path.splitext(upload_file.filename)[1]}")
+# Uploads are copied in chunks of this size, so the memory used does not depend on the size of the file:
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-    with open(file_url, "wb") as file_object:
-        file_object.write(upload_file.file.read())
+# The name of the rendition that is stored at the image's URL:
+FULL_SIZE = "full"
 
-    return file_url
 
+def rendition_sizes() -> dict:
+    # The maximum dimension of each rendition of an image, so that clients can use the smallest one that fits:
+    settings = get_settings()
+    return {**settings.rendition_sizes, FULL_SIZE: settings.compression_size}
 
-def compress_image(url: str) -> str:
-    img = Image.open(url)
-    
-    # Automatically correcting the orientation from EXIF data:
-    img = ImageOps.exif_transpose(img)
-    
-    # Resizing the image while preserving the aspect ratio:
-    img.thumbnail((COMPRESSION_DIMENSION, COMPRESSION_DIMENSION))
-    
-    img.save(url, optimize=True)
 
-    return url
+# The number of worker processes for image processing, and the number of images that can be waiting for or being
+# processed at once. Further uploads wait until there is space, so a burst of uploads cannot exhaust the memory:
+IMAGE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+IMAGE_QUEUE_LIMIT = IMAGE_WORKERS * 2
 
+# Created when the first image is processed, so importing the module does not start any processes:
+image_pool = None
+image_queue_slots = asyncio.Semaphore(IMAGE_QUEUE_LIMIT)
+
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global image_pool
+    if image_pool is None:
+        # Using "spawn" rather than forking the server process (along with its event loop and database connections):
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return image_pool
+
+
+def shutdown_image_pool() -> None:
+    # Called when the app shuts down, waiting for the images being processed to finish:
+    global image_pool
+    if image_pool is not None:
+        image_pool.shutdown(wait=True, cancel_futures=True)
+        image_pool = None
+
+
+def content_path(content_hash: str) -> str:
+    # e.g. abcd... -> images/ab/cd/abcd... (the extension is added once the image's format is known):
+    shards = [content_hash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(IMAGE_DIRECTORY, *shards, content_hash)
+
+
+async def save_file(upload_file: UploadFile) -> Tuple[str, str]:
+    # Saves the upload to a temporary file, returning its path and the SHA-256 hash of its content.
+    # The final path depends on the hash, so is only known once the whole file has been read.
+    temp_url = os.path.join(UPLOAD_DIRECTORY, f"{uuid.uuid4()}.part")
+
+    content_hash = hashlib.sha256()
+    size = 0
+    max_upload_size = get_settings().max_upload_size
+
+    try:
+        # Creating the upload directory if needed (the app's startup also creates it, but it is not run in every case,
+        # e.g. when the app is called directly by a benchmark):
+        await aiofiles.os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+
+        # Writing the file asynchronously, a chunk at a time, and stopping as soon as it is too large:
+        async with aiofiles.open(temp_url, "wb") as file_object:
+            while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_upload_size: raise FileTooLargeError
+
+                content_hash.update(chunk)
+                await file_object.write(chunk)
+
+    except BaseException:
+        if os.path.exists(temp_url): os.remove(temp_url)
+        raise
+
+    return temp_url, content_hash.hexdigest()
+
+
+async def store_files(files: list, url: str) -> None:
+    # Moves the processed files of an image from the upload directory to their URLs.
+    # Renaming is atomic, so each file appears at its URL complete. The image itself is moved last,
+    # so its renditions are already in place when it appears:
+    await aiofiles.os.makedirs(os.path.dirname(url), exist_ok=True)
+    try:
+        for staged_path, path in sorted(files, key=lambda file: file[1] == url): await aiofiles.os.replace(staged_path, path)
+    finally:
+        # Removing any files that were not moved (e.g. if a move failed):
+        for staged_path, _ in files:
+            if os.path.exists(staged_path): os.remove(staged_path)
+
+
+async def find_stored_image(db: AsyncSession, content_hash: str) -> dict:
+    # Returns the fields of an existing image record with the same content, if its files are still present:
+    existing = (await db.execute(
+        select(Image.url, Image.renditions).where(Image.content_hash == content_hash).limit(1)
+    )).first()
+
+    # The files could have just been deleted along with the last record that referenced them,
+    # in which case the image is processed again:
+    if existing is None or not all(os.path.exists(path) for path in image_files(existing)): return None
+    return {"url": existing.url, "renditions": existing.renditions, "content_hash": content_hash}
+
+
+async def compress_image(temp_url: str, url: str) -> tuple:
+    # Creating the renditions of the upload at temp_url (for the image at url, without its extension) in a worker process,
+    # so the event loop is not blocked. Returns the URL (with the extension of the decoded format), renditions and files.
+    # Imported here rather than at the top, so Pillow is only loaded by the server once an image is uploaded
+    # (it is needed to pass the function to the worker processes), rather than whenever a worker starts:
+    from services.image_processing import render_image
+
+    async with image_queue_slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            get_image_pool(), render_image, temp_url, url, UPLOAD_DIRECTORY, rendition_sizes(), get_settings().max_image_pixels, FULL_SIZE
+        )
+
+
+def image_files(image) -> list:
+    # The paths of all the files of an image record (the image itself and its renditions):
+    return [image.url, *(rendition["url"] for rendition in image.renditions or [] if rendition["url"] != image.url)]
+
+
+def release_image_files(images: list) -> None:
+    # Deletes the files of image records that have been deleted, unless other records still reference them.
+    # The files are shared by every record with the same content, so the records are the reference count.
+    # This must be called after the deletion of the records has been committed.
+    # The files are deleted in the background, after checking that they are no longer referenced (see file_cleanup.py):
+    for image in images: file_cleanup.add(image_files(image), image.content_hash)
+
+
+async def create_image(db: AsyncSession, image: UploadFile = File(...)) -> dict: 
+    # Returns the fields of the image record (the URL, renditions and content hash):
+    temp_url = None
+
+    settings = get_settings()
 
-async def create_image(image: UploadFile = File(...)) -> str: 
-    
     try:    
         # Checking if the uploaded file is of an allowed image type:
-        if image.content_type not in IMAGE_MIME_TYPES:
+        if image.content_type not in settings.image_mime_types:
             raise UnsupportedFileTypeError()
 
+        # Rejecting files that are too large before reading them (the size is known once the upload has been received):
+        if image.size is not None and image.size > settings.max_upload_size:
+            raise FileTooLargeError()
+
         # Saving the image:
-        url = save_file(image)
+        temp_url, content_hash = await save_file(image)
+
+        # If the same image has already been uploaded, its files (and renditions) are shared, skipping the processing:
+        stored_image = await find_stored_image(db, content_hash)
+        if stored_image is not None: return stored_image
 
         # Checking for malware in the image file:
         check_for_malware(image)
 
-        # Compressing the image:
-        url = compress_image(url)
+        # Compressing the image from the upload, then moving the renditions to the image's URLs.
+        # The upload itself is never served (the full size rendition replaces it):
+        # The extension is set from the format the image was decoded as:
+        url, renditions, files = await compress_image(temp_url, content_path(content_hash))
+        await store_files(files, url)
 
-        return url
+        return {"url": url, "renditions": renditions, "content_hash": content_hash}
+
+    except FileTooLargeError:
+        raise
     
     except Exception as e:
         print(f"Error occurred: {e}")
 
-        raise UnableToProcessInputError() from e
\ No newline at end of file
+        raise UnableToProcessInputError() from e
+
+    finally:
+        # Removing the upload, which has been processed (or was a duplicate):
+        if temp_url is not None and os.path.exists(temp_url): os.remove(temp_url)
@@ -1,15 +1,31 @@
-import os
-from typing import List, Optional
+import datetime
+from typing import List, Optional, Tuple
 
 from fastapi import File, UploadFile, status as st
+from sqlalchemy import select, update, delete, tuple_, literal, or_, Float
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
 from dependencies import db_dependency, user_dependency, optional_user_dependency
 from schemas import CreatePostRequest, UpdatePostRequest, PostResponse, VoteResponse
 from models import Post, Image, User, Vote
 from enums import VoteType, Order
-from services.utils import order_query
-from services.image_service import create_image
-from exceptions import PostNotFoundError, UnauthorizedAccessError, ImageNotFoundError
+from services.utils import (order_query, after_cursor_query, comment_tree_query, encode_cursor, decode_cursor, encode_post_cursor,
+                            child_path, path_ids, descendants_filter, insert_ignoring_conflicts)
+from services.image_service import create_image, release_image_files
+from services.search_service import title_filter, author_filter, search_scores_query
+from services.response_cache import invalidate_post
+from services import realtime
+from services.ranking import score_values, score_expressions
+from exceptions import PostNotFoundError, UnauthorizedAccessError, ImageNotFoundError, InvalidCursorError
+
+# The default number of comment levels returned below a post, and replies returned per comment.
+# Deeper or wider threads are continued using the 'replies_cursor' of the comment:
+COMMENT_MAX_DEPTH = 10
+COMMENT_REPLY_LIMIT = 50
+
+# The default number of posts returned per page of a feed:
+POSTS_PAGE_SIZE = 20
 
 
 def verify_post_ownership(user: user_dependency, post: Post) -> None:
@@ -18,62 +34,157 @@ def verify_post_ownership(user: user_dependency, post: Post) -> None:
 
 
 # Returning 'PostResponse' instead of 'Post' since the model doesn't include current_user_vote:
-def create_post(db: db_dependency, user: user_dependency, post_data: CreatePostRequest) -> PostResponse:
+async def create_post(db: db_dependency, user: user_dependency, post_data: CreatePostRequest) -> PostResponse:
     
+    path = ""
+
     # If the post is a comment, ensuring that the parent post exists:
     if post_data.parent_id is not None: 
-        parent_id = post_data.parent_id
-
-        # Adding 1 to the comment counter of all parent posts:
-        while parent_id is not None:
-            parent = get_post(db, parent_id)
-            parent.comment_count += 1
-            parent_id = parent.parent_id
-
-    new_post = Post(**post_data.dict(), user_id=user.id)
+        parent = (await db.execute(select(Post.id, Post.path).filter_by(id=post_data.parent_id))).first()
+        if parent is None: raise PostNotFoundError
+        path = child_path(parent)
+
+        # Adding 1 to the comment counter of all parent posts, using a single statement.
+        # The increment is done by the database, so concurrent replies are all counted:
+        await db.execute(update(Post).where(Post.id.in_(path_ids(path))).values(comment_count=Post.comment_count + 1)
+                         .execution_options(synchronize_session=False))
+
+    # The user is automatically upvotes their post (saved in the same transaction as the post):
+    # The creation time is set here (rather than by the database) since the post's scores depend on it.
+    # Stored in UTC, to the second (the precision SQLite stores):
+    created_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    new_post = Post(**post_data.dict(), user_id=user.id, path=path, upvote_count=1, created_at=created_at,
+                    **score_values(1, 0, created_at))
+    new_post.votes.append(Vote(user_id=user.id, vote_type=VoteType.UP))
     db.add(new_post)
-    db.commit()
-    db.refresh(new_post)
+    await db.commit()
+    await invalidate_post(new_post.id, path, new_post.parent_id, feeds=True)
 
-    # The user is automatically upvotes their post:
-    vote(db, user, new_post.id, VoteType.UP)
+    # A new post has no comments or images, so there is no need to query them:
+    set_committed_value(new_post, "comments", [])
+    set_committed_value(new_post, "images", [])
+    set_committed_value(new_post, "author", user)
     new_post.current_user_vote = VoteType.UP
 
+    # Sending the reply to the clients following the thread:
+    await realtime.post_created(new_post)
+
     return new_post
 
 
-# Recursively populates the 'current_user_vote' field of the post and comments
-def populate_current_user_votes(db: db_dependency, user: user_dependency, post: Post):
-    vote = db.query(Vote).filter_by(post_id=post.id, user_id=user.id).first()
-    post.current_user_vote = vote.vote_type if vote else None
+# Populates the 'current_user_vote' field of the posts and all of their comments.
+# The votes for the whole response are found using one query, rather than one per post:
+async def populate_current_user_votes(db: db_dependency, user: user_dependency, posts: List[Post]) -> None:
+    # Collecting every post in the trees:
+    nodes, stack = [], list(posts)
+    while stack:
+        post = stack.pop()
+        nodes.append(post)
+        stack.extend(post.comments)
 
-    for comment in post.comments:
-        populate_current_user_votes(db, user, comment)
+    if not nodes: return
 
+    post_ids = {post.id for post in nodes}
+    rows = await db.execute(select(Vote.post_id, Vote.vote_type).where(Vote.user_id == user.id, Vote.post_id.in_(post_ids)))
+    votes = dict(rows.all())
 
-def get_post(db: db_dependency, post_id: int, user: optional_user_dependency = None) -> PostResponse:
-    # Retrieving the post based on its ID:
-    post = db.query(Post).filter_by(id=post_id).first()
+    for post in nodes:
+        post.current_user_vote = votes.get(post.id)
+
+
+async def load_comment_trees(db: db_dependency, posts: List[Post], max_depth: int = COMMENT_MAX_DEPTH,
+                             reply_limit: int = COMMENT_REPLY_LIMIT, after_id: int = None) -> None:
+    # Loads the comments of all the given posts using a single query, and assembles the trees in memory.
+    # Setting 'comments' on each post means serialization does not query each comment's replies separately.
+    # If after_id is given, the replies of the (single) post continue after that reply.
+
+    for post in posts: post.replies_cursor = None
+
+    # Rows are ordered by depth, so a comment is always reached after its parent:
+    rows = (await db.execute(comment_tree_query([post.id for post in posts], max_depth, reply_limit, after_id))).all() if max_depth > 0 else []
+
+    nodes = {post.id: post for post in posts}
+    children = {post.id: [] for post in posts}
+    depths = {post.id: 0 for post in posts}
+
+    for comment, depth, siblings in rows:
+        # Skipping replies whose parent was not returned (over the reply limit),
+        # and comments already placed (which happens if one of the posts is a comment on another):
+        if comment.parent_id not in children or comment.id in nodes: continue
+
+        nodes[comment.id] = comment
+        children[comment.id] = []
+        depths[comment.id] = depth
+        children[comment.parent_id].append(comment)
+
+        # If the parent has more replies than were returned, continuing after the last one returned:
+        if siblings > reply_limit and len(children[comment.parent_id]) == reply_limit:
+            nodes[comment.parent_id].replies_cursor = encode_cursor({"parent_id": comment.parent_id, "after_id": comment.id})
+
+    for post_id, node in nodes.items():
+        set_committed_value(node, "comments", children[post_id])
+
+        # Comments at the maximum depth which have replies can be continued from their first reply:
+        if depths[post_id] == max_depth and node.comment_count:
+            node.replies_cursor = encode_cursor({"parent_id": post_id, "after_id": None})
+
+
+# Retrieves a post by ID, without its comments (used when the comments are not returned):
+async def fetch_post(db: db_dependency, post_id: int) -> Post:
+    post = (await db.execute(select(Post).filter_by(id=post_id))).scalars().first()
 
     # Ensuring the post exists:
     if post is None: raise PostNotFoundError
-    if user: populate_current_user_votes(db, user, post)
+    return post
+
+
+async def get_post(db: db_dependency, post_id: int, user: optional_user_dependency = None,
+                   max_depth: int = COMMENT_MAX_DEPTH, reply_limit: int = COMMENT_REPLY_LIMIT) -> PostResponse:
+    # Retrieving the post based on its ID:
+    post = await fetch_post(db, post_id)
+
+    await load_comment_trees(db, [post], max_depth, reply_limit)
+    if user: await populate_current_user_votes(db, user, [post])
 
     return post
 
 
-def get_posts(db: db_dependency, user: optional_user_dependency = None,  user_id: int = None, user_vote: VoteType = None,
-              username: str = None, title: str = None, parent_id: int = None, order_by: Order = Order.DATE, show_comments=False) -> List[PostResponse]:
+async def get_comments(db: db_dependency, post_id: int, user: optional_user_dependency = None, cursor: Optional[str] = None,
+                       max_depth: int = COMMENT_MAX_DEPTH, reply_limit: int = COMMENT_REPLY_LIMIT) -> Tuple[List[PostResponse], Optional[str]]:
+    # Returns a page of replies to a post, and the cursor for the next page (if there are more replies).
+    after_id = None
+    if cursor:
+        position = decode_cursor(cursor)
+        # The cursor must have been issued for this post:
+        if position.get("parent_id") != post_id: raise InvalidCursorError
+        after_id = position.get("after_id")
+        if after_id is not None and not isinstance(after_id, int): raise InvalidCursorError
+
+    # The post itself is not returned, it is the root of the tree being loaded:
+    post = await fetch_post(db, post_id)
+    await load_comment_trees(db, [post], max_depth, reply_limit, after_id)
+
+    if user: await populate_current_user_votes(db, user, post.comments)
+
+    return post.comments, post.replies_cursor
+
+
+async def get_posts(db: db_dependency, user: optional_user_dependency = None,  user_id: int = None, user_vote: VoteType = None,
+              username: str = None, title: str = None, parent_id: int = None, order_by: Order = Order.DATE, show_comments=False,
+              max_depth: int = COMMENT_MAX_DEPTH, reply_limit: int = COMMENT_REPLY_LIMIT,
+              cursor: Optional[str] = None, limit: int = POSTS_PAGE_SIZE) -> Tuple[List[PostResponse], Optional[str]]:
+    # Returns a page of posts, and the cursor for the next page (if there are more posts).
     
-    query = db.query(Post).join(User)
+    query = select(Post).join(User)
 
     if user and user_vote:
-        # Querying the post_id column of Vote, where vote_type=user_vote
-        # 'subquery' allows us to use the result in a different query (is more efficient for this):
-        post_ids_subquery = db.query(Vote.post_id).filter(Vote.user_id == user.id, Vote.vote_type == user_vote).subquery()
+        # Querying the post_id column of Vote, where vote_type=user_vote.
+        # The select is passed to 'in_' as it is, which makes it a subquery of the statement (without another round trip):
+        voted_post_ids = select(Vote.post_id).filter(Vote.user_id == user.id, Vote.vote_type == user_vote)
         
         # 'in_' method works similarly to [post_id for post_id in post_ids]
-        query = db.query(Post).filter(Post.id.in_(post_ids_subquery))
+        # The query keeps its join to the users table, which the username filter relies on:
+        query = query.filter(Post.id.in_(voted_post_ids))
 
         # Slower alternative:
         # votes = db.query(Vote).filter_by(vote_type=user_vote).all()
@@ -82,123 +193,189 @@ def get_posts(db: db_dependency, user: optional_user_dependency = None,  user_id
 
 
     if user_id: query = query.filter(Post.user_id == user_id)
-    # The 'ilike' function allows for case insensitive search, and the '%' signs are wildcards:
-    if username: query = query.filter(User.name.ilike(f"%{username}%"))
-    if title: query = query.filter(Post.title.ilike(f"%{title}%"))
+    # Case insensitive substring searches, which use the search indexes of the database:
+    if username: query = query.filter(author_filter(db.bind.dialect.name, username))
+    if title: query = query.filter(title_filter(db.bind.dialect.name, title))
     if parent_id: query = query.filter(Post.parent_id == parent_id)
 
     if not show_comments: query = query.filter(Post.parent_id == None)
 
 
-    posts = order_query(query, order_by).all()
+    if cursor: query = after_cursor_query(query, order_by, cursor)
+
+    # Fetching one extra post to find out whether there is another page:
+    posts = (await db.execute(order_query(query, order_by).limit(limit + 1))).scalars().all()
+    next_cursor = encode_post_cursor(posts[limit - 1], order_by) if len(posts) > limit else None
+    posts = posts[:limit]
+
+    await load_comment_trees(db, posts, max_depth, reply_limit)
     
-    if user:
-        for post in posts:
-            populate_current_user_votes(db, user, post)
+    if user: await populate_current_user_votes(db, user, posts)
 
-    return posts
+    return posts, next_cursor
 
 
-def update_post(db: db_dependency,user: user_dependency, post_id: int, post_data: UpdatePostRequest) -> None:
-    post = get_post(db, post_id)
+async def search_posts(db: db_dependency, text: str, user: optional_user_dependency = None, show_comments: bool = False,
+                       max_depth: int = COMMENT_MAX_DEPTH, reply_limit: int = COMMENT_REPLY_LIMIT,
+                       cursor: Optional[str] = None, limit: int = POSTS_PAGE_SIZE) -> Tuple[List[PostResponse], Optional[str]]:
+    # Returns a page of the posts matching the search text, most relevant first, and the cursor for the next page.
+    scores = search_scores_query(db.bind.dialect.name, text).subquery()
+    query = select(Post, scores.c.score).join(scores, Post.id == scores.c.id)
+
+    if not show_comments: query = query.filter(Post.parent_id == None)
+
+    if cursor:
+        position = decode_cursor(cursor)
+        # The cursor must have been issued for the same search:
+        if position.get("text") != text or not isinstance(position.get("score"), (int, float)) or not isinstance(position.get("id"), int):
+            raise InvalidCursorError
+        query = query.where(tuple_(scores.c.score, Post.id) < tuple_(literal(position["score"], Float), literal(position["id"])))
+
+    # Fetching one extra post to find out whether there is another page:
+    rows = (await db.execute(query.order_by(scores.c.score.desc(), Post.id.desc()).limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        post, score = rows[limit - 1]
+        next_cursor = encode_cursor({"text": text, "score": score, "id": post.id})
+    posts = [post for post, _ in rows[:limit]]
+
+    await load_comment_trees(db, posts, max_depth, reply_limit)
+    if user: await populate_current_user_votes(db, user, posts)
+
+    return posts, next_cursor
+
+
+async def update_post(db: db_dependency,user: user_dependency, post_id: int, post_data: UpdatePostRequest) -> None:
+    post = await fetch_post(db, post_id)
     verify_post_ownership(user, post)
 
     for key, value in post_data.dict().items():
         setattr(post, key, value)
 
-    db.commit()
+    await db.commit()
+    await invalidate_post(post.id, post.path, post.parent_id)
+    await realtime.post_updated(post)
 
 
-def delete_post(db: db_dependency, user: user_dependency, post_id: int) -> None:
-    post = get_post(db, post_id)
+async def delete_post(db: db_dependency, user: user_dependency, post_id: int) -> None:
+    # Deletes the post and all of its replies with a few set-based statements, rather than loading every reply,
+    # image and vote of the thread into the session and deleting them one at a time.
+    # Only the columns needed are selected (rather than the post with its relationships):
+    post = (await db.execute(select(Post.id, Post.user_id, Post.path, Post.parent_id).filter_by(id=post_id))).first()
+    if post is None: raise PostNotFoundError
     verify_post_ownership(user, post)
-    
-    # Only deleting the images themselves, not the database records (which are cascade deleted):
-    try:
-        for image in post.images:
-            # If the image exists, deleting it:
-            if os.path.exists(image.url): os.remove(image.url)
-    except Exception as e:
-        print(f"Failed to delete one or more image files: {e}")      
 
-    db.delete(post)
-    db.commit()
+    # The post and its descendants (whose paths start with the post's child path, see utils.py):
+    in_thread = or_(Post.id == post.id, descendants_filter(post))
+    thread_ids = select(Post.id).where(in_thread)
+
+    # The rows referencing the posts are deleted first. The deleted images are returned, so their files can be released:
+    await db.execute(delete(Vote).where(Vote.post_id.in_(thread_ids)).execution_options(synchronize_session=False))
+    images = (await db.execute(
+        delete(Image).where(Image.post_id.in_(thread_ids)).returning(Image.url, Image.renditions, Image.content_hash)
+        .execution_options(synchronize_session=False)
+    )).all()
+    deleted = (await db.execute(delete(Post).where(in_thread).execution_options(synchronize_session=False))).rowcount
+
+    # Subtracting the deleted posts from the comment counters of all the ancestors, using a single statement:
+    if post.path:
+        await db.execute(update(Post).where(Post.id.in_(path_ids(post.path))).values(comment_count=Post.comment_count - deleted)
+                         .execution_options(synchronize_session=False))
+
+    await db.commit()
+    await invalidate_post(post.id, post.path, post.parent_id, feeds=True, subtree=True)
+    await realtime.post_deleted(post, deleted)
+
+    # Deleting the images themselves (and their renditions) in the background, unless they are shared with other records:
+    release_image_files(images)
 
 
 async def create_post_image(db: db_dependency, user: user_dependency, post_id: int, image: UploadFile = File(...)) -> Image:
-    url = await create_image(image)
-    post = get_post(db, post_id)
+    image_data = await create_image(db, image)
+    post = await fetch_post(db, post_id)
     verify_post_ownership(user, post)
 
-    image_record = Image(post_id=post_id, url=url)
+    image_record = Image(post_id=post_id, **image_data)
     db.add(image_record)
-    db.commit()
+    await db.commit()
+    await invalidate_post(post.id, post.path, post.parent_id)
 
     return image_record
 
 
-def get_post_images(db: db_dependency, post_id) -> List[Image]:
-    post = get_post(db, post_id)
+async def get_post_images(db: db_dependency, post_id) -> List[Image]:
+    post = await fetch_post(db, post_id)
 
     return post.images
 
 
-def delete_post_image(db: db_dependency, user: user_dependency, post_id: int, url: str) -> None:
-    post = get_post(db, post_id)
+async def delete_post_image(db: db_dependency, user: user_dependency, post_id: int, url: str) -> None:
+    post = await fetch_post(db, post_id)
     verify_post_ownership(user, post)
 
-    image = db.query(Image).filter_by(url=url).first()
+    # Images with the same content share the same URL, so the image must also be one of this post's:
+    image = (await db.execute(select(Image).filter_by(url=url, post_id=post_id))).scalars().first()
     if image is None: raise ImageNotFoundError
 
-    try:
-        db.delete(image)
-        db.commit()
-
-        # If the image exists, deleting it:
-        if os.path.exists(url): os.remove(url)
-    except Exception as e:
-        print(f"Failed to delete one or more image files: {e}")  
-        raise
-
-
-def vote(db: db_dependency, user: user_dependency, post_id: int, vote_type: VoteType) -> VoteResponse:
-    post = get_post(db, post_id)
-    existing_vote = db.query(Vote).filter_by(post_id=post_id, user_id=user.id).first()
-
-    if existing_vote:
-        if existing_vote.vote_type == vote_type:
-            # If the vote type is the same, deleting it and decreasing counter:
-            db.delete(existing_vote)
-            if vote_type == VoteType.UP: post.upvote_count -= 1
-            else: post.downvote_count -= 1
-
-            # User has removed their vote:
-            current_vote = None
-        else:
-            # If it is the opposite vote type, changing it, updating counters:
-            existing_vote.vote_type = vote_type
-            if vote_type == VoteType.UP:
-                # If the vote was down and changed to up:
-                post.upvote_count += 1
-                post.downvote_count -= 1
-            else:
-                post.upvote_count -= 1
-                post.downvote_count += 1
-            
-            # User has changed their vote:
-            current_vote = vote_type
+    await db.delete(image)
+    await db.commit()
+    await invalidate_post(post.id, post.path, post.parent_id)
+
+    # Deleting the image and its renditions in the background, unless they are shared with other records:
+    release_image_files([image])
+
+
+async def vote(db: db_dependency, user: user_dependency, post_id: int, vote_type: VoteType) -> VoteResponse:
+    # Votes are applied with set-based statements in one transaction, rather than reading and writing back the counters,
+    # so that concurrent votes on the same post are all counted.
+
+    # Removing the user's existing vote (if any), which also tells us what it was:
+    previous_vote = (await db.execute(
+        delete(Vote).where(Vote.post_id == post_id, Vote.user_id == user.id).returning(Vote.vote_type)
+    )).scalar()
+
+    # The change to each counter:
+    deltas = {VoteType.UP: 0, VoteType.DOWN: 0}
+    if previous_vote is not None: deltas[previous_vote] -= 1
+
+    if previous_vote == vote_type:
+        # If the vote type is the same, the user has removed their vote:
+        current_vote = None
     else:
-        # Creating a new vote and increasing the relevant counter by 1:
-        # Need to use a new variable since DB objects are assigned by reference:
-        new_vote = Vote(post_id=post_id, user_id=user.id, vote_type=vote_type)
-        db.add(new_vote)
-        if vote_type == VoteType.UP: post.upvote_count += 1
-        else: post.downvote_count += 1
-
-        # User has added a vote
+        # Otherwise, the user has added or changed their vote.
+        # If a concurrent request from the same user has already inserted a vote, it is left as it is (and not counted twice):
+        try:
+            inserted = (await db.execute(
+                insert_ignoring_conflicts(db.bind.dialect.name, Vote, ["post_id", "user_id"])
+                .values(post_id=post_id, user_id=user.id, vote_type=vote_type).returning(Vote.id)
+            )).scalar()
+        except IntegrityError:
+            # The foreign key constraint fails if the post does not exist:
+            await db.rollback()
+            raise PostNotFoundError
+        if inserted is not None: deltas[vote_type] += 1
         current_vote = vote_type
-    
-    db.commit()
-    db.refresh(post)
-    post.current_user_vote = current_vote
-    return post
\ No newline at end of file
+
+    # Incrementing the counters in the database, and returning the new values.
+    # The scores are calculated from the new counters in the same statement (the row is locked until the transaction is
+    # committed, so concurrent votes update the scores in the same order as the counters):
+    upvote_count, downvote_count = Post.upvote_count + deltas[VoteType.UP], Post.downvote_count + deltas[VoteType.DOWN]
+    counts = (await db.execute(
+        update(Post).where(Post.id == post_id)
+        .values(upvote_count=upvote_count, downvote_count=downvote_count,
+                **score_expressions(db.bind.dialect.name, upvote_count, downvote_count, Post.created_at))
+        .returning(Post.upvote_count, Post.downvote_count, Post.path, Post.parent_id)
+        .execution_options(synchronize_session=False)
+    )).first()
+
+    # Ensuring the post exists (nothing is saved if it doesn't):
+    if counts is None:
+        await db.rollback()
+        raise PostNotFoundError
+
+    await db.commit()
+    await invalidate_post(post_id, counts.path, counts.parent_id, votes=True)
+    # The new counts are sent to the clients following the thread with the other votes of the interval:
+    realtime.vote_updates.add(post_id, counts.path)
+
+    return VoteResponse(current_user_vote=current_vote, upvote_count=counts.upvote_count, downvote_count=counts.downvote_count)
@@ -0,0 +1,95 @@
+import math
+import datetime
+
+from sqlalchemy import Float, Numeric, case, cast, extract, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Post
+
+
+# The "hot" and "controversial" orders sort by scores stored with each post (and indexed), rather than calculating them
+# for every post when a feed is requested.
+
+# Hot posts are those with the most net votes for their age. Rather than reducing every post's score as time passes,
+# newer posts get a higher starting score: every HOT_SCORE_PERIOD seconds a post is newer is worth 10x the net votes.
+# This orders posts the same way as decaying the scores would, but a score only changes when a post is voted on,
+# so the order is stable for pagination and old posts never need to be updated:
+HOT_SCORE_EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+HOT_SCORE_PERIOD = 45_000
+
+# The range of post IDs whose scores are recalculated per transaction by refresh_scores:
+SCORE_REFRESH_BATCH_SIZE = 1000
+
+
+def epoch_seconds(moment: datetime.datetime) -> float:
+    # Timestamps are stored in UTC, without a time zone:
+    if moment.tzinfo is None: moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return (moment - HOT_SCORE_EPOCH).total_seconds()
+
+
+def hot_score(upvote_count: int, downvote_count: int, created_at: datetime.datetime) -> float:
+    net_votes = upvote_count - downvote_count
+    # Each order of magnitude of net votes counts the same (the first 10 votes count as much as the next 90):
+    order = math.log10(max(abs(net_votes), 1))
+    sign = 1 if net_votes > 0 else -1 if net_votes < 0 else 0
+    return round(sign * order + epoch_seconds(created_at) / HOT_SCORE_PERIOD, 7)
+
+
+def controversial_score(upvote_count: int, downvote_count: int) -> float:
+    # Controversial posts have many votes, split evenly between upvotes and downvotes:
+    if upvote_count <= 0 or downvote_count <= 0: return 0.0
+    balance = min(upvote_count, downvote_count) / max(upvote_count, downvote_count)
+    return round((upvote_count + downvote_count) ** balance, 7)
+
+
+def score_values(upvote_count: int, downvote_count: int, created_at: datetime.datetime) -> dict:
+    return {"hot_score": hot_score(upvote_count, downvote_count, created_at),
+            "controversial_score": controversial_score(upvote_count, downvote_count)}
+
+
+def score_expressions(dialect: str, upvote_count, downvote_count, created_at) -> dict:
+    # The same scores as score_values, calculated by the database from SQL expressions (e.g. the counters being updated),
+    # so they can be set in the statement that changes the counters:
+    upvotes, downvotes = cast(upvote_count, Float), cast(downvote_count, Float)
+    net_votes = upvotes - downvotes
+
+    # PostgreSQL's log is in base 10, and the seconds since 1970 are calculated from the date differently by each database:
+    if dialect == "postgresql":
+        log10, unix_seconds = func.log, extract("epoch", created_at)
+    elif dialect == "sqlite":
+        log10, unix_seconds = func.log10, (func.julianday(created_at) - 2440587.5) * 86400
+    else:
+        raise ValueError(f"Scores are not supported for '{dialect}'")
+
+    order = log10(case((func.abs(net_votes) > 1, func.abs(net_votes)), else_=1.0))
+    hot = func.sign(net_votes) * order + (unix_seconds - HOT_SCORE_EPOCH.timestamp()) / HOT_SCORE_PERIOD
+    balance = case((upvotes < downvotes, upvotes / downvotes), else_=downvotes / upvotes)
+    controversial = case((or_(upvotes <= 0, downvotes <= 0), 0.0), else_=func.power(upvotes + downvotes, balance))
+
+    # Rounded as numbers, since PostgreSQL cannot round floats to a number of digits:
+    return {"hot_score": cast(func.round(cast(hot, Numeric), 7), Float),
+            "controversial_score": cast(func.round(cast(controversial, Numeric), 7), Float)}
+
+
+async def refresh_scores(db: AsyncSession, batch_size: int = SCORE_REFRESH_BATCH_SIZE) -> int:
+    # Recalculates the scores of all posts, a batch of IDs at a time (so that the table is never locked for long).
+    # Only needed once, to fill in the scores of posts created before the scores existed (see backfill.py), since votes
+    # update the scores along with the counters.
+    # Returns the number of scores that were changed.
+    scores = score_expressions(db.bind.dialect.name, func.coalesce(Post.upvote_count, 0), func.coalesce(Post.downvote_count, 0),
+                               Post.created_at)
+    changed, last_id = 0, 0
+    max_id = (await db.execute(select(func.max(Post.id)))).scalar() or 0
+
+    while last_id < max_id:
+        # The IDs are returned to count the updated posts:
+        updated = (await db.execute(
+            update(Post).where(Post.id > last_id, Post.id <= last_id + batch_size,
+                               or_(*(getattr(Post, name).is_distinct_from(value) for name, value in scores.items())))
+            .values(**scores).returning(Post.id).execution_options(synchronize_session=False)
+        )).all()
+        await db.commit()
+        changed += len(updated)
+        last_id += batch_size
+
+    return changed
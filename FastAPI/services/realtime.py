@@ -0,0 +1,159 @@
+import asyncio
+
+import orjson
+from sqlalchemy import select
+
+from broadcast import MemoryBroadcaster, Subscription
+from config import get_settings
+from database import AsyncSessionLocal
+from exceptions import TooManyConnectionsError, TooManySubscriptionsError
+from models import Post
+from serializers import serialize_post
+from services.utils import path_ids
+
+
+# Clients subscribe to top-level posts (e.g. the posts of the feed they are showing, or the thread they have open), and
+# receive a small message for each change to a post or any of its replies, rather than requesting the whole tree again.
+# Each message has a "type" and the ID of the top-level post ("thread_id"):
+# - "post_created": a reply was added (with the reply, as returned by the API). The ancestors' comment counts go up by 1.
+# - "post_updated": the title and body of a post were changed.
+# - "post_deleted": a post was deleted along with its replies. The ancestors' comment counts go down by "deleted".
+#   For a top-level post, this is the last message of its thread.
+# - "votes": the vote counts of a post changed.
+# Votes are sent at most once every realtime_vote_interval seconds per post (with the counts at the time), so a post
+# receiving thousands of votes does not send thousands of messages to each of its subscribers.
+#
+# The broadcaster only reaches the clients connected to this worker process. With several workers (WEB_CONCURRENCY),
+# clients miss the changes handled by the other workers until a shared broadcaster is implemented (see broadcast.py):
+broadcaster = MemoryBroadcaster()
+
+# The most top-level posts a client can subscribe to, and the most messages that can be waiting to be sent to it:
+MAX_SUBSCRIBED_POSTS = 100
+MAX_QUEUED_MESSAGES = 100
+
+
+def thread_channel(thread_id: int) -> str:
+    return f"thread:{thread_id}"
+
+
+def thread_id(post_id: int, path: str) -> int:
+    # The top-level post is the first ancestor in the path (or the post itself, if it is not a reply):
+    return path_ids(path)[0] if path else post_id
+
+
+async def publish(thread: int, message: dict) -> None:
+    # The message is encoded once, however many clients it is sent to.
+    # A failure to publish (e.g. if a shared broadcaster is unavailable) does not fail the change that was made:
+    channel = thread_channel(thread)
+    if not broadcaster.may_have_subscribers(channel): return
+    try:
+        await broadcaster.publish(channel, orjson.dumps({**message, "thread_id": thread}).decode())
+    except Exception as e:
+        print(f"Failed to publish to {channel}: {e}")
+
+
+async def post_created(post: Post) -> None:
+    # New top-level posts have no subscribers yet (clients find them in the feeds):
+    if post.parent_id is None: return
+    # The author's own vote is not sent to the other clients:
+    await publish(thread_id(post.id, post.path), {"type": "post_created", "post": {**serialize_post(post), "current_user_vote": None}})
+
+
+async def post_updated(post: Post) -> None:
+    await publish(thread_id(post.id, post.path), {"type": "post_updated", "post_id": post.id, "title": post.title, "body": post.body})
+
+
+async def post_deleted(post, deleted: int) -> None:
+    await publish(thread_id(post.id, post.path), {"type": "post_deleted", "post_id": post.id, "parent_id": post.parent_id,
+                                                  "deleted": deleted})
+
+
+class VoteUpdates:
+    # Collects the posts that were voted on, and publishes their vote counts every interval.
+    # The counts are read when they are published, so each message has the latest counts (including votes handled by
+    # other workers), and messages sent by different workers never go back to older counts.
+
+    def __init__(self):
+        # The posts voted on since the last update, with their paths:
+        self.pending = {}
+        self.task = None
+        self.loop = None
+        self.published = 0
+        self.coalesced = 0
+
+    def add(self, post_id: int, path: str) -> None:
+        if not broadcaster.may_have_subscribers(thread_channel(thread_id(post_id, path))): return
+        if post_id in self.pending: self.coalesced += 1
+        self.pending[post_id] = path
+
+        # Starting a task to publish the votes after the interval (unless one is already waiting).
+        # If the event loop has changed (e.g. between tests), the task is started on the current one:
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.loop is not loop:
+            self.loop = loop
+            self.task = loop.create_task(self.publish_later(get_settings().realtime_vote_interval))
+
+    async def publish_later(self, interval: float) -> None:
+        await asyncio.sleep(interval)
+        # Votes made while these are being published start the next interval:
+        pending, self.pending = self.pending, {}
+        self.task = None
+        try:
+            await self.publish(pending)
+        except Exception as e:
+            print(f"Failed to publish the votes of {len(pending)} posts: {e}")
+
+    async def publish(self, pending: dict) -> None:
+        # Reading the counts of all the posts with one query:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(Post.id, Post.upvote_count, Post.downvote_count).where(Post.id.in_(pending))
+            )).all()
+
+        for row in rows:
+            await publish(thread_id(row.id, pending[row.id]), {"type": "votes", "post_id": row.id,
+                                                               "upvote_count": row.upvote_count, "downvote_count": row.downvote_count})
+            self.published += 1
+
+    def cancel(self) -> None:
+        if self.task is not None: self.task.cancel()
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "published": self.published, "coalesced": self.coalesced}
+
+
+vote_updates = VoteUpdates()
+
+
+async def subscribe(subscription: Subscription, post_ids) -> None:
+    channels = {thread_channel(post_id) for post_id in post_ids}
+    if len(subscription.channels | channels) > MAX_SUBSCRIBED_POSTS: raise TooManySubscriptionsError
+    await subscription.subscribe(channels)
+
+
+async def unsubscribe(subscription: Subscription, post_ids) -> None:
+    await subscription.unsubscribe({thread_channel(post_id) for post_id in post_ids})
+
+
+# The subscriptions of the connections (WebSockets and event streams) open in this worker:
+connections = set()
+
+
+def subscription() -> Subscription:
+    # Each connection holds a task and a queue of messages, so their number is limited.
+    # The subscription must be closed with close (even if subscribing fails):
+    if len(connections) >= get_settings().realtime_max_connections: raise TooManyConnectionsError
+    subscription = Subscription(broadcaster, MAX_QUEUED_MESSAGES)
+    connections.add(subscription)
+    return subscription
+
+
+async def close(subscription: Subscription) -> None:
+    # Can be called more than once:
+    connections.discard(subscription)
+    await subscription.close()
+
+
+def stats() -> dict:
+    return {**broadcaster.stats(), "connections": len(connections), "max_connections": get_settings().realtime_max_connections,
+            "votes": vote_updates.stats()}
@@ -0,0 +1,168 @@
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi.responses import ORJSONResponse
+
+from cache import Cache, MemoryCacheBackend, worker_ttl
+from config import get_settings
+from enums import Order
+from models import Post, User, Vote
+from serializers import serialize_posts, posts_response
+from services.utils import path_ids
+
+
+# Posts and feeds are mostly read by many people between changes, so their responses are cached (as JSON-ready data),
+# rather than loading and serializing the same posts for every request.
+#
+# Each entry has tags naming what it depends on (e.g. "post:5"), and changes invalidate tags rather than entries.
+# The time each tag was last invalidated is stored, and an entry is only used if none of its tags were invalidated
+# after it started loading. This works with a shared backend (where entries cannot be listed or deleted by tag),
+# and a change made while an entry is being loaded still invalidates it.
+#
+# The responses are cached without the current user's votes, which are added to a copy of the cached response
+# for each request (the personalization overlay), so everyone shares the same entries.
+#
+# With several worker processes, each has its own cache and the TTLs are capped at cache_max_staleness (see cache.py).
+# Tags must be kept for at least as long as the entries, so the tag backend should not be smaller than the entry backend:
+response_cache = Cache("response", MemoryCacheBackend(max_size=get_settings().response_cache_size,
+                                                      ttl=worker_ttl(get_settings().response_cache_ttl)))
+tag_cache = Cache("response-tag", MemoryCacheBackend(max_size=get_settings().response_cache_size * 10,
+                                                     ttl=worker_ttl(get_settings().response_cache_ttl)))
+
+# The number of entries found that had been invalidated:
+stale_entries = 0
+
+# The feed orders which are changed by votes (other orders only change when posts are created or deleted):
+VOTE_ORDERS = {Order.POPULARITY, Order.HOT, Order.CONTROVERSIAL}
+
+
+def cache_key(endpoint: str, **params) -> str:
+    # The same request always has the same key, regardless of the order of the query parameters:
+    return f"{endpoint}?{urlencode(sorted((key, getattr(value, 'value', value)) for key, value in params.items() if value is not None))}"
+
+
+def feed_tag(parent_id: Optional[int], show_comments: bool, order_by: Order) -> str:
+    # The posts in a feed are the replies to a post, the top-level posts, or every post (if comments are shown):
+    scope = parent_id if parent_id is not None else ("all" if show_comments else "root")
+    return f"feed:{scope}:{getattr(order_by, 'value', order_by)}"
+
+
+def post_tags(posts: List[Post]) -> set:
+    # A response depends on the posts in it and on their authors. A post's response also contains its replies,
+    # which are covered by the post's tag, since changes to a post also invalidate its ancestors.
+    # Deleting a post deletes its replies, so the responses of all of its descendants depend on it too ("subtree" tags).
+    tags, stack = set(), list(posts)
+    for post in posts:
+        tags.add(f"post:{post.id}")
+        tags.update(f"subtree:{ancestor_id}" for ancestor_id in path_ids(post.path))
+
+    while stack:
+        post = stack.pop()
+        tags.add(f"user:{post.user_id}")
+        stack.extend(post.comments)
+
+    return tags
+
+
+async def invalidate(tags: set) -> None:
+    invalidated_at = time.time()
+    for tag in tags: await tag_cache.set(tag, invalidated_at)
+
+
+async def invalidate_post(post_id: int, path: str, parent_id: Optional[int], feeds: bool = False, votes: bool = False,
+                          subtree: bool = False) -> None:
+    # Invalidates the responses containing a post, which includes those of its ancestors (whose replies include it).
+    # 'feeds' is for changes to which posts are in the feeds (creating or deleting a post),
+    # 'votes' is for changes to the order of the feeds ordered by votes, and
+    # 'subtree' is for changes to the post's descendants (deleting them).
+    tags = {f"post:{ancestor_id}" for ancestor_id in [*path_ids(path), post_id]}
+    if subtree: tags.add(f"subtree:{post_id}")
+
+    if feeds or votes:
+        for show_comments in (False, True):
+            # Comments only appear in the top-level feed if comments are shown:
+            if parent_id is not None and not show_comments: continue
+            for order_by in Order:
+                if feeds or order_by in VOTE_ORDERS: tags.add(feed_tag(None, show_comments, order_by))
+
+        if parent_id is not None:
+            for order_by in Order:
+                if feeds or order_by in VOTE_ORDERS: tags.add(feed_tag(parent_id, False, order_by))
+
+    await invalidate(tags)
+
+
+async def invalidate_user(user_id: int) -> None:
+    # Invalidates the responses containing the user's posts (which include their name and profile image):
+    await invalidate({f"user:{user_id}"})
+
+
+async def get_entry(key: str) -> Optional[dict]:
+    global stale_entries
+
+    entry = await response_cache.get(key)
+    if entry is None: return None
+
+    invalidated_at = await tag_cache.get_many(list(entry["tags"]))
+    if any(tag_time is not None and tag_time >= entry["created_at"] for tag_time in invalidated_at):
+        stale_entries += 1
+        return None
+
+    return entry
+
+
+async def overlay_user_votes(db: AsyncSession, user: User, content: list) -> list:
+    # Returns a copy of the cached posts with the current user's votes, found using one query for the whole response:
+    post_ids, stack = [], list(content)
+    while stack:
+        post = stack.pop()
+        post_ids.append(post["id"])
+        stack.extend(post["comments"] or [])
+
+    if not post_ids: return content
+    rows = await db.execute(select(Vote.post_id, Vote.vote_type).where(Vote.user_id == user.id, Vote.post_id.in_(post_ids)))
+    votes = {post_id: vote_type.value for post_id, vote_type in rows.all()}
+
+    def with_votes(post: dict) -> dict:
+        comments = post["comments"]
+        return {**post, "current_user_vote": votes.get(post["id"]),
+                "comments": [with_votes(comment) for comment in comments] if comments is not None else None}
+
+    return [with_votes(post) for post in content]
+
+
+async def cached_posts_response(db: AsyncSession, user: Optional[User], key: str,
+                                load: Callable[[], Awaitable[Tuple[List[Post], Optional[str]]]],
+                                tags: set = frozenset(), single: bool = False) -> ORJSONResponse:
+    # Returns the response for the posts returned by 'load' (a page of posts and the cursor for the next page),
+    # only calling it if the response is not cached. 'load' must not populate the current user's votes.
+    # If 'single' is true, only the first post is returned (rather than a list).
+    entry = await get_entry(key)
+
+    if entry is None:
+        # Taken before loading, so that changes made while loading invalidate the entry:
+        created_at = time.time()
+        posts, next_cursor = await load()
+
+        entry = {
+            "created_at": created_at,
+            "tags": post_tags(posts) | set(tags),
+            "content": serialize_posts(posts),
+            "next_cursor": next_cursor,
+        }
+        await response_cache.set(key, entry)
+
+    content = entry["content"]
+    if user: content = await overlay_user_votes(db, user, content)
+
+    # The content has already been serialized, so it is returned as it is (rather than validated again by the route):
+    return posts_response(content, entry["next_cursor"], single=single)
+
+
+def stats() -> dict:
+    # Entries that were found but had been invalidated are counted as misses:
+    hits, misses = response_cache.hits - stale_entries, response_cache.misses + stale_entries
+    return {"hits": hits, "misses": misses, "stale": stale_entries, "hit_rate": hits / (hits + misses) if hits + misses else None}
@@ -0,0 +1,64 @@
+from sqlalchemy import select, func, or_, table, column, literal_column
+
+from models import Post, User, POST_SEARCH_DOCUMENT
+
+
+# The FTS5 table that shadows the posts table on SQLite (see models.py).
+# The row ID of each entry is the ID of the post:
+POSTS_FTS = table("posts_fts", column("rowid"), column("title"), column("body"), column("author"))
+
+# The trigram tokenizer can only match terms of at least 3 characters:
+FTS_MIN_TERM_LENGTH = 3
+
+
+def fts_phrase(term: str) -> str:
+    # Quoting the term so that it is matched literally, rather than parsed as FTS5 query syntax:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def fts_match(columns: str, term: str):
+    # Selecting the IDs of the posts whose given columns contain the term, e.g. "{title body} : "term"":
+    return select(POSTS_FTS.c.rowid).where(literal_column("posts_fts").op("MATCH")(f"{columns} : {fts_phrase(term)}"))
+
+
+def title_filter(dialect: str, term: str):
+    # Case insensitive substring search of post titles.
+    # On PostgreSQL, ILIKE is served by the trigram index, on SQLite the FTS5 table is used instead:
+    if dialect == "sqlite" and len(term) >= FTS_MIN_TERM_LENGTH:
+        return Post.id.in_(fts_match("title", term))
+    # The 'ilike' function allows for case insensitive search, and the '%' signs are wildcards:
+    return Post.title.ilike(f"%{term}%")
+
+
+def author_filter(dialect: str, term: str):
+    # Case insensitive substring search of author names (the query must be joined to the users table):
+    if dialect == "sqlite" and len(term) >= FTS_MIN_TERM_LENGTH:
+        return Post.id.in_(fts_match("author", term))
+    return User.name.ilike(f"%{term}%")
+
+
+def search_scores_query(dialect: str, text: str):
+    # Returns a query of the IDs of the posts matching the search text, with a relevance score (higher is better).
+    if dialect == "postgresql":
+        # Matching words in the title or body (using the full text index), or part of the title (using the trigram index):
+        search_query = func.websearch_to_tsquery(literal_column("'english'"), text)
+        score = func.ts_rank(POST_SEARCH_DOCUMENT, search_query) + func.similarity(func.coalesce(Post.title, ""), text)
+        return select(Post.id, score.label("score")).where(
+            or_(POST_SEARCH_DOCUMENT.op("@@")(search_query), Post.title.ilike(f"%{text}%"))
+        )
+
+    elif dialect == "sqlite":
+        # bm25 returns better matches as lower (more negative) values, so negating it:
+        if len(text) >= FTS_MIN_TERM_LENGTH:
+            score = -func.bm25(literal_column("posts_fts"))
+            return (
+                select(POSTS_FTS.c.rowid.label("id"), score.label("score"))
+                .where(literal_column("posts_fts").op("MATCH")(f"{{title body}} : {fts_phrase(text)}"))
+            )
+        # Too short for the index, so falling back to a scan:
+        return select(Post.id, literal_column("0.0").label("score")).where(
+            or_(Post.title.ilike(f"%{text}%"), Post.body.ilike(f"%{text}%"))
+        )
+
+    else:
+        raise ValueError(f"Search is not supported for '{dialect}'")
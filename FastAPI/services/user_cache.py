@@ -0,0 +1,60 @@
+from typing import Optional
+
+from sqlalchemy import select, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import Cache, MemoryCacheBackend, worker_ttl
+from config import get_settings
+from models import User, Image
+
+
+# Every authenticated request needs the current user, so the users are cached by ID rather than selected each time.
+# Entries expire after user_cache_ttl seconds, which limits how long a change that was not invalidated can go unnoticed.
+# With several worker processes, each has its own cache and the TTL is capped at cache_max_staleness (see cache.py):
+user_cache = Cache("user", MemoryCacheBackend(max_size=get_settings().user_cache_size, ttl=worker_ttl(get_settings().user_cache_ttl)))
+
+# Password hashes are not cached (they are only needed when the password is checked, which selects the user anyway):
+UNCACHED_USER_COLUMNS = {"password"}
+
+
+def column_values(instance, exclude: set = frozenset()) -> dict:
+    return {column.key: getattr(instance, column.key) for column in inspect(instance).mapper.column_attrs
+            if column.key not in exclude}
+
+
+def detached_instance(model, values: dict):
+    # Creates an instance as if it had been loaded from the database (rather than a new one that would be inserted):
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return instance
+
+
+async def get_cached_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    # Returns the user with the given ID, or None if they do not exist, only selecting them if they are not cached:
+    values = await user_cache.get(user_id)
+
+    if values is None:
+        user = (await db.execute(select(User).filter_by(id=user_id))).scalars().first()
+        if user is None: return None
+
+        await user_cache.set(user_id, {
+            "user": column_values(user, exclude=UNCACHED_USER_COLUMNS),
+            "profile_image": column_values(user.profile_image) if user.profile_image is not None else None,
+        })
+        return user
+
+    user = detached_instance(User, values["user"])
+    profile_image = detached_instance(Image, values["profile_image"]) if values["profile_image"] is not None else None
+    # Setting the relationship without it counting as a change:
+    set_committed_value(user, "profile_image", profile_image)
+
+    # Adding the user to the session without selecting it, so that changes to it are saved as usual.
+    # The password is expired, so it would be loaded if it was used:
+    return await db.merge(user, load=False)
+
+
+async def invalidate_user(user_id: int) -> None:
+    # Must be called after any change to a user (or their profile image) is committed:
+    await user_cache.delete(user_id)
@@ -1,20 +1,22 @@
-import os
-
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from fastapi import File, UploadFile
 from exceptions import UserNotFoundError, UserAlreadyExistsError, ImageNotFoundError
 
 from dependencies import user_dependency, db_dependency
-from services.image_service import create_image
+from services.image_service import create_image, release_image_files
 from services.auth_service import authenticate_user
+from services.user_cache import invalidate_user
+from services import response_cache
 from schemas import CreateUserRequest, UpdateUserRequest, UpdateUserPasswordRequest
 from models import User, Image
-from security import bcrypt_context
+from enums import Role
+from security import hash_password
 
 
-def create_user(db: db_dependency, user_data: CreateUserRequest) -> User:
+async def create_user(db: db_dependency, user_data: CreateUserRequest) -> User:
     # Hashing the password:
-    password_hash = bcrypt_context.hash(user_data.password)
+    password_hash = await hash_password(user_data.password)
 
     # Creating a new user instance with the hashed password instead of plaintext:
     new_user = User(**user_data.model_dump(exclude={"password", "name"}), name=user_data.name.title(), password=password_hash)
@@ -22,30 +24,33 @@ def create_user(db: db_dependency, user_data: CreateUserRequest) -> User:
     try: 
         # Returning the new user (will be converted to the response model at the endpoints):
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         return new_user
         
     except IntegrityError:
         raise UserAlreadyExistsError
 
 
-def get_user(db: db_dependency, user_id: int) -> User:
-    user = db.query(User).filter_by(id=user_id).first()
+async def get_user(db: db_dependency, user_id: int) -> User:
+    user = (await db.execute(select(User).filter_by(id=user_id))).scalars().first()
 
     # Ensuring the user exists:
     if user is None: raise UserNotFoundError
-    
-    user.profile_image_url = read_profile_image(db, user_id).url
+
+    # The profile image is loaded with the user (and returned as part of the response):
     return user
 
 
-def update_user(db: db_dependency, user: user_dependency, user_data: UpdateUserRequest) -> User:
+async def update_user(db: db_dependency, user: user_dependency, user_data: UpdateUserRequest) -> User:
     try:
         for key, value in user_data.dict().items():
             setattr(user, key, value)
 
-        db.commit()
+        await db.commit()
+        await invalidate_user(user.id)
+        # The user's name is included with their posts:
+        await response_cache.invalidate_user(user.id)
 
         return user
         
@@ -53,39 +58,57 @@ def update_user(db: db_dependency, user: user_dependency, user_data: UpdateUserR
         raise UserAlreadyExistsError
     
 
-def update_user_password(db: db_dependency, user: user_dependency, password_data: UpdateUserPasswordRequest) -> None:
+async def update_user_password(db: db_dependency, user: user_dependency, password_data: UpdateUserPasswordRequest) -> None:
 
-    authenticate_user(db, user.email, password_data.old_password)
+    await authenticate_user(db, user.email, password_data.old_password)
 
     # Hashing the password:
-    password_hash = bcrypt_context.hash(password_data.new_password)
+    password_hash = await hash_password(password_data.new_password)
     user.password = password_hash
-    db.commit()
+    await db.commit()
+    await invalidate_user(user.id)
+
+
+async def update_user_role(db: db_dependency, user_id: int, role: Role) -> User:
+    user = (await db.execute(select(User).filter_by(id=user_id))).scalars().first()
+    if user is None: raise UserNotFoundError
+
+    user.role = role
+    await db.commit()
+    # The role is checked using the cached user, so the change must take effect immediately (e.g. removing admin access):
+    await invalidate_user(user.id)
+
+    return user
 
 
 async def create_profile_image(db: db_dependency, user: user_dependency, image: UploadFile = File(...)) -> Image:
-    url = await create_image(image)
-    image_record = Image(user_id=user.id, url=url)
+    image_data = await create_image(db, image)
+    image_record = Image(user_id=user.id, **image_data)
     db.add(image_record)
-    db.commit()
+    await db.commit()
+    await invalidate_user(user.id)
+    await response_cache.invalidate_user(user.id)
 
     return image_record
 
 
-def read_profile_image(db: db_dependency, user_id: int) -> Image:
-    image = db.query(Image).filter_by(user_id=user_id).first()
+async def read_profile_image(db: db_dependency, user_id: int) -> Image:
+    image = (await db.execute(select(Image).filter_by(user_id=user_id))).scalars().first()
 
     if image is None: raise ImageNotFoundError
     return image
 
 
-def delete_profile_image(db: db_dependency, user: user_dependency) -> None:
+async def delete_profile_image(db: db_dependency, user: user_dependency) -> None:
     # Deletes both the database record and actual image:
-    image = db.query(Image).filter_by(user_id=user.id).first()
+    image = (await db.execute(select(Image).filter_by(user_id=user.id))).scalars().first()
 
     if image is None: raise ImageNotFoundError
 
-    if os.path.exists(image.url): os.remove(image.url)
+    await db.delete(image)
+    await db.commit()
+    await invalidate_user(user.id)
+    await response_cache.invalidate_user(user.id)
 
-    db.delete(image)
-    db.commit()
\ No newline at end of file
+    # Deleting the image and its renditions, unless they are shared with other records:
+    release_image_files([image])
\ No newline at end of file
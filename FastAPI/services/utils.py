@@ -1,11 +1,134 @@
+import json
+import base64
+import binascii
+import datetime
+
+from sqlalchemy import select, func, literal, tuple_, and_
+from sqlalchemy.dialects import postgresql, sqlite
+
 from models import Post
 from enums import Order
+from exceptions import InvalidCursorError
 
 
-def order_query(query, order_by: Order = Order.DATE):
+def order_columns(order_by: Order = Order.DATE) -> tuple:
+    # The columns that posts are sorted by (in descending order) for each order option.
+    # The ID is always last, so that posts with equal values have a stable order for pagination:
     if order_by == Order.DATE:
-        return query.order_by(Post.created_at.desc())
+        return Post.created_at, Post.id
     elif order_by == Order.POPULARITY:
-        return query.order_by(Post.upvote_count.desc())
+        return Post.upvote_count, Post.id
+    elif order_by == Order.HOT:
+        return Post.hot_score, Post.id
+    elif order_by == Order.CONTROVERSIAL:
+        return Post.controversial_score, Post.id
     else:
         raise ValueError("Invalid order value")
+
+
+def order_query(query, order_by: Order = Order.DATE):
+    return query.order_by(*(column.desc() for column in order_columns(order_by)))
+
+
+def encode_post_cursor(post: Post, order_by: Order) -> str:
+    # The cursor stores the sort values of the last post on the page, so the next page continues after it:
+    value, post_id = (getattr(post, column.key) for column in order_columns(order_by))
+    if order_by == Order.DATE: value = value.isoformat()
+    return encode_cursor({"order_by": order_by.value, "value": value, "id": post_id})
+
+
+def after_cursor_query(query, order_by: Order, cursor: str):
+    # Keyset pagination: filtering to the posts that come after the cursor, rather than using OFFSET,
+    # so that the database can seek straight to the start of the page using the index:
+    position = decode_cursor(cursor)
+    if position.get("order_by") != order_by.value or not isinstance(position.get("id"), int):
+        raise InvalidCursorError
+
+    value = position.get("value")
+    try:
+        if order_by == Order.DATE: value = datetime.datetime.fromisoformat(value)
+        elif order_by == Order.POPULARITY: value = int(value)
+        # The scores are floats, which are stored in the cursor exactly:
+        else: value = float(value)
+    except (TypeError, ValueError) as e:
+        raise InvalidCursorError() from e
+
+    # Since the order is descending, the posts after the cursor are the ones with smaller values.
+    # The values are bound using the column types, so they are stored in the same format as the columns:
+    columns = order_columns(order_by)
+    values = (literal(value, columns[0].type), literal(position["id"], columns[1].type))
+    return query.where(tuple_(*columns) < tuple_(*values))
+
+
+def child_path(post: Post) -> str:
+    # The path of a reply to the post (its ancestors are the post and the post's ancestors):
+    return f"{post.path}{post.id}/"
+
+
+def path_ids(path: str) -> list:
+    # The IDs of the ancestors stored in a path:
+    return [int(post_id) for post_id in path.split("/") if post_id]
+
+
+def descendants_filter(post: Post):
+    # All descendants have paths starting with the post's child path, e.g. "1/5/" for post 5 (whose parent is 1).
+    # Since '0' is the character after '/', these are the paths in the range ["1/5/", "1/50"),
+    # which (unlike LIKE '1/5/%') can always be served by the index on the path:
+    prefix = child_path(post)
+    return and_(Post.path >= prefix, Post.path < prefix[:-1] + "0")
+
+
+def insert_ignoring_conflicts(dialect: str, model, index_elements: list):
+    # An INSERT that does nothing if a row with the same values for the (unique) index elements already exists.
+    # Each database has its own upsert syntax, so using the insert construct of the dialect:
+    dialects = {"postgresql": postgresql, "sqlite": sqlite}
+    if dialect not in dialects: raise ValueError(f"Upserts are not supported for '{dialect}'")
+    return dialects[dialect].insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def encode_cursor(data: dict) -> str:
+    # Cursors are opaque to clients, so the position is serialised to JSON and base64 encoded:
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, UnicodeError) as e:
+        raise InvalidCursorError() from e
+
+    if not isinstance(data, dict): raise InvalidCursorError
+    return data
+
+
+def comment_tree_query(parent_ids, max_depth: int, reply_limit: int, after_id: int = None):
+    # A recursive CTE that walks down from the given parents, up to max_depth levels.
+    # The first (anchor) part selects the direct replies, the second (recursive) part repeatedly selects
+    # the replies of the rows found so far, so the whole tree is fetched by one statement:
+    anchor = select(Post.id, Post.parent_id, literal(1).label("depth")).where(Post.parent_id.in_(parent_ids))
+    # Used to load more replies, continuing after the last reply that was returned:
+    if after_id is not None: anchor = anchor.where(Post.id > after_id)
+
+    tree = anchor.cte("comment_tree", recursive=True)
+    tree = tree.union_all(
+        select(Post.id, Post.parent_id, tree.c.depth + 1)
+        .join(tree, Post.parent_id == tree.c.id)
+        .where(tree.c.depth < max_depth)
+    )
+
+    # Window functions cannot be used within the recursive part, so numbering each reply among its siblings here.
+    # The sibling count tells us whether a comment has more replies than were returned:
+    ranked = select(
+        tree.c.id,
+        tree.c.depth,
+        func.row_number().over(partition_by=tree.c.parent_id, order_by=tree.c.id).label("position"),
+        func.count().over(partition_by=tree.c.parent_id).label("siblings"),
+    ).subquery()
+
+    # Replies are returned oldest first (IDs are assigned in creation order), parents before their replies:
+    return (
+        select(Post, ranked.c.depth, ranked.c.siblings)
+        .join(ranked, Post.id == ranked.c.id)
+        .where(ranked.c.position <= reply_limit)
+        .order_by(ranked.c.depth, Post.id)
+    )